@@ -0,0 +1,110 @@
+"""
+Benchmark of requests/sec and latency of the sync and async apps
+
+Starts the Flask app under gunicorn sync workers and the ASGI app of
+service.asgi under uvicorn workers, one worker each, then runs concurrent
+clients against GET /products/<id> and GET /products?limit=20 of each for a
+fixed time. The cache is turned off, so every request waits for the database.
+The products are created through the app and deleted at the end:
+
+  DATABASE_URI=postgresql://... python -m benchmarks.async_vs_sync [clients] [seconds]
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import subprocess
+
+import httpx
+
+# an empty config: gunicorn would otherwise load ./gunicorn.conf.py, with its
+# worker class, preloading and server hooks
+NO_CONFIG = "--config=/dev/null"
+SERVERS = {
+    "sync": ["gunicorn", NO_CONFIG, "--workers=1", "--worker-class=sync", "--bind=127.0.0.1:{port}", "service:app"],
+    "async": ["gunicorn", NO_CONFIG, "--workers=1", "--worker-class=uvicorn.workers.UvicornWorker",
+              "--bind=127.0.0.1:{port}", "service.asgi:app"],
+}
+PRODUCTS = 200
+
+
+def start(command: list, port: int) -> subprocess.Popen:
+    """Starts a server and waits until it answers"""
+    env = dict(os.environ, CACHE_ENABLED="false")
+    server = subprocess.Popen(
+        [arg.format(port=port) for arg in command], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/products/0")
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f"{command[-1]} did not start")
+
+
+async def client(http, paths: list, deadline: float, latencies: list):
+    """Sends requests one after the other until the deadline"""
+    while time.perf_counter() < deadline:
+        start_time = time.perf_counter()
+        response = await http.get(random.choice(paths))
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start_time)
+
+
+async def run(base_url: str, paths: list, clients: int, seconds: float) -> list:
+    """Returns the latency of every request the clients sent in time"""
+    latencies = []
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as http:
+        deadline = time.perf_counter() + seconds
+        await asyncio.gather(*[client(http, paths, deadline, latencies) for _ in range(clients)])
+    return latencies
+
+
+def report(name: str, route: str, latencies: list, seconds: float):
+    """Prints the throughput and latency percentiles of a run"""
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f"{name:<6} {route:<16} {len(latencies) / seconds:8.1f} req/s  p50 {p50:7.1f} ms  p99 {p99:7.1f} ms")
+
+
+def create_products(base_url: str, name: str, ids: list):
+    """Creates the benchmark products, collecting their ids as it goes"""
+    for index in range(PRODUCTS):
+        response = httpx.post(
+            f"{base_url}/products",
+            json={"name": f"bench-{name}-{index}", "description": "benchmark product",
+                  "category": f"category-{index % 20}", "price": 10.0 + index % 90, "available": True},
+        )
+        response.raise_for_status()
+        ids.append(response.json()["id"])
+
+
+def main(clients: int = 32, seconds: float = 10.0):
+    """Benchmarks each app with the same clients and products"""
+    for port, (name, command) in enumerate(SERVERS.items(), start=8091):
+        server = start(command, port)
+        base_url = f"http://127.0.0.1:{port}"
+        ids = []
+        try:
+            create_products(base_url, name, ids)
+            routes = {
+                "/products/<id>": [f"/products/{product_id}" for product_id in ids],
+                "/products": ["/products?limit=20"],
+            }
+            for route, paths in routes.items():
+                latencies = asyncio.run(run(base_url, paths, clients, seconds))
+                report(name, route, latencies, seconds)
+        finally:
+            for product_id in ids:
+                httpx.delete(f"{base_url}/products/{product_id}")
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]], *[float(arg) for arg in sys.argv[2:3]])
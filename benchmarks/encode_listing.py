@@ -0,0 +1,47 @@
+"""
+Benchmark of encoding a product listing with each JSON encoder
+
+  python -m benchmarks.encode_listing [products] [repeats]
+"""
+import sys
+import json
+import timeit
+
+from flask.json import JSONEncoder
+
+from service.utils.json_encoder import FastJSONEncoder
+
+
+def listing(count: int) -> list:
+    """Returns count serialized products"""
+    return [
+        {
+            "id": index,
+            "name": f"product-{index}",
+            "description": "unavailable",
+            "category": f"category-{index % 20}",
+            "price": 10.0 + index % 9000 / 100,
+            "available": index % 2 == 0,
+            "rating": None if index % 3 else 3.5,
+            "no_of_users_rated": index % 3,
+        }
+        for index in range(count)
+    ]
+
+
+def main(count: int = 10000, repeats: int = 5):
+    """Prints the best time per product of each encoder, as jsonify calls it"""
+    products = listing(count)
+    for encoder in (JSONEncoder, FastJSONEncoder):
+        best = min(
+            timeit.repeat(
+                lambda: json.dumps(products, cls=encoder, sort_keys=True, separators=(",", ":")),
+                number=1,
+                repeat=repeats,
+            )
+        )
+        print(f"{encoder.__name__:<16} {best * 1e6 / count:8.2f} us/product  ({count} products)")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
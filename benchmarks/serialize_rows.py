@@ -0,0 +1,74 @@
+"""
+Benchmark of the per-row cost of serializing a product listing
+
+Compares the ORM path (hydrate Product instances, then Product.serialize())
+with the column-projected row path behind GET /products, for every field
+and for a ?fields=id,name,price projection.
+
+The products are inserted inside a transaction that is rolled back at the
+end, so it can be pointed at any database:
+
+  DATABASE_URI=postgresql://... python -m benchmarks.serialize_rows [rows] [repeats]
+"""
+import os
+import sys
+import timeit
+
+from service import app
+from service.models import Product, db
+from service.routes import init_db
+
+
+def seed(count: int):
+    """Adds count products to the current transaction"""
+    db.session.add_all(
+        Product(
+            name=f"bench-{index}",
+            description="benchmark product",
+            category=f"category-{index % 20}",
+            price=10.0 + index % 90,
+            available=index % 2 == 0,
+            rating=None,
+            no_of_users_rated=0,
+        )
+        for index in range(count)
+    )
+    db.session.flush()
+    db.session.expunge_all()
+
+
+def orm_listing():
+    """The previous listing: Product instances serialized one by one"""
+    products = [product.serialize() for product in Product.find_by_criteria({})]
+    db.session.expunge_all()
+    return products
+
+
+def row_listing(fields=None):
+    """The listing served by GET /products: plain rows straight to dicts"""
+    fields, statement = Product.select_rows({}, fields)
+    return [dict(zip(fields, row)) for row in db.session.execute(statement)]
+
+
+def main(count: int = 10000, repeats: int = 5):
+    """Prints the best time per row of each way to build the listing"""
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URI", app.config["SQLALCHEMY_DATABASE_URI"])
+    init_db()
+    seed(count)
+    try:
+        cases = {
+            "orm + serialize()": orm_listing,
+            "rows, all fields": row_listing,
+            "rows, id,name,price": lambda: row_listing(("name", "price")),
+        }
+        rows = len(orm_listing())
+        for label, listing in cases.items():
+            best = min(timeit.repeat(listing, number=1, repeat=repeats))
+            print(f"{label:<22} {best * 1e6 / rows:8.2f} us/row  ({rows} rows)")
+    finally:
+        db.session.rollback()
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,91 @@
+"""
+Measurement of the boot time and memory of the gunicorn workers
+
+Starts gunicorn with gunicorn.conf.py, with and without preloading the app,
+and reports how long it took until every worker answered a request and the
+memory of the master and of each worker: RSS, PSS (shared pages divided
+among the processes sharing them) and USS (pages of that process only).
+Run it in another checkout to compare with an older version:
+
+  DATABASE_URI=postgresql://... python -m benchmarks.worker_startup [workers] [checkout]
+"""
+import os
+import sys
+import time
+import subprocess
+
+import httpx
+
+PORT = 8095
+
+
+def memory(pid: int) -> dict:
+    """Returns the RSS, PSS and USS of a process in MiB"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup", encoding="ascii") as smaps:
+        for line in smaps:
+            key, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                values[key] = int(value.split()[0]) / 1024
+    uss = values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+    return {"rss": values["Rss"], "pss": values["Pss"], "uss": uss}
+
+
+def children(pid: int) -> list:
+    """Returns the pids of the child processes of a process"""
+    with open(f"/proc/{pid}/task/{pid}/children", encoding="ascii") as children_file:
+        return [int(child) for child in children_file.read().split()]
+
+
+def wait_for_workers(workers: int, timeout: float = 60.0) -> set:
+    """Sends requests until every worker has answered one, returns their pids"""
+    answered = set()
+    deadline = time.monotonic() + timeout
+    with httpx.Client(base_url=f"http://127.0.0.1:{PORT}", headers={"Connection": "close"}) as http:
+        while len(answered) < workers:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"only {len(answered)} of {workers} workers answered")
+            try:
+                response = http.get("/metrics/pool")
+            except httpx.TransportError:
+                time.sleep(0.05)
+                continue
+            if response.status_code == 200:
+                answered.add(response.json()["pid"])
+    return answered
+
+
+def measure(workers: int, checkout: str, preload: bool) -> dict:
+    """Starts gunicorn, waits for its workers and measures it"""
+    env = dict(os.environ, GUNICORN_WORKERS=str(workers), GUNICORN_PRELOAD=str(preload).lower(),
+               GUNICORN_WORKER_CLASS="sync", PORT=str(PORT))
+    start = time.monotonic()
+    server = subprocess.Popen(
+        ["gunicorn", "--config=gunicorn.conf.py", "service:app"],
+        cwd=checkout, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        pids = wait_for_workers(workers)
+        boot = time.monotonic() - start
+        worker_memory = [memory(pid) for pid in children(server.pid) if pid in pids]
+        return {"boot": boot, "master": memory(server.pid), "workers": worker_memory}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(workers: int = 4, checkout: str = "."):
+    """Prints the boot time and memory without and with preloading"""
+    print(f"{'preload':<8} {'boot s':>7}  {'master RSS':>10}  {'worker RSS':>10}  {'PSS':>6}  {'USS':>6}  (MiB)")
+    for preload in (False, True):
+        result = measure(workers, checkout, preload)
+        count = len(result["workers"])
+        average = {key: sum(worker[key] for worker in result["workers"]) / count for key in ("rss", "pss", "uss")}
+        print(
+            f"{str(preload):<8} {result['boot']:7.2f}  {result['master']['rss']:10.1f}  "
+            f"{average['rss']:10.1f}  {average['pss']:6.1f}  {average['uss']:6.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]], *sys.argv[2:3])
@@ -0,0 +1,215 @@
+"""
+Gunicorn configuration of the product service
+
+  gunicorn --config gunicorn.conf.py service:app
+
+Workers are sized from the CPU and memory limits of the container (cgroup
+v1 or v2) unless set explicitly. Every setting can be overridden from the
+environment:
+
+  GUNICORN_BIND                  address to listen on, default 0.0.0.0:$PORT
+  GUNICORN_WORKER_CLASS          sync, gthread (default) or gevent
+  GUNICORN_WORKERS               default 2 x CPUs + 1, within GUNICORN_WORKER_MEMORY
+  GUNICORN_WORKER_MEMORY         MiB one worker needs, default 48
+  GUNICORN_THREADS               threads of a gthread worker, default 4
+  GUNICORN_WORKER_CONNECTIONS    concurrent requests of a gevent worker, default 100
+  GUNICORN_PRELOAD               load the app once in the master, default true
+  GUNICORN_TIMEOUT               seconds before a silent worker is restarted, default 30
+  GUNICORN_GRACEFUL_TIMEOUT      seconds a worker gets to finish on restart, default 30
+  GUNICORN_KEEPALIVE             seconds to keep an idle connection open, default 5
+  GUNICORN_MAX_REQUESTS          requests before a worker is recycled, default 1000 (0 never)
+  GUNICORN_MAX_REQUESTS_JITTER   random extra requests, so workers are not recycled together, default 100
+  GUNICORN_LOG_LEVEL             default info
+  PROMETHEUS_MULTIPROC_DIR       where the workers write their metrics, emptied on start
+
+This file must not import the service: the master reads it before it loads
+the app, and without preloading the master never loads it at all.
+"""
+import os
+import sys
+import tempfile
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+MIB = 1024 * 1024
+# cgroup v1 reports "no limit" as a huge page-aligned number
+UNLIMITED_MEMORY = 2 ** 60
+
+
+def read_cgroup(root: str, *paths: str):
+    """Returns the content of the first cgroup file that exists, or None"""
+    for path in paths:
+        try:
+            with open(os.path.join(root, path), encoding="ascii") as cgroup_file:
+                return cgroup_file.read().strip()
+        except OSError:
+            continue
+    return None
+
+
+def cgroup_cpus(root: str = CGROUP_ROOT):
+    """Returns the CPU limit of the container in CPUs, or None if it has none"""
+    cpu_max = read_cgroup(root, "cpu.max")  # cgroup v2: "<quota> <period>"
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        return int(quota) / int(period or 100000) if quota != "max" else None
+    quota = read_cgroup(root, "cpu/cpu.cfs_quota_us", "cpu,cpuacct/cpu.cfs_quota_us")
+    period = read_cgroup(root, "cpu/cpu.cfs_period_us", "cpu,cpuacct/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def cgroup_memory(root: str = CGROUP_ROOT):
+    """Returns the memory limit of the container in bytes, or None if it has none"""
+    limit = read_cgroup(root, "memory.max", "memory/memory.limit_in_bytes")
+    if not limit or limit == "max" or int(limit) >= UNLIMITED_MEMORY:
+        return None
+    return int(limit)
+
+
+def available_cpus() -> float:
+    """Returns the CPUs this process may use: its cgroup limit or its CPU affinity"""
+    cpus = cgroup_cpus()
+    if cpus is not None:
+        return cpus
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def worker_count(cpus: float, memory: int = None, worker_memory: int = 48 * MIB) -> int:
+    """Returns 2 x CPUs + 1 workers, as many as fit in memory and at least one"""
+    workers = int(2 * cpus) + 1
+    if memory is not None:
+        workers = min(workers, memory // worker_memory)
+    return max(workers, 1)
+
+
+def env_int(name: str, default: int) -> int:
+    """Returns an integer setting from the environment"""
+    return int(os.getenv(name) or default)
+
+
+def env_bool(name: str, default: bool) -> bool:
+    """Returns a boolean setting from the environment"""
+    value = os.getenv(name)
+    return default if not value else value.lower() in ("true", "1", "yes")
+
+
+######################################################################
+# S E T T I N G S
+######################################################################
+bind = os.getenv("GUNICORN_BIND") or f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+if worker_class not in ("sync", "gthread", "gevent"):
+    raise ValueError(f"GUNICORN_WORKER_CLASS must be sync, gthread or gevent, not {worker_class}")
+workers = env_int(
+    "GUNICORN_WORKERS",
+    worker_count(available_cpus(), cgroup_memory(), env_int("GUNICORN_WORKER_MEMORY", 48) * MIB),
+)
+threads = env_int("GUNICORN_THREADS", 4) if worker_class == "gthread" else 1
+worker_connections = env_int("GUNICORN_WORKER_CONNECTIONS", 100)
+preload_app = env_bool("GUNICORN_PRELOAD", True)
+timeout = env_int("GUNICORN_TIMEOUT", 30)
+graceful_timeout = env_int("GUNICORN_GRACEFUL_TIMEOUT", 30)
+keepalive = env_int("GUNICORN_KEEPALIVE", 5)
+max_requests = env_int("GUNICORN_MAX_REQUESTS", 1000)
+max_requests_jitter = env_int("GUNICORN_MAX_REQUESTS_JITTER", 100)
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+# The workers share their request metrics through files in this directory,
+# see service.utils.metrics. It must be set before the app is imported.
+METRICS_DIR = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "products-metrics")
+)
+
+
+######################################################################
+# S E R V E R   H O O K S
+######################################################################
+def on_starting(server):
+    """Migrates the database once, in the master, before any worker is forked
+
+    The workers inherit the migrated state and the loaded name completions.
+    Without preloading each worker does this on its first request instead.
+    The metrics files of a previous run are removed first.
+    """
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    for name in os.listdir(METRICS_DIR):
+        if name.endswith(".db"):
+            os.remove(os.path.join(METRICS_DIR, name))
+    if not preload_app:
+        return
+    from service import app, routes  # pylint: disable=import-outside-toplevel
+
+    try:
+        routes.prepare_db(app)
+    except Exception as error:  # pylint: disable=broad-except
+        server.log.critical("%s: Cannot continue", error)
+        sys.exit(4)
+
+
+def when_ready(server):
+    """Logs how the workers were sized"""
+    cpus, memory = available_cpus(), cgroup_memory()
+    server.log.info(
+        "%d %s worker(s) x %d thread(s) for %.2f CPU(s) and %s MiB, preload %s",
+        workers,
+        worker_class,
+        threads if worker_class == "gthread" else worker_connections if worker_class == "gevent" else 1,
+        cpus,
+        memory // MIB if memory else "unlimited",
+        preload_app,
+    )
+
+
+def post_fork(server, worker):
+    """Gives the new worker its own database connections
+
+    The master opened a connection pool to migrate the database; its sockets
+    are inherited by every worker, so each worker drops them (without
+    closing the master's) and opens its own on first use.
+    """
+    if worker_class == "gevent":
+        try:
+            from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            server.log.warning("gevent workers need psycogreen to wait for the database cooperatively")
+        else:
+            patch_psycopg()
+    if not preload_app:
+        return
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.models import db  # pylint: disable=import-outside-toplevel
+
+    with app.app_context():
+        for bind_key in [None, *(app.config.get("SQLALCHEMY_BINDS") or {})]:
+            db.get_engine(app, bind=bind_key).dispose(close=False)
+
+
+def worker_exit(server, worker):
+    """Writes the ratings still waiting in the buffer of the exiting worker
+
+    Its live gauges are then dropped from the metrics, see child_exit.
+    """
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.models import rating_buffer  # pylint: disable=import-outside-toplevel
+
+    with app.app_context():
+        pending = rating_buffer.pending()
+        if pending:
+            server.log.info("Writing %d buffered rating(s) before worker %s exits", pending, worker.pid)
+        rating_buffer.stop()
+    mark_process_dead(worker.pid)
+
+
+def child_exit(server, worker):
+    """Drops the live gauges of a worker that was killed before worker_exit ran"""
+    mark_process_dead(worker.pid)
+
+
+def mark_process_dead(pid: int):
+    """Removes the live gauge files of a worker, so it is no longer reported"""
+    from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+
+    multiprocess.mark_process_dead(pid, METRICS_DIR)
@@ -3,37 +3,78 @@ Package: service
 Package for the application models and service routes
 This module creates and configures the Flask app and sets up the logging
 and SQL database
+
+Importing the package is cheap: Flask, SQLAlchemy, the models and the
+routes are only imported by create_app(), and nothing connects to the
+database until the first request (see service.routes.ensure_db).
+service.app, the app that gunicorn and the flask command serve, is
+created on first use.
 """
 import sys
+import threading
+
+# the settings of the app, overridden by the config passed to create_app()
+DEFAULT_CONFIG = "service.config"
+
+# makes threads that use service.app first share one app
+app_lock = threading.Lock()
+
+
+def create_app(config=DEFAULT_CONFIG):
+    """
+    Creates and configures the Flask app
+
+    :param config: the settings, an object or the import name of one
+    :type config: object or str
+
+    :return: the app, with the routes, error handlers, commands and metrics registered
+    :rtype: Flask
 
-# import logging
-from flask import Flask
-from service import config
-from service.utils import log_handlers
+    """
+    # pylint: disable=import-outside-toplevel
+    from flask import Flask
+    from service.models import Product
+    from service.routes import api
+    from service.utils import log_handlers
+    from service.utils.cli_commands import commands
+    from service.utils.error_handlers import errors
+    from service.utils.json_encoder import select_json_encoder
+    from service.utils.metrics import metrics
 
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object(config)
+    # Create Flask application
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.json_encoder = select_json_encoder(app.config["JSON_ENCODER"])
+    app.register_blueprint(api)
+    app.register_blueprint(errors)
+    app.register_blueprint(commands)
+    app.register_blueprint(metrics)
 
-# Dependencies require we import the routes AFTER the Flask app is created
-# pylint: disable=wrong-import-position, wrong-import-order
-from service import routes  # noqa: E402, E261
+    # Set up logging for production
+    log_handlers.init_logging(app, "gunicorn.error")
 
-# pylint: disable=wrong-import-position
-from service.utils import error_handlers, cli_commands  # noqa: F401 E402
+    app.logger.info(70 * "*")
+    app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
+    app.logger.info(70 * "*")
 
-# Set up logging for production
-log_handlers.init_logging(app, "gunicorn.error")
+    try:
+        # no database I/O here: the tables are migrated by the gunicorn
+        # master before it forks (see gunicorn.conf.py) or on the first request
+        Product.init_app(app)
+    except Exception as error:
+        app.logger.critical("%s: Cannot continue", error)
+        # gunicorn requires exit code 4 to stop spawning workers when they die
+        sys.exit(4)
 
-app.logger.info(70 * "*")
-app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
+    app.logger.info("Service initialized!")
+    return app
 
-try:
-    routes.init_db()  # make our SQLAlchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
 
-app.logger.info("Service initialized!")
+def __getattr__(name: str):
+    """Creates service.app, the app of the default settings, on first use"""
+    if name == "app":
+        with app_lock:
+            if "app" not in globals():
+                globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,316 @@
+"""
+Async Product API
+
+An ASGI application serving the product routes with asyncio and the asyncpg
+driver, as an alternative to the synchronous Flask app:
+
+  uvicorn service.asgi:app
+  gunicorn -k uvicorn.workers.UvicornWorker service.asgi:app
+
+A worker waits for the database without blocking, so one process serves many
+requests at once instead of one per worker. Requests are checked by the same
+code as the Flask routes (parse_listing, Product.deserialize) and queries are
+built by Product.select_rows, so both apps answer the same requests the same
+way. Listings are read straight from the database, not through the cache.
+
+Only the core routes are served here: listing, retrieving, creating,
+updating and deleting a Product. Streams, bulk requests, ratings, statistics
+and suggestions stay on the Flask app.
+"""
+import json
+import hashlib
+from http import HTTPStatus
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+from starlette.routing import Route
+
+from service import app as flask_app
+from service.models import CHANGE_COUNTER, DataConflictError, DataValidationError, Product, app_state
+from service.routes import CONTENT_TYPE_JSON, page_cursor, parse_listing, prepare_db
+from service.utils import status
+
+PRODUCTS = Product.__table__
+
+# columns the database assigns, never taken from a request
+GENERATED_COLUMNS = ("id", "version")
+
+
+def async_database_uri(uri: str) -> str:
+    """Returns a PostgreSQL URI that connects through the asyncpg driver"""
+    scheme, separator, rest = uri.partition("://")
+    if scheme.split("+")[0] not in ("postgres", "postgresql"):
+        raise ValueError(f"The async app needs a PostgreSQL database, not {scheme}")
+    return "postgresql+asyncpg" + separator + rest
+
+
+async def startup():
+    """Opens the connection pool of this worker"""
+    if not app_state(flask_app).db_ready:
+        await run_in_threadpool(prepare_db, flask_app)
+    config = flask_app.config
+    app.state.engine = create_async_engine(
+        async_database_uri(config["SQLALCHEMY_DATABASE_URI"]),
+        pool_size=config["DB_POOL_SIZE"],
+        max_overflow=config["DB_POOL_MAX_OVERFLOW"],
+        pool_timeout=config["DB_POOL_TIMEOUT"],
+        pool_recycle=config["DB_POOL_RECYCLE"],
+        pool_pre_ping=config["DB_POOL_PRE_PING"],
+    )
+
+
+async def shutdown():
+    """Closes the connection pool of this worker"""
+    await app.state.engine.dispose()
+
+
+######################################################################
+# LIST ALL PRODUCTS
+######################################################################
+async def list_products(request):
+    """
+    Returns one page of the Products matching the query string filters
+
+    Takes the same query parameters as GET /products of the Flask app,
+    except ?stream=1
+    """
+    flask_app.logger.info("Request for Product List")
+    try:
+        listing = parse_listing(request.query_params, stream=False)
+    except ValueError:
+        return Response(status_code=status.HTTP_406_NOT_ACCEPTABLE)
+
+    # fetch one extra row to learn whether there is a next page
+    limit = listing["limit"]
+    with flask_app.app_context():
+        fields, statement = Product.select_rows(**dict(listing, limit=limit + 1))
+    async with app.state.engine.connect() as connection:
+        etag = listing_etag(request, await connection.scalar(CHANGE_COUNTER))
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return not_modified(etag, {"Vary": "Accept"})
+        results = [dict(zip(fields, row)) for row in await connection.execute(statement)]
+
+    # the Flask app streams the same URL when NDJSON is accepted
+    headers = {"ETag": f'"{etag}"', "Vary": "Accept"}
+    if len(results) > limit:
+        results = results[:limit]
+        cursor = page_cursor(results[-1], listing["sort"])
+        next_url = request.url.include_query_params(after=cursor)
+        headers.update({"Link": f'<{next_url}>; rel="next"', "X-Next-Cursor": cursor})
+    flask_app.logger.info("Returning %d products", len(results))
+    return json_response(results, headers=headers)
+
+
+######################################################################
+# RETRIEVE A PRODUCT
+######################################################################
+async def get_product(request):
+    """Retrieve a single Product, or 304_NOT_MODIFIED if If-None-Match names its version"""
+    product_id = request.path_params["product_id"]
+    flask_app.logger.info("Request for product with id: %s", product_id)
+    async with app.state.engine.connect() as connection:
+        product = await find_product(connection, product_id)
+    if etag_matches(request.headers.get("If-None-Match"), product.etag):
+        return not_modified(product.etag)
+    return product_response(product)
+
+
+######################################################################
+# ADD A NEW PRODUCT
+######################################################################
+async def create_product(request):
+    """Creates a Product from the data in the body that is posted"""
+    flask_app.logger.info("Request to create a product")
+    check_content_type(request, CONTENT_TYPE_JSON)
+    product = Product().deserialize(await read_json(request))
+    values = {
+        key: value
+        for key, value in product.to_row().items()
+        if value is not None and key not in GENERATED_COLUMNS
+    }
+    try:
+        async with app.state.engine.begin() as connection:
+            result = await connection.execute(insert(PRODUCTS).values(values).returning(*PRODUCTS.columns))
+            product = Product(**result.mappings().one())
+    except IntegrityError as error:
+        raise product.creation_error(error) from error
+    await run_in_threadpool(Product.invalidate, [product.id])
+
+    flask_app.logger.info("Product with ID [%s] created.", product.id)
+    location_url = request.url_for("get_product", product_id=product.id)
+    return product_response(product, status.HTTP_201_CREATED, {"Location": location_url})
+
+
+######################################################################
+# UPDATE AN EXISTING PRODUCT
+######################################################################
+async def update_product(request):
+    """
+    Update a Product from the body that is posted
+
+    The UPDATE only applies to the version that was read, so a concurrent
+    change is reported with 409_CONFLICT as by the Flask app
+    """
+    product_id = request.path_params["product_id"]
+    flask_app.logger.info("Request to update product with id: %s", product_id)
+    check_content_type(request, CONTENT_TYPE_JSON)
+    data = await read_json(request)
+    try:
+        async with app.state.engine.begin() as connection:
+            product = await find_product(connection, product_id)
+            check_if_match(request, product)
+            version = product.version
+            product.deserialize(data)
+            values = {key: value for key, value in product.to_row().items() if key not in GENERATED_COLUMNS}
+            result = await connection.execute(
+                update(PRODUCTS)
+                .where(PRODUCTS.c.id == product_id, PRODUCTS.c.version == version)
+                .values(version=PRODUCTS.c.version + 1, **values)
+                .returning(*PRODUCTS.columns)
+            )
+            row = result.mappings().first()
+    except IntegrityError as error:
+        raise product.creation_error(error) from error
+    await run_in_threadpool(Product.invalidate, [product_id])
+    if row is None:
+        raise DataConflictError(f"Product with id '{product_id}' was changed by another request")
+
+    flask_app.logger.info("Product with ID [%s] updated.", product_id)
+    return product_response(Product(**row))
+
+
+######################################################################
+# DELETE A PRODUCT
+######################################################################
+async def delete_product(request):
+    """Delete a Product"""
+    product_id = request.path_params["product_id"]
+    flask_app.logger.info("Request to delete product with id: %s", product_id)
+    async with app.state.engine.begin() as connection:
+        await connection.execute(delete(PRODUCTS).where(PRODUCTS.c.id == product_id))
+    await run_in_threadpool(Product.invalidate, [product_id])
+
+    flask_app.logger.info("Product with ID [%s] delete complete.", product_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+async def find_product(connection, product_id: int) -> Product:
+    """Reads a Product, or raises 404_NOT_FOUND"""
+    result = await connection.execute(select(PRODUCTS).where(PRODUCTS.c.id == product_id))
+    row = result.mappings().first()
+    if row is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+    return Product(**row)
+
+
+async def read_json(request):
+    """Returns the JSON body of a request, or raises 400_BAD_REQUEST"""
+    try:
+        return await request.json()
+    except ValueError as error:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "The body is not valid JSON") from error
+
+
+def json_response(content, code: int = status.HTTP_200_OK, headers: dict = None) -> Response:
+    """Encodes content as jsonify does, with the encoder of the Flask app"""
+    body = json.dumps(
+        content,
+        cls=flask_app.json_encoder,
+        sort_keys=flask_app.config["JSON_SORT_KEYS"],
+        separators=(",", ":"),
+    )
+    return Response(body + "\n", code, headers, media_type=CONTENT_TYPE_JSON)
+
+
+def error_response(code: int, message: str) -> Response:
+    """Returns an error in the format of service.utils.error_handlers"""
+    flask_app.logger.warning(message)
+    return json_response({"status": code, "error": HTTPStatus(code).phrase, "message": message}, code)
+
+
+def product_response(product, code: int = status.HTTP_200_OK, headers: dict = None) -> Response:
+    """Returns a Product as JSON, tagged with the ETag of its version"""
+    return json_response(product.serialize(), code, dict(headers or {}, ETag=f'"{product.etag}"'))
+
+
+def listing_etag(request, counter: int) -> str:
+    """Returns the ETag of a listing page: the table change counter, the query and the media type"""
+    key = f"{counter}:page:{CONTENT_TYPE_JSON}:{request.url.path}?{request.url.query}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Returns True if an If-Match or If-None-Match header names etag"""
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/").strip('"') for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def not_modified(etag: str, headers: dict = None) -> Response:
+    """Returns an empty 304_NOT_MODIFIED response for an unchanged resource"""
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=dict(headers or {}, ETag=f'"{etag}"'))
+
+
+def check_if_match(request, product):
+    """Raises 412_PRECONDITION_FAILED if If-Match names another version"""
+    header = request.headers.get("If-Match")
+    if header and not etag_matches(header, product.etag):
+        flask_app.logger.info("Product with ID [%s] has changed.", product.id)
+        raise HTTPException(status.HTTP_412_PRECONDITION_FAILED, f"Product with id '{product.id}' has changed.")
+
+
+def check_content_type(request, *media_types):
+    """Raises 415_UNSUPPORTED_MEDIA_TYPE unless the media type is an accepted one"""
+    content_type = request.headers.get("Content-Type")
+    if content_type and content_type in media_types:
+        return
+    flask_app.logger.error("Invalid Content-Type: %s", content_type)
+    raise HTTPException(
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        "Content-Type must be {}".format(" or ".join(media_types)),
+    )
+
+
+######################################################################
+# Error Handlers
+######################################################################
+async def http_error(request, error: HTTPException) -> Response:
+    """Handles the errors raised by the routes"""
+    return error_response(error.status_code, f"{error.status_code} {HTTPStatus(error.status_code).phrase}: {error.detail}")
+
+
+async def request_validation_error(request, error: DataValidationError) -> Response:
+    """Handles Value Errors from bad data"""
+    return error_response(status.HTTP_400_BAD_REQUEST, str(error))
+
+
+async def request_conflict_error(request, error: DataConflictError) -> Response:
+    """Handles products changed by another request"""
+    return error_response(status.HTTP_409_CONFLICT, str(error))
+
+
+app = Starlette(
+    routes=[
+        Route("/products", list_products, methods=["GET"]),
+        Route("/products", create_product, methods=["POST"]),
+        Route("/products/{product_id:int}", get_product, methods=["GET"]),
+        Route("/products/{product_id:int}", update_product, methods=["PUT"]),
+        Route("/products/{product_id:int}", delete_product, methods=["DELETE"]),
+    ],
+    exception_handlers={
+        HTTPException: http_error,
+        DataValidationError: request_validation_error,
+        DataConflictError: request_conflict_error,
+    },
+    on_startup=[startup],
+    on_shutdown=[shutdown],
+)
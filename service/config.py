@@ -4,6 +4,8 @@ Global Configuration for Application
 import os
 import json
 import logging
+from service.utils.pool import InstrumentedQueuePool
+from service.utils.replicas import replica_binds
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -19,7 +21,70 @@ if 'VCAP_SERVICES' in os.environ:
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-SQLALCHEMY_POOL_SIZE = 2
+
+# Optional read replicas, a comma separated list of database URIs. Read-only
+# requests read from one of them until they write; writes always go to
+# DATABASE_URI (see service.utils.replicas)
+DATABASE_READ_URI = os.getenv("DATABASE_READ_URI", "")
+SQLALCHEMY_BINDS = replica_binds([uri.strip() for uri in DATABASE_READ_URI.split(",") if uri.strip()])
+
+# Connection pool of each worker: DB_POOL_SIZE connections are kept open and
+# up to DB_POOL_MAX_OVERFLOW more are opened under load. A request waits at
+# most DB_POOL_TIMEOUT seconds for one, connections are replaced after
+# DB_POOL_RECYCLE seconds (-1 never) and tested before use with DB_POOL_PRE_PING
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "2"))
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("true", "1", "yes")
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "poolclass": InstrumentedQueuePool,
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_POOL_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+}
+
+# Keyset pagination of the product listing
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Streamed listings (?stream=1) fetch this many rows from the database at a time
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "500"))
+
+# Bulk product creation
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "500"))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "10000"))
+
+# Rating ingestion: "direct" writes every rating as it arrives, "buffered"
+# coalesces them per product and writes them at most RATING_FLUSH_INTERVAL
+# seconds later (or as soon as RATING_BUFFER_MAX ratings are pending)
+RATING_INGESTION = os.getenv("RATING_INGESTION", "direct")
+RATING_FLUSH_INTERVAL = float(os.getenv("RATING_FLUSH_INTERVAL", "1.0"))
+RATING_BUFFER_MAX = int(os.getenv("RATING_BUFFER_MAX", "10000"))
+
+# Read-through cache of products and listings. With CACHE_BACKEND=redis the
+# cache and its invalidation are shared by every worker through CACHE_URL,
+# with "memory" each process caches and invalidates on its own
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() in ("true", "1", "yes")
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "1024"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+
+# Width of the price buckets counted by GET /products/stats
+STATS_PRICE_BUCKET = float(os.getenv("STATS_PRICE_BUCKET", "10"))
+
+# Name completions (GET /products/suggest) are served from an index in each
+# worker, reloaded from the database every SUGGEST_REFRESH_INTERVAL seconds
+SUGGEST_LIMIT = int(os.getenv("SUGGEST_LIMIT", "10"))
+SUGGEST_MAX_LIMIT = int(os.getenv("SUGGEST_MAX_LIMIT", "50"))
+SUGGEST_REFRESH_INTERVAL = float(os.getenv("SUGGEST_REFRESH_INTERVAL", "30"))
+
+# Encoder of JSON responses: "auto" uses orjson when it is installed,
+# "orjson" insists on it and "stdlib" always uses the json module
+JSON_ENCODER = os.getenv("JSON_ENCODER", "auto")
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
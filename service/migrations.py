@@ -0,0 +1,275 @@
+"""
+Schema Migrations
+
+Versioned, forward-only migrations for the product database. Every
+migration is applied once, in order, and recorded in the schema_version
+table, so existing databases pick up new indexes and columns at startup
+without being rebuilt with `flask create-db`.
+
+Migration 1 creates any missing table straight from the models, so a brand
+new database already has the latest schema when the later migrations run.
+Every later migration must therefore be idempotent (IF NOT EXISTS).
+"""
+import logging
+from sqlalchemy import text
+
+logger = logging.getLogger("flask.app")
+
+SCHEMA_VERSION_TABLE = "schema_version"
+
+# The tables created by the migrations rather than from the models, including
+# those of superseded migrations
+MIGRATION_TABLES = ("product_change_slots", "product_changes", "category_summary", SCHEMA_VERSION_TABLE)
+
+# Key of the Postgres advisory lock that serializes concurrent upgrades
+# (e.g. several replicas starting at the same time)
+MIGRATION_LOCK_ID = 72820
+
+
+def _create_tables(connection, metadata):
+    """Creates every table declared on the models that does not exist yet"""
+    metadata.create_all(bind=connection, checkfirst=True)
+
+
+# Recomputes category_summary from the product table. Writes to product are
+# blocked meanwhile, so no change is counted twice or lost.
+REBUILD_CATEGORY_SUMMARY = [
+    "LOCK TABLE product IN SHARE MODE",
+    "DELETE FROM category_summary",
+    "INSERT INTO category_summary "
+    "(category, product_count, available_count, price_sum, rating_sum, rated_count) "
+    "SELECT category, count(*), count(*) FILTER (WHERE available), "
+    "coalesce(sum(price::numeric), 0), coalesce(sum(rating::numeric), 0), count(rating) "
+    "FROM product GROUP BY category",
+]
+
+
+def _summary_delta(rows: str, sign: str) -> str:
+    """Returns the upsert adding (sign +) or removing (sign -) a transition table"""
+    return (
+        "INSERT INTO category_summary AS summary "
+        "(category, product_count, available_count, price_sum, rating_sum, rated_count) "
+        f"SELECT category, {sign}count(*), {sign}count(*) FILTER (WHERE available), "
+        f"{sign}coalesce(sum(price::numeric), 0), {sign}coalesce(sum(rating::numeric), 0), "
+        f"{sign}count(rating) FROM {rows} GROUP BY category ORDER BY category "
+        "ON CONFLICT (category) DO UPDATE SET "
+        "product_count = summary.product_count + excluded.product_count, "
+        "available_count = summary.available_count + excluded.available_count, "
+        "price_sum = summary.price_sum + excluded.price_sum, "
+        "rating_sum = summary.rating_sum + excluded.rating_sum, "
+        "rated_count = summary.rated_count + excluded.rated_count;"
+    )
+
+
+# The change counter is spread over this many rows, one per database backend
+# (modulo), so concurrent write transactions do not queue on one counter row
+CHANGE_COUNTER_SLOTS = 256
+
+# (version, description, callable or list of SQL statements)
+MIGRATIONS = [
+    (1, "create product tables", _create_tables),
+    (
+        2,
+        "index the product query columns",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_product_category ON product (category)",
+            "CREATE INDEX IF NOT EXISTS ix_product_price ON product (price)",
+            "CREATE INDEX IF NOT EXISTS ix_product_rating ON product (rating)",
+            "CREATE INDEX IF NOT EXISTS ix_product_available_category_price "
+            "ON product (category, price) WHERE available",
+        ],
+    ),
+    (
+        3,
+        "store the sum of all ratings",
+        [
+            "ALTER TABLE product ADD COLUMN IF NOT EXISTS "
+            "rating_sum DOUBLE PRECISION NOT NULL DEFAULT 0",
+            "UPDATE product SET rating_sum = rating * no_of_users_rated "
+            "WHERE rating IS NOT NULL",
+        ],
+    ),
+    (
+        4,
+        "version products and count changes to the product table",
+        [
+            "ALTER TABLE product ADD COLUMN IF NOT EXISTS "
+            "version INTEGER NOT NULL DEFAULT 1",
+            "CREATE TABLE IF NOT EXISTS product_changes ("
+            "id INTEGER PRIMARY KEY CHECK (id = 1), "
+            "counter BIGINT NOT NULL DEFAULT 0)",
+            "INSERT INTO product_changes (id, counter) VALUES (1, 0) "
+            "ON CONFLICT (id) DO NOTHING",
+            "CREATE OR REPLACE FUNCTION count_product_changes() RETURNS trigger AS $$ "
+            "BEGIN UPDATE product_changes SET counter = counter + 1 WHERE id = 1; "
+            "RETURN NULL; END; $$ LANGUAGE plpgsql",
+            "DROP TRIGGER IF EXISTS product_changes_counter ON product",
+            "CREATE TRIGGER product_changes_counter "
+            "AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON product "
+            "FOR EACH STATEMENT EXECUTE PROCEDURE count_product_changes()",
+        ],
+    ),
+    (
+        5,
+        "index the sort orders of the product listing",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_product_name_id ON product (name, id)",
+            "CREATE INDEX IF NOT EXISTS ix_product_price_id ON product (price, id)",
+            "CREATE INDEX IF NOT EXISTS ix_product_rating_id ON product (rating, id)",
+            "CREATE INDEX IF NOT EXISTS ix_product_rating_desc_id "
+            "ON product (rating DESC NULLS LAST, id DESC)",
+            "CREATE INDEX IF NOT EXISTS ix_product_category_price_id "
+            "ON product (category, price, id)",
+            "CREATE INDEX IF NOT EXISTS ix_product_category_rating_desc_id "
+            "ON product (category, rating DESC NULLS LAST, id DESC)",
+        ],
+    ),
+    (
+        6,
+        "index the name and description for full-text search",
+        [
+            "ALTER TABLE product ADD COLUMN IF NOT EXISTS search tsvector "
+            "GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(description, '')), 'B')) STORED",
+            "CREATE INDEX IF NOT EXISTS ix_product_search ON product USING GIN (search)",
+        ],
+    ),
+    (
+        7,
+        "summarize products per category",
+        [
+            "CREATE TABLE IF NOT EXISTS category_summary ("
+            "category VARCHAR(63) PRIMARY KEY, "
+            "product_count BIGINT NOT NULL DEFAULT 0, "
+            "available_count BIGINT NOT NULL DEFAULT 0, "
+            "price_sum NUMERIC NOT NULL DEFAULT 0, "
+            "rating_sum NUMERIC NOT NULL DEFAULT 0, "
+            "rated_count BIGINT NOT NULL DEFAULT 0)",
+            # one statement-level trigger per event: only those can see the
+            # changed rows as transition tables, and update a category once
+            "CREATE OR REPLACE FUNCTION summarize_product_changes() RETURNS trigger AS $$ "
+            "BEGIN "
+            "IF TG_OP IN ('UPDATE', 'DELETE') THEN " + _summary_delta("old_rows", "-") + " END IF; "
+            "IF TG_OP IN ('INSERT', 'UPDATE') THEN " + _summary_delta("new_rows", "") + " END IF; "
+            "DELETE FROM category_summary WHERE product_count = 0; "
+            "RETURN NULL; END; $$ LANGUAGE plpgsql",
+            "CREATE OR REPLACE FUNCTION clear_category_summary() RETURNS trigger AS $$ "
+            "BEGIN DELETE FROM category_summary; RETURN NULL; END; $$ LANGUAGE plpgsql",
+            "DROP TRIGGER IF EXISTS category_summary_insert ON product",
+            "CREATE TRIGGER category_summary_insert AFTER INSERT ON product "
+            "REFERENCING NEW TABLE AS new_rows "
+            "FOR EACH STATEMENT EXECUTE PROCEDURE summarize_product_changes()",
+            "DROP TRIGGER IF EXISTS category_summary_update ON product",
+            "CREATE TRIGGER category_summary_update AFTER UPDATE ON product "
+            "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows "
+            "FOR EACH STATEMENT EXECUTE PROCEDURE summarize_product_changes()",
+            "DROP TRIGGER IF EXISTS category_summary_delete ON product",
+            "CREATE TRIGGER category_summary_delete AFTER DELETE ON product "
+            "REFERENCING OLD TABLE AS old_rows "
+            "FOR EACH STATEMENT EXECUTE PROCEDURE summarize_product_changes()",
+            "DROP TRIGGER IF EXISTS category_summary_truncate ON product",
+            "CREATE TRIGGER category_summary_truncate AFTER TRUNCATE ON product "
+            "FOR EACH STATEMENT EXECUTE PROCEDURE clear_category_summary()",
+        ]
+        + REBUILD_CATEGORY_SUMMARY,
+    ),
+    (
+        8,
+        "count changes to the product table in one row per backend",
+        [
+            "CREATE TABLE IF NOT EXISTS product_change_slots ("
+            "slot INTEGER PRIMARY KEY, "
+            "counter BIGINT NOT NULL DEFAULT 0)",
+            # carry on from the single-row counter of migration 4
+            "INSERT INTO product_change_slots (slot, counter) "
+            "SELECT 0, counter FROM product_changes ON CONFLICT (slot) DO NOTHING",
+            "DROP TRIGGER IF EXISTS product_changes_counter ON product",
+            "DROP FUNCTION IF EXISTS count_product_changes()",
+            "DROP TABLE IF EXISTS product_changes",
+            "CREATE OR REPLACE FUNCTION bump_product_changes() RETURNS trigger AS $$ "
+            "BEGIN INSERT INTO product_change_slots AS slots (slot, counter) "
+            f"VALUES (pg_backend_pid() % {CHANGE_COUNTER_SLOTS}, 1) "
+            "ON CONFLICT (slot) DO UPDATE SET counter = slots.counter + 1; "
+            "RETURN NULL; END; $$ LANGUAGE plpgsql",
+            # triggers fire in name order: this one comes before the
+            # category_summary ones, so a writer takes its counter row before
+            # any summary row and two writers sharing a slot cannot deadlock
+            "DROP TRIGGER IF EXISTS bump_product_changes ON product",
+            "CREATE TRIGGER bump_product_changes "
+            "AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON product "
+            "FOR EACH STATEMENT EXECUTE PROCEDURE bump_product_changes()",
+        ],
+    ),
+]
+
+
+def current_version(connection) -> int:
+    """Returns the highest migration version applied to the database"""
+    result = connection.execute(text(f"SELECT MAX(version) FROM {SCHEMA_VERSION_TABLE}"))
+    return result.scalar() or 0
+
+
+def upgrade(engine, metadata) -> list:
+    """Applies all pending migrations in a single transaction
+
+    :param engine: the engine of the database to migrate
+    :type engine: Engine
+    :param metadata: the metadata holding the model tables
+    :type metadata: MetaData
+
+    :return: the versions that were applied
+    :rtype: list
+
+    """
+    applied = []
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(
+                text("SELECT pg_advisory_xact_lock(:lock_id)"),
+                {"lock_id": MIGRATION_LOCK_ID},
+            )
+        connection.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} ("
+                "version INTEGER PRIMARY KEY, "
+                "description VARCHAR(255) NOT NULL, "
+                "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+            )
+        )
+        version = current_version(connection)
+        for number, description, steps in MIGRATIONS:
+            if number <= version:
+                continue
+            logger.info("Applying migration %d: %s", number, description)
+            if callable(steps):
+                steps(connection, metadata)
+            else:
+                for statement in steps:
+                    connection.execute(text(statement))
+            connection.execute(
+                text(
+                    f"INSERT INTO {SCHEMA_VERSION_TABLE} (version, description) "
+                    "VALUES (:version, :description)"
+                ),
+                {"version": number, "description": description},
+            )
+            applied.append(number)
+    return applied
+
+
+def rebuild_category_summary(connection):
+    """Recomputes the category summary from scratch, in the caller's transaction"""
+    for statement in REBUILD_CATEGORY_SUMMARY:
+        connection.execute(text(statement))
+
+
+def drop_migration_tables(engine):
+    """Drops the tables made by the migrations and forgets every applied migration
+
+    Used when the model tables are rebuilt, so that the change counter and
+    the category summary start over with them.
+    """
+    with engine.begin() as connection:
+        for table in MIGRATION_TABLES:
+            connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
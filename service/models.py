@@ -4,11 +4,25 @@ Models for Product
 All of the models are stored in this module
 """
 # from email.policy import default
+import os
+import re
 import logging
+import threading
 
 # from wsgiref import validate
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, current_app
+from sqlalchemy import Float, Integer, and_, asc, case, cast, column, desc, func, inspect, literal, literal_column, or_
+from sqlalchemy import select, text, tuple_, update, values
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm.util import identity_key
+from werkzeug.local import LocalProxy
+from service import migrations
+from service.utils.cache import LRUCache, VersionedCache, create_cache_backend
+from service.utils.prefix_index import PrefixIndex
+from service.utils.rating_buffer import RatingBuffer
+from service.utils.replicas import READ_ONLY, REPLICA_PREFIX, RoutingSQLAlchemy
 
 # from tomlkit import boolean
 # from sqlalchemy import null
@@ -18,11 +32,69 @@ MIN_PRICE = 10.00
 MAX_PRICE = 100.00
 MIN_RATE = 0
 MAX_RATE = 5
+MAX_NAME_LENGTH = 63
 MAX_DESCRIPTION_LENGTH = 63
+MAX_CATEGORY_LENGTH = 63
+DEFAULT_DESCRIPTION = "unavailable"
+REQUIRED_FIELDS = ("name", "category", "price")
+BULK_UPDATE_FIELDS = ("description", "category", "price", "available")
+SERIALIZED_FIELDS = (
+    "id", "name", "description", "category", "price", "available", "rating", "no_of_users_rated",
+)
+SORT_FIELDS = ("id", "name", "price", "rating", "rank")
+
+# Full-text search runs on the "search" tsvector column and its GIN index,
+# added by migration 6 and deliberately not declared on the model. Words are
+# indexed as written (the "simple" configuration) so that prefixes typed by
+# users match. Other databases fall back to LIKE with the same weights.
+SEARCH_CONFIG = "simple"
+SEARCH_VECTOR = literal_column("product.search", type_=TSVECTOR)
+SEARCH_WEIGHTS = (("name", 1.0), ("description", 0.4))
+
+# The table-level change counter, see Product.change_counter
+CHANGE_COUNTER = text("SELECT coalesce(sum(counter), 0)::bigint FROM product_change_slots")
+
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+
+class AppState:  # pylint: disable=too-few-public-methods
+    """The caches and buffers of one app, kept in app.extensions["products"]
+
+    Each app created by service.create_app() has its own, so creating a
+    second app (e.g. in a test) does not take over the state of the first.
+    """
+
+    def __init__(self, app: Flask):
+        # Read-through cache of product rows and listing pages
+        self.cache = VersionedCache()
+        # Product names for completions, kept up to date by the Product write methods
+        self.suggestions = PrefixIndex()
+        # Ratings waiting to be written with RATING_INGESTION=buffered
+        self.rating_buffer = RatingBuffer(lambda ratings: write_ratings(app, ratings))
+        # set once the tables are migrated, see Product.prepare_db
+        self.db_ready = False
+        # Serializes Product.ensure_db between the threads of a worker
+        self.prepare_lock = threading.Lock()
+
+
+def app_state(app: Flask = None) -> AppState:
+    """Returns the state of an app, by default of the current one"""
+    return (app or current_app).extensions["products"]
+
+
+def write_ratings(app: Flask, ratings: dict):
+    """Writes the ratings coalesced by the rating buffer of an app"""
+    with app.app_context():
+        Product.add_ratings(ratings)
+
+
+# The state of the current app, see AppState
+cache = LocalProxy(lambda: app_state().cache)
+suggestions = LocalProxy(lambda: app_state().suggestions)
+rating_buffer = LocalProxy(lambda: app_state().rating_buffer)
 
 
 # def init_db(app):
@@ -43,6 +115,73 @@ class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
 
+class DataConflictError(Exception):
+    """Used when a product was changed by someone else since it was read"""
+
+
+# Predicates understood by Product.find_by_criteria, keyed by criterion name.
+# Each one maps a (class, value) pair onto a SQL expression so that any
+# combination of them can be AND-ed into a single statement.
+FILTERS = {
+    "ids": lambda cls, value: cls.id.in_(value),
+    "name": lambda cls, value: cls.name == value,
+    "category": lambda cls, value: cls.category == value,
+    "price": lambda cls, value: cls.price <= value,
+    "rating": lambda cls, value: cls.rating >= value,
+    "available": lambda cls, value: cls.available == value,
+    "q": lambda cls, value: cls.search_clause(value),
+    "q_prefix": lambda cls, value: cls.search_clause(value, prefix=True),
+}
+
+
+def fold_stats(rows, bucket_size: float) -> dict:
+    """Folds the groups counted by Product.stats into its facets
+
+    Each row is (category, available, price bucket, count, min price,
+    max price, price sum, rating sum, number of ratings)
+    """
+    categories = {}
+    available = {"true": 0, "false": 0}
+    buckets = {}
+    total = 0
+    for category, is_available, bucket, count, low, high, price_sum, rating_sum, rated in rows:
+        total += count
+        available["true" if is_available else "false"] += count
+        buckets[bucket] = buckets.get(bucket, 0) + count
+        facet = categories.setdefault(
+            category,
+            {"count": 0, "available": 0, "min_price": low, "max_price": high, "price_sum": 0.0,
+             "rating_sum": 0.0, "rated": 0},
+        )
+        facet["count"] += count
+        facet["available"] += count if is_available else 0
+        facet["min_price"] = min(facet["min_price"], low)
+        facet["max_price"] = max(facet["max_price"], high)
+        facet["price_sum"] += price_sum
+        facet["rating_sum"] += rating_sum or 0.0
+        facet["rated"] += rated
+    for facet in categories.values():
+        facet["avg_price"] = facet.pop("price_sum") / facet["count"]
+        rating_sum, rated = facet.pop("rating_sum"), facet.pop("rated")
+        facet["avg_rating"] = rating_sum / rated if rated else None
+    return {
+        "total": total,
+        "categories": categories,
+        "available": available,
+        "price_buckets": [
+            {"min": bucket * bucket_size, "max": (bucket + 1) * bucket_size, "count": count}
+            for bucket, count in sorted(buckets.items())
+        ],
+    }
+
+
+def pool_state(pool) -> dict:
+    """Returns the state of a connection pool, with its counters if it keeps any"""
+    if hasattr(pool, "stats"):
+        return pool.stats()
+    return {"pid": os.getpid(), "status": pool.status()}
+
+
 class Product(db.Model):
     """
     Class that represents a product
@@ -50,17 +189,34 @@ class Product(db.Model):
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(63), nullable=False, unique=True)
+    name = db.Column(db.String(MAX_NAME_LENGTH), nullable=False, unique=True)
     description = db.Column(
         db.String(MAX_DESCRIPTION_LENGTH),
         nullable=False,
-        server_default=("unavailable"),
+        server_default=(DEFAULT_DESCRIPTION),
     )
-    category = db.Column(db.String(63), nullable=False)
-    price = db.Column(db.Float(), nullable=False)
+    category = db.Column(db.String(MAX_CATEGORY_LENGTH), nullable=False, index=True)
+    price = db.Column(db.Float(), nullable=False, index=True)
     available = db.Column(db.Boolean(), nullable=False, default=False)
-    rating = db.Column(db.Float, nullable=True)
+    rating = db.Column(db.Float, nullable=True, index=True)
     no_of_users_rated = db.Column(db.Integer, nullable=False, default=0)
+    # sum of every rating received, rating is always rating_sum / no_of_users_rated
+    rating_sum = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    # incremented on every change, used for ETags and optimistic concurrency
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
+    # Existing databases get these through service.migrations
+    __table_args__ = (
+        db.Index(
+            "ix_product_available_category_price",
+            "category",
+            "price",
+            postgresql_where=available.is_(True),
+            sqlite_where=available.is_(True),
+        ),
+    )
 
     def __repr__(self):
         return "<Product %r id=[%s]>" % (self.name, self.id)
@@ -76,28 +232,80 @@ class Product(db.Model):
             db.session.commit()
         except Exception as error:
             db.session.rollback()
-            # raise DataValidationError(error.args[0])
-            if "UniqueViolation" in error.args[0]:
-                raise DataValidationError(f"Error: name {self.name} already exists!")
-            elif "NotNullViolation" in error.args[0]:
-                raise DataValidationError(f"Error: Some none-null vaiable not provided. {error.args[0]}")
-            else:
-                raise DataValidationError("Error: Something happened when creating new product.")
+            raise self.creation_error(error)
+        self.invalidate([self.id])
+        suggestions.add(self.id, self.name, self.rating)
+
+    def creation_error(self, error: Exception) -> DataValidationError:
+        """Explains why the database refused to create or save this Product"""
+        # psycopg2 and asyncpg both name the violated constraint in the message
+        if "UniqueViolation" in error.args[0]:
+            return DataValidationError(f"Error: name {self.name} already exists!")
+        if "NotNullViolation" in error.args[0]:
+            return DataValidationError(f"Error: Some none-null vaiable not provided. {error.args[0]}")
+        return DataValidationError("Error: Something happened when creating new product.")
 
     def update(self):
         """
         Updates a Product to the database
+
+        Raises DataConflictError if the Product was changed since it was read
         """
         logger.info("Saving %s", self.name)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
+        product_id, name, rating = self.id, self.name, self.rating
+        self.commit_or_conflict()
+        self.invalidate([product_id])
+        suggestions.add(product_id, name, rating)
 
     def delete(self):
         """Removes a product from the data store"""
         logger.info("Deleting %s", self.name)
+        product_id = self.id
         db.session.delete(self)
-        db.session.commit()
+        self.commit_or_conflict()
+        self.invalidate([product_id])
+        suggestions.remove(product_id)
+
+    def commit_or_conflict(self):
+        """Commits the session, turning a version mismatch into DataConflictError"""
+        try:
+            db.session.commit()
+        except StaleDataError as error:
+            db.session.rollback()
+            self.invalidate([self.id])
+            raise DataConflictError(
+                f"Product with id '{self.id}' was changed by another request"
+            ) from error
+
+    @property
+    def etag(self) -> str:
+        """Returns the strong entity tag of this version of the Product"""
+        return f"{self.id}-{self.version}"
+
+    def to_row(self) -> dict:
+        """Returns every column of a product, as held in the cache"""
+        return {column.key: getattr(self, column.key) for column in self.__table__.columns}
+
+    def check_required(self):
+        """Raises a DataValidationError if a non-null field has no value"""
+        missing = [field for field in REQUIRED_FIELDS if getattr(self, field) is None]
+        if missing:
+            raise DataValidationError(
+                "Invalid Product: missing required field(s) " + ", ".join(missing)
+            )
+
+    def check_lengths(self):
+        """Raises DataValidationError if a text field is longer than its column"""
+        for field, max_length in (
+            ("name", MAX_NAME_LENGTH),
+            ("description", MAX_DESCRIPTION_LENGTH),
+            ("category", MAX_CATEGORY_LENGTH),
+        ):
+            value = getattr(self, field)
+            if value is not None and len(value) > max_length:
+                raise DataValidationError(f"Invalid length for [{field}]")
 
     def serialize(self) -> dict:
         """Serializes a product into a dictionary"""
@@ -136,6 +344,7 @@ class Product(db.Model):
             if isinstance(rating, float):
                 if rating >= MIN_RATE and rating <= MAX_RATE:
                     self.rating = rating
+                    self.sync_rating_sum()
                 else:
                     raise DataValidationError(
                         "Invalid range for [rating]: " + str(rating)
@@ -146,11 +355,13 @@ class Product(db.Model):
                 )
         else:
             self.rating = None
+            self.sync_rating_sum()
 
     def check_no_of_users_rated(self, no_of_users_rated):
         if isinstance(no_of_users_rated, int):
             if no_of_users_rated >= 0:
                 self.no_of_users_rated = no_of_users_rated
+                self.sync_rating_sum()
             else:
                 raise DataValidationError(
                     "Invalid Range for [no_of_users_rated]: "
@@ -162,6 +373,10 @@ class Product(db.Model):
                 + str(type(no_of_users_rated))
             )
 
+    def sync_rating_sum(self):
+        """Keeps rating_sum in line with a rating or count set directly"""
+        self.rating_sum = (self.rating or 0) * (self.no_of_users_rated or 0)
+
     def check_name(self, name):
         if not isinstance(name, str):
             raise TypeError
@@ -214,18 +429,288 @@ class Product(db.Model):
     ##################################################
     @classmethod
     def init_db(cls, app: Flask):
-        """Initializes the database session
+        """Initializes the database session and brings the database up to date
+
+        :param app: the Flask app
+        :type data: Flask
+
+        """
+        cls.init_app(app)
+        cls.prepare_db()
+
+    @classmethod
+    def init_app(cls, app: Flask):
+        """Initializes the database session without connecting to the database
+
+        The engine and its connection pool are created on first use, so every
+        process forked after this call opens its own connections.
 
         :param app: the Flask app
         :type data: Flask
 
         """
         logger.info("Initializing database")
-        cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        state = app.extensions.get("products")
+        if state is None:
+            state = app.extensions["products"] = AppState(app)
+        ttl = app.config.get("CACHE_TTL", 30.0)
+        state.cache.configure(
+            LRUCache(app.config.get("CACHE_MAX_SIZE", 1024), ttl),
+            create_cache_backend(app.config, ttl),
+            app.config.get("CACHE_ENABLED", True),
+        )
+        state.suggestions.configure(app.config.get("SUGGEST_REFRESH_INTERVAL", 30.0))
+        state.rating_buffer.configure(
+            app.config.get("RATING_FLUSH_INTERVAL", 1.0), app.config.get("RATING_BUFFER_MAX", 10000)
+        )
+
+    @classmethod
+    def prepare_db(cls):
+        """Migrates the tables and loads the name completions
+
+        Under gunicorn this runs once, in the master before it forks the
+        workers, which inherit the loaded index; otherwise see ensure_db.
+        """
+        logger.info("Preparing database")
+        migrations.upgrade(db.engine, db.metadata)  # make and migrate our tables
+        cls.load_suggestions()
+        db.session.remove()  # do not hold a pooled connection until the first request
+        app_state().db_ready = True
+
+    @classmethod
+    def ensure_db(cls):
+        """Prepares the database unless this process, or the one it was forked from, did"""
+        state = app_state()
+        if state.db_ready:
+            return
+        with state.prepare_lock:
+            if not state.db_ready:
+                cls.prepare_db()
+
+    @classmethod
+    def create_many(cls, products: list, batch_size: int = 500) -> dict:
+        """Creates Products with batched multi-row INSERTs in one transaction
+
+        Products whose name already exists are skipped instead of failing
+        the whole transaction.
+
+        :param products: validated Products that have not been created yet
+        :type products: list
+        :param batch_size: the number of rows sent in each INSERT statement
+        :type batch_size: int
+
+        :return: the id of every created Product, keyed by its name
+        :rtype: dict
+
+        """
+        logger.info("Creating %d products in batches of %d", len(products), batch_size)
+        rows = [
+            {
+                "name": product.name,
+                "description": product.description or DEFAULT_DESCRIPTION,
+                "category": product.category,
+                "price": product.price,
+                "available": bool(product.available),
+                "rating": product.rating,
+                "no_of_users_rated": product.no_of_users_rated or 0,
+                "rating_sum": (product.rating or 0) * (product.no_of_users_rated or 0),
+                "version": 1,
+            }
+            for product in products
+        ]
+        created = {}
+        try:
+            for start in range(0, len(rows), batch_size):
+                statement = (
+                    insert(cls.__table__)
+                    .values(rows[start:start + batch_size])
+                    .on_conflict_do_nothing(index_elements=["name"])
+                    .returning(cls.id, cls.name)
+                )
+                for product_id, name in db.session.execute(statement):
+                    created[name] = product_id
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls.invalidate(list(created.values()))
+        for product in products:
+            if product.name in created:
+                suggestions.add(created[product.name], product.name, product.rating)
+        return created
+
+    @classmethod
+    def update_many(cls, criteria: dict, changes: dict) -> int:
+        """Applies the same changes to every matching Product in one UPDATE
+
+        :param criteria: criterion name to value, see FILTERS; must not be empty
+        :type criteria: dict
+        :param changes: new values for some of the BULK_UPDATE_FIELDS
+        :type changes: dict
+
+        :return: the number of Products updated
+        :rtype: int
+
+        """
+        clauses = cls.filter_clauses(criteria)
+        if not clauses:
+            raise DataValidationError("Bulk update called without any criteria")
+        unknown = set(changes) - set(BULK_UPDATE_FIELDS)
+        if not changes or unknown:
+            raise DataValidationError(
+                "Bulk update can only change " + ", ".join(BULK_UPDATE_FIELDS)
+            )
+        cls().deserialize(changes)  # same type and range checks as one Product
+        if len(changes.get("category", "")) > MAX_CATEGORY_LENGTH:
+            raise DataValidationError("Invalid length for [category]")
+        if len(changes.get("description", "")) > MAX_DESCRIPTION_LENGTH:
+            raise DataValidationError("Invalid length for [description]")
+        logger.info("Updating %s for products matching %s", changes, criteria)
+        try:
+            count = cls.query.filter(*clauses).update(
+                dict(changes, version=cls.version + 1), synchronize_session=False
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls.invalidate()
+        return count
+
+    @classmethod
+    def delete_many(cls, criteria: dict) -> int:
+        """Removes every matching Product in one DELETE
+
+        :param criteria: criterion name to value, see FILTERS; must not be empty
+        :type criteria: dict
+
+        :return: the number of Products deleted
+        :rtype: int
+
+        """
+        clauses = cls.filter_clauses(criteria)
+        if not clauses:
+            raise DataValidationError("Bulk delete called without any criteria")
+        logger.info("Deleting products matching %s", criteria)
+        try:
+            count = cls.query.filter(*clauses).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls.invalidate()
+        suggestions.expire()
+        return count
+
+    @classmethod
+    def rating_changes(cls, total, count) -> dict:
+        """Returns the SET clause that adds `count` ratings summing to `total`
+
+        The database computes the new average from the stored sum and count,
+        so concurrent ratings never overwrite each other. A Product whose
+        rating was cleared starts over from the new ratings.
+
+        :param total: the sum of the new ratings (value or SQL expression)
+        :param count: the number of new ratings (value or SQL expression)
+
+        :return: column to new value expression
+        :rtype: dict
+
+        """
+        total = cast(total, db.Float)
+        reset = or_(cls.rating.is_(None), cls.no_of_users_rated == 0)
+        return {
+            cls.rating_sum: case((reset, total), else_=cls.rating_sum + total),
+            cls.no_of_users_rated: case(
+                (reset, count), else_=cls.no_of_users_rated + count
+            ),
+            cls.rating: case(
+                (reset, total / count),
+                else_=(cls.rating_sum + total) / (cls.no_of_users_rated + count),
+            ),
+            cls.version: cls.version + 1,
+        }
+
+    @classmethod
+    def add_rating(cls, product_id: int, rating: int, version: int = None):
+        """Adds one user rating to a Product with a single atomic UPDATE
+
+        :param product_id: the id of the Product being rated
+        :type product_id: int
+        :param rating: the rating given by the user
+        :type rating: int
+        :param version: only rate the Product if it is still at this version
+        :type version: int
+
+        :return: the updated Product, or None if it was not found (at that version)
+        :rtype: Product
+
+        """
+        logger.info("Adding rating %s to product %s", rating, product_id)
+        statement = (
+            update(cls)
+            .where(cls.id == product_id)
+            .values(cls.rating_changes(rating, 1))
+            .returning(*cls.__table__.columns)
+        )
+        if version is not None:
+            statement = statement.where(cls.version == version)
+        try:
+            product = (
+                db.session.execute(
+                    select(cls)
+                    .from_statement(statement)
+                    .execution_options(populate_existing=True)
+                )
+                .scalars()
+                .first()
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls.invalidate([product_id])
+        if product:
+            suggestions.add(product.id, product.name, product.rating)
+        return product
+
+    @classmethod
+    def add_ratings(cls, ratings: dict) -> int:
+        """Adds coalesced ratings to many Products with a single UPDATE
+
+        :param ratings: product id to a (sum of ratings, number of ratings) pair
+        :type ratings: dict
+
+        :return: the number of Products updated
+        :rtype: int
+
+        """
+        logger.info("Adding ratings to %d products", len(ratings))
+        deltas = values(
+            column("id", Integer),
+            column("total", Float),
+            column("count", Integer),
+            name="deltas",
+        ).data([(product_id, float(total), count) for product_id, (total, count) in ratings.items()])
+        statement = (
+            update(cls)
+            .where(cls.id == deltas.c.id)
+            .values(cls.rating_changes(deltas.c.total, deltas.c.count))
+            .returning(cls.id, cls.name, cls.rating)
+            .execution_options(synchronize_session=False)
+        )
+        try:
+            rows = db.session.execute(statement).all()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls.invalidate(list(ratings))
+        for product_id, name, rating in rows:
+            suggestions.add(product_id, name, rating)
+        return len(rows)
 
     @classmethod
     def all(cls):
@@ -233,10 +718,41 @@ class Product(db.Model):
         logger.info("Processing all products")
         return cls.query.all()
 
+    @classmethod
+    def change_counter(cls) -> int:
+        """Returns the table-level counter bumped by every change to products
+
+        The counter is maintained by a trigger (see service.migrations), so it
+        also covers bulk statements. Each database backend counts in its own
+        row and the counter is their sum: it changes with every committed
+        write, in the same snapshot as the write, without making concurrent
+        writers wait for one another.
+        """
+        return db.session.execute(CHANGE_COUNTER).scalar()
+
+    @classmethod
+    def invalidate(cls, product_ids: list = None):
+        """Makes cached Products and every cached listing stale after a write
+
+        The cache versions its keys by scope: "products" covers everything,
+        "listings" every listing page and "product:<id>" one Product.
+
+        :param product_ids: the ids of the Products written, None if unknown
+        :type product_ids: list
+
+        """
+        if product_ids is None:
+            cache.invalidate("products")
+            return
+        cache.invalidate("listings", *[f"product:{product_id}" for product_id in product_ids])
+
     @classmethod
     def find(cls, product_id: int):
         """Find a Product by it's id
 
+        Products are read through the cache; a cached Product is attached to
+        the session without a query. Use find_for_update to change a Product.
+
         :param product_id: the id of the Product to find
         :type product_id: int
 
@@ -245,7 +761,279 @@ class Product(db.Model):
 
         """
         logger.info("Processing lookup for id %s ...", product_id)
-        return cls.query.get(product_id)
+        product = db.session.identity_map.get(identity_key(cls, product_id))
+        if product is not None and not inspect(product).expired:
+            return product
+        loaded = []
+
+        def load():
+            # from the primary: it is cached under the versions the last write
+            # set, and a lagging replica may not have that write yet
+            loaded.append(cls.query.execution_options(primary=True).get(product_id))
+            return loaded[0].to_row() if loaded[0] is not None else None
+
+        row = cache.get_or_load(
+            f"product:{product_id}", ["products", f"product:{product_id}"], load
+        )
+        if loaded or row is None:
+            return loaded[0] if loaded else None
+        product = cls(**row)
+        make_transient_to_detached(product)
+        return db.session.merge(product, load=False)
+
+    @classmethod
+    def find_for_update(cls, product_id: int):
+        """Find a Product by it's id in the database, bypassing the cache
+
+        Writes check the version of the Product they change, and a cached
+        Product may be older than the row when another process wrote it.
+
+        :param product_id: the id of the Product to find
+        :type product_id: int
+
+        :return: an instance with the product_id, or None if not found
+        :rtype: Product
+
+        """
+        logger.info("Processing lookup for update of id %s ...", product_id)
+        return cls.query.populate_existing().get(product_id)
+
+    @classmethod
+    def select_rows(cls, criteria: dict, fields: tuple = None, after=None, limit: int = None, sort: str = "id"):
+        """Builds a query for some columns of the matching Products
+
+        The rows it returns are plain tuples: no Product is constructed and
+        nothing enters the identity map, which is what makes listings cheap.
+
+        :param criteria: criterion name to value, see FILTERS
+        :type criteria: dict
+        :param fields: the serialized fields to select, all of them if None;
+            the id is always selected first, followed by the sort field
+        :type fields: tuple
+        :param after: only return Products after this position, see paginate
+        :type after: int or tuple
+        :param limit: the maximum number of Products to return
+        :type limit: int
+        :param sort: the field to order by, see paginate
+        :type sort: str
+
+        :return: the selected field names and the statement
+        :rtype: tuple
+
+        """
+        fields = cls.check_fields(fields, sort.lstrip("-"))
+        statement = select(*[cls.sort_expression(field, criteria).label(field) for field in fields])
+        statement = statement.where(*cls.filter_clauses(criteria))
+        return fields, cls.paginate(statement, after, limit, sort, criteria)
+
+    @staticmethod
+    def check_fields(fields: tuple = None, sort_field: str = "id") -> tuple:
+        """Validates a field projection and puts the id and the sort field first"""
+        fields = tuple(fields or SERIALIZED_FIELDS)
+        unknown = [field for field in fields if field not in SERIALIZED_FIELDS]
+        if unknown:
+            raise DataValidationError("Invalid field(s) " + ", ".join(unknown))
+        return tuple(dict.fromkeys(("id", sort_field) + fields))
+
+    @classmethod
+    def list_serialized(
+        cls, criteria: dict, after=None, limit: int = None, fields: tuple = None, sort: str = "id",
+        counter: int = None,
+    ) -> list:
+        """Returns one page of matching Products, serialized, through the cache
+
+        With the change counter the page was asked at, the cache only answers
+        with a page read at that counter, so it agrees with an ETag built from it.
+
+        :param criteria: criterion name to value, see FILTERS
+        :type criteria: dict
+        :param after: only return Products after this position, see paginate
+        :type after: int or tuple
+        :param limit: the maximum number of Products to return
+        :type limit: int
+        :param fields: the fields to return, see select_rows
+        :type fields: tuple
+        :param sort: the field to order by, see paginate
+        :type sort: str
+        :param counter: the change counter, see change_counter
+        :type counter: int
+
+        :return: the serialized Products
+        :rtype: list
+
+        """
+        fields, statement = cls.select_rows(criteria, fields, after, limit, sort)
+        key = f"list:{counter}:{sorted(criteria.items())!r}:{after!r}:{limit}:{','.join(fields)}:{sort}"
+        return cache.get_or_load(
+            key,
+            ["products", "listings"],
+            lambda: [dict(zip(fields, row)) for row in db.session.execute(statement)],
+        )
+
+    @classmethod
+    def iter_serialized(
+        cls, criteria: dict, after=None, limit: int = None, batch_size: int = 500, fields: tuple = None, sort: str = "id"
+    ):
+        """Yields the matching Products, serialized, without loading them all at once
+
+        Rows come from a server-side cursor batch_size at a time and are
+        serialized straight from the row tuples, see select_rows.
+        The cache is bypassed, the result may be larger than the whole cache.
+
+        :param criteria: criterion name to value, see FILTERS
+        :type criteria: dict
+        :param after: only return Products after this id (keyset pagination)
+        :type after: int
+        :param limit: the maximum number of Products to return, None for all
+        :type limit: int
+        :param batch_size: the number of rows fetched from the database at a time
+        :type batch_size: int
+        :param fields: the fields to return, see select_rows
+        :type fields: tuple
+        :param sort: the field to order by, see paginate
+        :type sort: str
+
+        :return: a generator of the serialized Products
+        :rtype: Iterator[dict]
+
+        """
+        fields, statement = cls.select_rows(criteria, fields, after, limit, sort)
+        result = db.session.execute(statement, execution_options={"stream_results": True})
+        for row in result.yield_per(batch_size):
+            yield dict(zip(fields, row))
+
+    @classmethod
+    def stats(cls, criteria: dict = None, bucket_size: float = 10.0, counter: int = None) -> dict:
+        """Returns facet counts and price and rating statistics, through the cache
+
+        Everything comes from one GROUP BY category, availability and price
+        bucket, folded into per-category figures and the facet counts.
+        Like list_serialized, the cached figures are keyed by the change counter.
+
+        :param criteria: criterion name to value, see FILTERS
+        :type criteria: dict
+        :param bucket_size: the width of the price buckets
+        :type bucket_size: float
+        :param counter: the change counter, see change_counter
+        :type counter: int
+
+        :return: the "total", "categories", "available" and "price_buckets" facets
+        :rtype: dict
+
+        """
+        criteria = criteria or {}
+        bucket = func.floor(cls.price / bucket_size)
+        statement = (
+            select(
+                cls.category,
+                cls.available,
+                bucket,
+                func.count(),
+                func.min(cls.price),
+                func.max(cls.price),
+                func.sum(cls.price),
+                func.sum(cls.rating),
+                func.count(cls.rating),
+            )
+            .where(*cls.filter_clauses(criteria))
+            .group_by(cls.category, cls.available, bucket)
+        )
+        key = f"stats:{counter}:{sorted(criteria.items())!r}:{bucket_size}"
+        return cache.get_or_load(
+            key,
+            ["products", "listings"],
+            lambda: fold_stats(db.session.execute(statement), bucket_size),
+        )
+
+    @classmethod
+    def category_summary(cls) -> dict:
+        """Returns the count, availability, average price and rating of each category
+
+        Read from the category_summary table, which triggers on the product
+        table keep up to date (see migration 7), so it costs one row per
+        category however many Products there are.
+
+        :return: the summary of every category, keyed by category
+        :rtype: dict
+
+        """
+        rows = db.session.execute(
+            text(
+                "SELECT category, product_count, available_count, price_sum, rating_sum, rated_count "
+                "FROM category_summary ORDER BY category"
+            )
+        )
+        return {
+            category: {
+                "count": count,
+                "available": available,
+                "avg_price": float(price_sum / count),
+                "avg_rating": float(rating_sum / rated) if rated else None,
+            }
+            for category, count, available, price_sum, rating_sum, rated in rows
+        }
+
+    @staticmethod
+    def pool_stats() -> dict:
+        """Returns the state and checkout counters of the connection pools of this process
+
+        The pools of the read replicas, if any, are reported under "replicas".
+        """
+        stats = pool_state(db.engine.pool)
+        binds = db.get_app().config.get("SQLALCHEMY_BINDS") or {}
+        replicas = {
+            bind: pool_state(db.get_engine(bind=bind).pool) for bind in binds if bind.startswith(REPLICA_PREFIX)
+        }
+        if replicas:
+            stats["replicas"] = replicas
+        return stats
+
+    @staticmethod
+    def read_from_replicas():
+        """Lets the reads of the current request go to a read replica until it writes"""
+        db.session.info[READ_ONLY] = True
+
+    @staticmethod
+    def reset_routing():
+        """Sends the reads of a new request to the primary until it is marked read-only
+
+        The session is only removed when the app context ends, and a request
+        made while a context is already pushed (e.g. in a test or a command)
+        does not end it, so the flags of the previous request are cleared
+        explicitly.
+        """
+        db.session().reset_routing()
+
+    @classmethod
+    def load_suggestions(cls):
+        """Rebuilds the completion index from the names and ratings of every Product"""
+        suggestions.load(cls.suggestion_rows())
+
+    @classmethod
+    def suggestion_rows(cls) -> list:
+        """Returns the id, name and rating of every Product, to index them"""
+        logger.info("Loading product names for suggestions")
+        return db.session.execute(select(cls.id, cls.name, cls.rating)).all()
+
+    @classmethod
+    def suggest(cls, prefix: str, limit: int = 10) -> list:
+        """Returns the best rated Products whose name starts with a prefix
+
+        Served from the in-process index, reloaded once it is older than
+        SUGGEST_REFRESH_INTERVAL so writes of other workers show up. While one
+        request reloads it the others are answered from the old index.
+
+        :param prefix: the beginning of the name, in any case
+        :type prefix: str
+        :param limit: the maximum number of Products to return
+        :type limit: int
+
+        :return: the id, name and rating of each Product, best rated first
+        :rtype: list
+
+        """
+        suggestions.refresh(cls.suggestion_rows)
+        return suggestions.suggest(prefix, limit)
 
     @classmethod
     def find_or_404(cls, product_id: int):
@@ -259,16 +1047,214 @@ class Product(db.Model):
         return cls.query.get_or_404(product_id)
 
     @classmethod
-    def find_by_name(cls, name: str) -> list:
+    def filter_clauses(cls, criteria: dict) -> list:
+        """Builds the SQL predicates for a set of search criteria
+
+        :param criteria: criterion name to value, see FILTERS; None values are skipped
+        :type criteria: dict
+
+        :return: a list of SQL expressions to be AND-ed together
+        :rtype: list
+
+        """
+        clauses = []
+        for key, value in criteria.items():
+            if value is None:
+                continue
+            if key not in FILTERS:
+                raise DataValidationError(f"Invalid filter [{key}]")
+            clauses.append(FILTERS[key](cls, value))
+        return clauses
+
+    @classmethod
+    def paginate(cls, query, after=None, limit: int = None, sort: str = "id", criteria: dict = None):
+        """Orders a query and restricts it to one keyset page
+
+        Products are ordered by the sort field and then by id, with missing
+        ratings last in either direction, so ORDER BY ... LIMIT can be served
+        by the (field, id) indexes of migration 5 instead of a full sort.
+
+        :param query: the query to paginate
+        :type query: Query or Select
+        :param after: the id of the last Product of the previous page or, when
+            sorted by another field, its (sort value, id)
+        :type after: int or tuple
+        :param limit: the maximum number of Products to return
+        :type limit: int
+        :param sort: one of SORT_FIELDS, prefixed with "-" for descending order
+        :type sort: str
+        :param criteria: the search criteria of the query, needed to sort by rank
+        :type criteria: dict
+
+        :return: the query for the requested page
+        :rtype: Query
+
+        """
+        field = sort.lstrip("-")
+        if field not in SORT_FIELDS:
+            raise DataValidationError(f"Invalid sort field [{field}]")
+        descending = sort.startswith("-")
+        sort_column = cls.sort_expression(field, criteria or {})
+        if after is not None:
+            query = query.filter(cls.after_clause(field, sort_column, descending, after))
+        query = query.order_by(*cls.order_clauses(field, sort_column, descending))
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def sort_expression(cls, field: str, criteria: dict):
+        """Returns the column of a sort field, or the relevance of a search for rank"""
+        if field == "rank":
+            return cls.search_rank(criteria)
+        return getattr(cls, field)
+
+    @classmethod
+    def nullable(cls, field: str) -> bool:
+        """Returns True if the values of a sort field can be NULL"""
+        return field in cls.__table__.c and cls.__table__.c[field].nullable
+
+    @classmethod
+    def order_clauses(cls, field: str, sort_column, descending: bool) -> list:
+        """Returns the ORDER BY of a sort field, with the id breaking ties"""
+        direction = desc if descending else asc
+        order = direction(sort_column)
+        if cls.nullable(field):
+            order = order.nullslast()
+        if field == "id":
+            return [order]
+        return [order, direction(cls.id)]
+
+    @classmethod
+    def after_clause(cls, field: str, sort_column, descending: bool, after):
+        """Returns the predicate selecting the rows after a keyset position"""
+        if field == "id":
+            return cls.id < after if descending else cls.id > after
+        value, last_id = after
+        if value is None:
+            # the previous page ended among the trailing NULLs
+            return and_(sort_column.is_(None), cls.id < last_id if descending else cls.id > last_id)
+        position = tuple_(sort_column, cls.id)
+        last = tuple_(value, last_id)
+        clause = position < last if descending else position > last
+        if cls.nullable(field):
+            clause = or_(clause, sort_column.is_(None))
+        return clause
+
+    ##################################################
+    # FULL-TEXT SEARCH
+    ##################################################
+
+    @staticmethod
+    def search_terms(text_query: str) -> list:
+        """Splits a search into lower case words"""
+        return re.findall(r"\w+", text_query.lower())
+
+    @classmethod
+    def search_query(cls, text_query: str, prefix: bool = False):
+        """Returns the tsquery of a search
+
+        :param text_query: the search, in web search syntax ("quoted phrases", -excluded)
+        :type text_query: str
+        :param prefix: match every word as a prefix, for typeahead
+        :type prefix: bool
+
+        """
+        if prefix:
+            words = " & ".join(f"{term}:*" for term in cls.search_terms(text_query))
+            return func.to_tsquery(SEARCH_CONFIG, words)
+        return func.websearch_to_tsquery(SEARCH_CONFIG, text_query)
+
+    @classmethod
+    def like_term(cls, field: str, term: str, prefix: bool = False):
+        """Returns the LIKE fallback matching one word of a search in one field"""
+        field_column = getattr(cls, field)
+        term = term.replace("_", "\\_")
+        if prefix:
+            return or_(
+                field_column.ilike(f"{term}%", escape="\\"),
+                field_column.ilike(f"% {term}%", escape="\\"),
+            )
+        return field_column.ilike(f"%{term}%", escape="\\")
+
+    @classmethod
+    def search_clause(cls, text_query: str, prefix: bool = False, dialect: str = None):
+        """Returns the predicate of the Products matching a search
+
+        :param text_query: the search, see search_query
+        :type text_query: str
+        :param prefix: match every word as a prefix, for typeahead
+        :type prefix: bool
+        :param dialect: the database dialect, that of the engine if None
+        :type dialect: str
+
+        """
+        if (dialect or db.engine.dialect.name) == "postgresql":
+            return SEARCH_VECTOR.op("@@")(cls.search_query(text_query, prefix))
+        terms = cls.search_terms(text_query)
+        if not terms:
+            return literal(False)
+        return and_(
+            *[or_(*[cls.like_term(field, term, prefix) for field, _ in SEARCH_WEIGHTS]) for term in terms]
+        )
+
+    @classmethod
+    def search_rank(cls, criteria: dict, dialect: str = None):
+        """Returns the relevance of each Product to the search in criteria
+
+        :param criteria: search criteria holding a "q" or "q_prefix" search
+        :type criteria: dict
+        :param dialect: the database dialect, that of the engine if None
+        :type dialect: str
+
+        """
+        prefix = bool(criteria.get("q_prefix"))
+        text_query = criteria.get("q_prefix") or criteria.get("q")
+        if not text_query:
+            raise DataValidationError("Sorting by rank needs a search")
+        if (dialect or db.engine.dialect.name) == "postgresql":
+            # as double precision, so ranks survive the round trip through cursors
+            return cast(func.ts_rank(SEARCH_VECTOR, cls.search_query(text_query, prefix)), Float)
+        weights = [
+            case((cls.like_term(field, term, prefix), weight), else_=0.0)
+            for term in cls.search_terms(text_query) or [""]
+            for field, weight in SEARCH_WEIGHTS
+        ]
+        return cast(sum(weights[1:], weights[0]), Float)
+
+    @classmethod
+    def find_by_criteria(cls, criteria: dict, after=None, limit: int = None, sort: str = "id"):
+        """Returns all of the Products matching every given criterion
+
+        :param criteria: criterion name to value, e.g. {"category": "shoes", "price": 20.0}
+        :type criteria: dict
+        :param after: only return Products after this position, see paginate
+        :type after: int or tuple
+        :param limit: the maximum number of Products to return
+        :type limit: int
+        :param sort: the field to order by, see paginate
+        :type sort: str
+
+        :return: a query for the matching Products, issued as one statement
+        :rtype: Query
+
+        """
+        logger.info("Processing criteria query for %s ...", criteria)
+        # only reads, so a read replica may answer it (see service.utils.replicas)
+        query = cls.query.filter(*cls.filter_clauses(criteria)).execution_options(replica=True)
+        return cls.paginate(query, after, limit, sort, criteria)
+
+    @classmethod
+    def find_by_name(cls, name: str, after: int = None, limit: int = None) -> list:
         """Returns all products with the given name
         Args:
         name (string): the name of the products you want to match
         """
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        return cls.find_by_criteria({"name": name}, after, limit)
 
     @classmethod
-    def find_by_rating(cls, rating: float) -> list:
+    def find_by_rating(cls, rating: float, after: int = None, limit: int = None) -> list:
         """Returns all Products by their rating
 
         :param rating: ratings can be inrange from [1,5]
@@ -279,10 +1265,10 @@ class Product(db.Model):
 
         """
         logger.info("Processing rating query for %s ...", rating)
-        return cls.query.filter(cls.rating >= rating)
+        return cls.find_by_criteria({"rating": rating}, after, limit)
 
     @classmethod
-    def find_by_category(cls, category: str) -> list:
+    def find_by_category(cls, category: str, after: int = None, limit: int = None) -> list:
         """Returns all of the Products in a category
 
         :param category: the category of the Products you want to match
@@ -293,10 +1279,10 @@ class Product(db.Model):
 
         """
         logger.info("Processing category query for %s ...", category)
-        return cls.query.filter(cls.category == category)
+        return cls.find_by_criteria({"category": category}, after, limit)
 
     @classmethod
-    def find_by_price(cls, price: float) -> list:
+    def find_by_price(cls, price: float, after: int = None, limit: int = None) -> list:
         """Returns all Products by their price
 
         :param price: values are float number
@@ -307,14 +1293,14 @@ class Product(db.Model):
 
         """
         logger.info("Processing price query for %s ...", price)
-        return cls.query.filter(cls.price <= price)
+        return cls.find_by_criteria({"price": price}, after, limit)
 
     @classmethod
-    def find_by_availability(cls) -> list:
+    def find_by_availability(cls, after: int = None, limit: int = None) -> list:
         """Returns all the products that are currently available
 
         Returns:
             list: returns the list of currently available products
         """
         logger.info("Processing availability query")
-        return cls.query.filter(cls.available)
+        return cls.find_by_criteria({"available": True}, after, limit)
@@ -7,143 +7,613 @@ Describe what your service does here
 # import os
 # import sys
 # import logging
+import json
+import base64
+import hashlib
+from functools import wraps
 # from flask import Flask, request, url_for, jsonify, make_response, abort
-from flask import url_for, jsonify, request, abort
-from service.utils import status  # HTTP Status Codes
-from service.models import Product, MIN_PRICE, MAX_PRICE, MAX_DESCRIPTION_LENGTH
+from flask import Blueprint, current_app, url_for, jsonify, request, abort, stream_with_context
+from flask import json as flask_json
+from service.utils import metrics, status  # HTTP Status Codes
+from service.models import Product, DataValidationError, rating_buffer
+from service.models import MIN_PRICE, MAX_PRICE, MAX_DESCRIPTION_LENGTH, MAX_CATEGORY_LENGTH
+from service.models import SERIALIZED_FIELDS, SORT_FIELDS
 
-# Import Flask application
-from . import app
+# The routes of the service, registered on the app by service.create_app()
+api = Blueprint("products", __name__)
+
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_NDJSON = "application/x-ndjson"
+
+
+def read_only(function):
+    """Marks a route that never writes, so it may read from a read replica"""
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        Product.read_from_replicas()
+        return function(*args, **kwargs)
+
+    return wrapper
+
+
+@api.before_app_request
+def reset_routing():
+    """Starts every request on the primary, see read_only"""
+    Product.reset_routing()
 
-MAX_CATEGORY_LENGTH = 63
 ######################################################################
 # GET INDEX
 ######################################################################
 
 
-@app.route("/")
+@api.route("/")
 def index():
     """Root URL response"""
-    app.logger.info("Request for Root URL")
-    return app.send_static_file("index.html")
+    current_app.logger.info("Request for Root URL")
+    return current_app.send_static_file("index.html")
 
 
 ######################################################################
 # LIST ALL PRODUCTS
 ######################################################################
-def check_category(category):
-    products = Product.find_by_category(category)
-    results = [product.serialize() for product in products]
-    app.logger.info("Returning %d products", len(results))
-    return results
+def parse_filters(args) -> dict:
+    """
+    Converts the query string of a list request into search criteria
 
+    Raises ValueError if a filter value is malformed or out of range
+    """
+    criteria = {}
+    category = args.get("category")
+    if category:
+        criteria["category"] = category
+    price = args.get("price")
+    if price:
+        criteria["price"] = float(price)
+        if criteria["price"] < 0:
+            raise ValueError
+    rating = args.get("rating")
+    if rating:
+        criteria["rating"] = float(rating)
+        if criteria["rating"] < 1 or criteria["rating"] > 5:
+            raise ValueError
+    available = args.get("available")
+    if available:
+        if available != "True":
+            raise ValueError
+        criteria["available"] = True
+    return criteria
+
+
+def parse_fields(fields_str) -> tuple:
+    """
+    Converts the fields query parameter into the fields of a listing
 
-def check_price(price):
-    price = float(price)
-    if price < 0:
+    Raises ValueError for a field that is not serialized; the id is always returned
+    """
+    if not fields_str:
+        return None
+    fields = tuple(field.strip() for field in fields_str.split(","))
+    if any(field not in SERIALIZED_FIELDS for field in fields):
         raise ValueError
-    products = Product.find_by_price(price)
-    results = [product.serialize() for product in products]
-    results.sort(key=lambda n: n["price"], reverse=True)
-    return results
+    return fields
+
+
+def parse_search(args) -> dict:
+    """
+    Converts the q and prefix query parameters into search criteria
+
+    ?q= is a full-text search of the names and descriptions, with ?prefix=true
+    every word also matches longer words (typeahead)
+    """
+    text_query = args.get("q", "").strip()
+    if not text_query:
+        return {}
+    prefix = args.get("prefix", "").lower() in ("1", "true", "yes")
+    return {"q_prefix" if prefix else "q": text_query}
+
+
+def parse_sort(args, searching: bool = False) -> str:
+    """
+    Converts the sort and order query parameters into the order of a listing
+
+    Searches are ordered by relevance (rank) unless asked otherwise.
+    Raises ValueError for a field that cannot be sorted on or an unknown order
+    """
+    field = args.get("sort") or ("rank" if searching else "id")
+    order = args.get("order") or ("desc" if field == "rank" else "asc")
+    if field not in SORT_FIELDS or order not in ("asc", "desc"):
+        raise ValueError
+    if field == "rank" and not searching:
+        raise ValueError
+    return "-" + field if order == "desc" else field
+
+
+def parse_listing(args, stream: bool) -> dict:
+    """
+    Converts the query string of a list request into the arguments of the listing
+
+    Raises ValueError if any parameter is malformed or out of range
+    """
+    search = parse_search(args)
+    sort = parse_sort(args, bool(search))
+    after = args.get("after")
+    return {
+        "criteria": dict(parse_filters(args), **search),
+        "after": decode_cursor(after, sort) if after else None,
+        "limit": parse_limit(args.get("limit"), unbounded=stream),
+        "fields": parse_fields(args.get("fields")),
+        "sort": sort,
+    }
+
+
+def parse_limit(limit_str, unbounded=False) -> int:
+    """
+    Converts the limit query parameter into a page size
+
+    Raises ValueError if the limit is not a positive integer within MAX_PAGE_SIZE.
+    An unbounded listing (a stream) has no default and no maximum size
+    """
+    if not limit_str:
+        return None if unbounded else current_app.config["DEFAULT_PAGE_SIZE"]
+    limit = int(limit_str)
+    if limit < 1 or (limit > current_app.config["MAX_PAGE_SIZE"] and not unbounded):
+        raise ValueError
+    return limit
+
+
+def accepts_ndjson() -> bool:
+    """Returns True if the client prefers NDJSON to JSON"""
+    best = request.accept_mimetypes.best_match([CONTENT_TYPE_JSON, CONTENT_TYPE_NDJSON])
+    return best == CONTENT_TYPE_NDJSON
+
+
+def wants_stream() -> bool:
+    """Returns True if the client asked for ?stream=1 or for NDJSON"""
+    if request.args.get("stream", "").lower() in ("1", "true", "yes"):
+        return True
+    return accepts_ndjson()
+
+
+def listing_representation(stream: bool) -> str:
+    """Names what a listing request gets: a page or a stream, and its media type"""
+    if not stream:
+        return "page:" + CONTENT_TYPE_JSON
+    return "stream:" + (CONTENT_TYPE_NDJSON if accepts_ndjson() else CONTENT_TYPE_JSON)
+
 
+def dump_row(row: dict) -> str:
+    """Encodes one row of a stream with the encoder and settings of jsonify"""
+    return flask_json.dumps(row, separators=(",", ":"))
 
-def check_rating(rating_str):
-    rating = float(rating_str)
-    if rating < 1 or rating > 5:
+
+def generate_json_array(rows):
+    """Encodes rows as one JSON array, a row at a time"""
+    yield "["
+    separator = ""
+    for row in rows:
+        yield separator + dump_row(row)
+        separator = ","
+    yield "]\n"
+
+
+def stream_products(listing: dict, etag: str):
+    """
+    Streams the matching Products instead of building the whole listing
+
+    Rows are fetched from a server-side cursor STREAM_BATCH_SIZE at a time and
+    written out as they arrive, as NDJSON if the client accepts it or else as
+    a single JSON array, so memory use does not grow with the catalog
+    """
+    rows = Product.iter_serialized(batch_size=current_app.config["STREAM_BATCH_SIZE"], **listing)
+    if accepts_ndjson():
+        body = (dump_row(row) + "\n" for row in rows)
+        mimetype = CONTENT_TYPE_NDJSON
+    else:
+        body = generate_json_array(rows)
+        mimetype = CONTENT_TYPE_JSON
+    response = current_app.response_class(stream_with_context(body), mimetype=mimetype)
+    response.set_etag(etag)
+    return response
+
+
+def encode_cursor(key: dict) -> str:
+    """Encodes the keyset position of the last row of a page as an opaque cursor"""
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, sort: str = "id"):
+    """
+    Decodes a cursor produced by encode_cursor into a keyset position
+
+    Returns the id of the last row, or its (sort value, id) for another sort.
+    Raises ValueError if the cursor was not produced by encode_cursor for this sort
+    """
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    if not isinstance(key, dict) or not isinstance(key.get("id"), int):
+        raise ValueError
+    if key.get("sort", "id") != sort:
+        raise ValueError
+    if sort == "id":
+        return key["id"]
+    field, value = sort.lstrip("-"), key.get("value")
+    if value is None:
+        if not Product.nullable(field):
+            raise ValueError
+    elif field == "name":
+        if not isinstance(value, str):
+            raise ValueError
+    elif not isinstance(value, (int, float)) or isinstance(value, bool):
         raise ValueError
-    products = Product.find_by_rating(rating)
-    results = [
-        product.serialize() for product in products if product.rating is not None
-    ]
-    results.sort(key=lambda n: n["rating"], reverse=True)
-    return results
+    return value, key["id"]
 
 
-def eliminate_product(products_all, products):
-    result = []
-    for product in products_all:
-        if product in products:
-            result.append(product)
-    return result
+def page_cursor(row: dict, sort: str) -> str:
+    """Returns the cursor of the page that starts after row"""
+    if sort == "id":
+        return encode_cursor({"id": row["id"]})
+    return encode_cursor({"id": row["id"], "value": row[sort.lstrip("-")], "sort": sort})
 
 
-@app.route("/products", methods=["GET"])
+def next_page_headers(cursor: str) -> dict:
+    """Builds the Link and X-Next-Cursor headers pointing at the next page"""
+    args = request.args.to_dict()
+    args["after"] = cursor
+    next_url = url_for(".list_products", _external=True, **args)
+    return {"Link": f'<{next_url}>; rel="next"', "X-Next-Cursor": cursor}
+
+
+@api.route("/products", methods=["GET"])
+@read_only
 def list_products():
-    app.logger.info("Request for Product List")
-    products_all = Product.all()
-    results_all = [product.serialize() for product in products_all]
-    rating_str = request.args.get("rating")
-    category = request.args.get("category")
-    price = request.args.get("price")
-    available = request.args.get("available")
-    if category:
-        results = check_category(category)
-        results_all = eliminate_product(results_all, results)
-    if price:
-        try:
-            results = check_price(price)
-            results_all = eliminate_product(results_all, results)
-        except ValueError:
-            return "", status.HTTP_406_NOT_ACCEPTABLE
-    if rating_str:
-        try:
-            results = check_rating(rating_str)
-            results_all = eliminate_product(results_all, results)
-        except ValueError:
-            return "", status.HTTP_406_NOT_ACCEPTABLE
-    if available:
-        if available != "True":
-            return "", status.HTTP_406_NOT_ACCEPTABLE
-        products = Product.find_by_availability()
-        results = [product.serialize() for product in products]
-        results_all = eliminate_product(results_all, results)
+    """
+    Returns one page of the Products matching the query string filters
+
+    Pages are at most ?limit= long and continue after the opaque ?after= cursor
+    returned in the Link and X-Next-Cursor headers of the previous page.
+    With ?stream=1 or Accept: application/x-ndjson every matching Product is
+    streamed in one response instead. ?fields=name,price returns only those
+    fields (and the id) of each Product. ?sort=price|rating|name|id with
+    ?order=asc|desc orders the listing in the database, e.g. the 20 best rated
+    shoes are ?category=shoes&sort=rating&order=desc&limit=20.
+    ?q= searches names and descriptions, most relevant first (sort=rank);
+    add ?prefix=true to match words as they are being typed.
+    Returns 304_NOT_MODIFIED if no product changed since the If-None-Match ETag
+    """
+    current_app.logger.info("Request for Product List")
+    try:
+        stream = wants_stream()
+        listing = parse_listing(request.args, stream)
+    except ValueError:
+        return "", status.HTTP_406_NOT_ACCEPTABLE
+
+    # the same URL is a page or a stream, as JSON or NDJSON, depending on Accept
+    counter = Product.change_counter()
+    etag = listing_etag(counter, listing_representation(stream))
+    if etag in request.if_none_match:
+        response = not_modified(etag)
+        response.vary.add("Accept")
+        return response
+    if stream:
+        current_app.logger.info("Streaming products")
+        response = stream_products(listing, etag)
+        response.vary.add("Accept")
+        return response
+
+    # fetch one extra row to learn whether there is a next page
+    limit = listing["limit"]
+    results = Product.list_serialized(**dict(listing, limit=limit + 1), counter=counter)
+    headers = {}
+    if len(results) > limit:
+        results = results[:limit]
+        headers = next_page_headers(page_cursor(results[-1], listing["sort"]))
+
+    current_app.logger.info("Returning %d products", len(results))
+    response = jsonify(results)
+    response.set_etag(etag)
+    response.vary.add("Accept")
+    return response, status.HTTP_200_OK, headers
+
+
+@api.route("/products/categories", methods=["GET"])
+@read_only
+def category_summary():
+    """
+    Returns the number of Products, available Products, average price and
+    average rating of every category, from the incrementally kept summary
+    """
+    current_app.logger.info("Request for the category summary")
+    return jsonify(Product.category_summary()), status.HTTP_200_OK
+
+
+######################################################################
+# SUGGEST PRODUCT NAMES
+######################################################################
+@api.route("/products/suggest", methods=["GET"])
+@read_only
+def suggest_products():
+    """
+    Completes a product name for a search box
+
+    Returns up to ?limit= products whose name starts with ?q=, ignoring case,
+    best rated first. The names are served from memory, not the database
+    """
+    prefix = request.args.get("q", "")
+    try:
+        limit = int(request.args.get("limit") or current_app.config["SUGGEST_LIMIT"])
+    except ValueError:
+        limit = 0
+    if limit < 1 or limit > current_app.config["SUGGEST_MAX_LIMIT"]:
+        return "", status.HTTP_406_NOT_ACCEPTABLE
+    if not prefix.strip():
+        return jsonify([]), status.HTTP_200_OK
+    return jsonify(Product.suggest(prefix, limit)), status.HTTP_200_OK
 
-    app.logger.info("Returning %d products", len(results_all))
-    return jsonify(results_all), status.HTTP_200_OK
+
+######################################################################
+# PRODUCT STATISTICS
+######################################################################
+@api.route("/products/stats", methods=["GET"])
+@read_only
+def product_stats():
+    """
+    Returns facet counts and statistics of the Products matching the filters
+
+    Counts per category, availability and price bucket, with the min, max and
+    average price and the average rating of each category, computed by a
+    single GROUP BY query
+    """
+    current_app.logger.info("Request for Product statistics")
+    try:
+        criteria = dict(parse_filters(request.args), **parse_search(request.args))
+    except ValueError:
+        return "", status.HTTP_406_NOT_ACCEPTABLE
+    counter = Product.change_counter()
+    etag = listing_etag(counter)
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    response = jsonify(Product.stats(criteria, current_app.config["STATS_PRICE_BUCKET"], counter))
+    response.set_etag(etag)
+    return response, status.HTTP_200_OK
 
 
 ######################################################################
 # RETRIEVE A PRODUCT
 ######################################################################
-@app.route("/products/<int:product_id>", methods=["GET"])
+@api.route("/products/<int:product_id>", methods=["GET"])
+@read_only
 def get_products(product_id):
     """
     Retrieve a single Product
 
-    This endpoint will return a Product based on it's id
+    This endpoint will return a Product based on it's id, or 304_NOT_MODIFIED
+    if it is still at the version named by If-None-Match
     """
-    app.logger.info("Request for product with id: %s", product_id)
+    current_app.logger.info("Request for product with id: %s", product_id)
     product = Product.find(product_id)
     if not product:
         abort(
             status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found."
         )
+    if product.etag in request.if_none_match:
+        return not_modified(product.etag)
 
-    app.logger.info("Returning product: %s", product.name)
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    current_app.logger.info("Returning product: %s", product.name)
+    return product_response(product)
 
 
 ######################################################################
 # ADD A NEW PRODUCT
 ######################################################################
-@app.route("/products", methods=["POST"])
+@api.route("/products", methods=["POST"])
 def create_products():
     """
     Creates a Product
     This endpoint will create a Product based the data in the body that is posted
     """
-    app.logger.info("Request to create a product")
+    current_app.logger.info("Request to create a product")
     check_content_type("application/json")
     product = Product()
     product.deserialize(request.get_json())
-    app.logger.info("Here Deserialization done")
+    current_app.logger.info("Here Deserialization done")
     product.create()
-    message = product.serialize()
-    location_url = url_for("get_products", product_id=product.id, _external=True)
+    location_url = url_for(".get_products", product_id=product.id, _external=True)
 
-    app.logger.info("Product with ID [%s] created.", product.id)
-    return jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
+    current_app.logger.info("Product with ID [%s] created.", product.id)
+    return product_response(product, status.HTTP_201_CREATED), {"Location": location_url}
+
+
+######################################################################
+# ADD PRODUCTS IN BULK
+######################################################################
+def read_bulk_items() -> list:
+    """Reads the items of a bulk request from a JSON array or an NDJSON body"""
+    if request.headers.get("Content-Type") == "application/x-ndjson":
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)  # reported as an invalid item
+        return items
+    items = request.get_json()
+    if not isinstance(items, list):
+        abort(status.HTTP_400_BAD_REQUEST, "Body must be a JSON array of products")
+    return items
+
+
+def validate_bulk_items(items: list):
+    """
+    Deserializes every item of a bulk request on its own
+
+    Returns the valid Products and one result per item, in order; invalid
+    items already carry their error
+    """
+    products = []
+    results = []
+    names = set()
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise DataValidationError("Invalid Product: item is not a JSON object")
+            product = Product().deserialize(item)
+            product.check_required()
+            product.check_lengths()
+            if product.name in names:
+                raise DataValidationError(f"Error: name {product.name} already exists!")
+        except DataValidationError as error:
+            results.append(
+                {"index": index, "status": status.HTTP_400_BAD_REQUEST, "error": str(error)}
+            )
+            continue
+        names.add(product.name)
+        products.append(product)
+        results.append({"index": index, "name": product.name})
+    return products, results
+
+
+@api.route("/products/bulk", methods=["POST"])
+def create_products_in_bulk():
+    """
+    Creates many Products at once
+
+    The body is a JSON array or an NDJSON stream of products. Every item is
+    validated on its own and the valid ones are inserted in batches within one
+    transaction. The response holds the outcome of every item, in order.
+    """
+    current_app.logger.info("Request to create products in bulk")
+    check_content_type("application/json", "application/x-ndjson")
+    items = read_bulk_items()
+    if len(items) > current_app.config["BULK_MAX_ITEMS"]:
+        abort(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            f"At most {current_app.config['BULK_MAX_ITEMS']} products can be created at once",
+        )
+
+    products, results = validate_bulk_items(items)
+    created = Product.create_many(products, current_app.config["BULK_BATCH_SIZE"])
+    for result in results:
+        if "name" not in result:
+            continue
+        name = result.pop("name")
+        if name in created:
+            result["status"] = status.HTTP_201_CREATED
+            result["id"] = created[name]
+            result["location"] = url_for(
+                ".get_products", product_id=created[name], _external=True
+            )
+        else:
+            result["status"] = status.HTTP_409_CONFLICT
+            result["error"] = f"Error: name {name} already exists!"
+
+    current_app.logger.info("Created %d of %d products in bulk.", len(created), len(items))
+    if len(created) == len(items):
+        return jsonify(results), status.HTTP_201_CREATED
+    return jsonify(results), status.HTTP_207_MULTI_STATUS
+
+
+######################################################################
+# UPDATE OR DELETE PRODUCTS IN BULK
+######################################################################
+# the JSON types of the criteria of a bulk "filter"
+BULK_FILTER_TYPES = {
+    "name": str,
+    "category": str,
+    "q": str,
+    "q_prefix": str,
+    "price": (int, float),
+    "rating": (int, float),
+    "available": bool,
+}
+
+
+def parse_bulk_filter(criteria: dict) -> dict:
+    """
+    Checks the "filter" object of a bulk request as parse_filters checks a query string
+
+    Raises ValueError if a criterion has the wrong type or is out of range;
+    unknown criteria are rejected by Product.filter_clauses
+    """
+    for key, value in criteria.items():
+        if value is None:
+            continue
+        if key == "ids":
+            if not isinstance(value, list) or not all(isinstance(i, int) for i in value):
+                raise ValueError("'ids' must be a list of product ids")
+            continue
+        expected = BULK_FILTER_TYPES.get(key)
+        if expected is None:
+            continue
+        if not isinstance(value, expected) or (expected is not bool and isinstance(value, bool)):
+            raise ValueError(f"Invalid type for filter [{key}]")
+    if criteria.get("price") is not None and criteria["price"] < 0:
+        raise ValueError("Invalid value for filter [price]")
+    if criteria.get("rating") is not None and not 1 <= criteria["rating"] <= 5:
+        raise ValueError("Invalid value for filter [rating]")
+    return criteria
+
+
+def read_bulk_criteria(body) -> dict:
+    """
+    Reads which Products a bulk request applies to
+
+    The body names them either by "ids" (a list of ids) or by a "filter"
+    object using the same criteria as the product listing
+    """
+    if not isinstance(body, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "Body must be a JSON object")
+    if "ids" in body:
+        ids = body["ids"]
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            abort(status.HTTP_400_BAD_REQUEST, "'ids' must be a list of product ids")
+        return {"ids": ids}
+    criteria = body.get("filter")
+    if not isinstance(criteria, dict) or not criteria:
+        abort(status.HTTP_400_BAD_REQUEST, "Body must contain 'ids' or a 'filter' object")
+    try:
+        return parse_bulk_filter(criteria)
+    except ValueError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+
+
+@api.route("/products/bulk", methods=["PATCH"])
+def update_products_in_bulk():
+    """
+    Updates many Products at once
+
+    The body selects Products with "ids" or "filter" and holds the new
+    price, availability, category or description in "set". All of them are
+    changed by a single UPDATE statement.
+    """
+    current_app.logger.info("Request to update products in bulk")
+    check_content_type("application/json")
+    body = request.get_json()
+    criteria = read_bulk_criteria(body)
+    changes = body.get("set")
+    if not isinstance(changes, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "Body must contain a 'set' object")
+    if isinstance(changes.get("price"), int) and not isinstance(changes["price"], bool):
+        changes["price"] = float(changes["price"])
+    count = Product.update_many(criteria, changes)
+    current_app.logger.info("Updated %d products in bulk.", count)
+    return jsonify(updated=count), status.HTTP_200_OK
+
+
+@api.route("/products/bulk", methods=["DELETE"])
+def delete_products_in_bulk():
+    """
+    Deletes many Products at once
+
+    The body selects Products with "ids" or "filter"; all of them are
+    removed by a single DELETE statement.
+    """
+    current_app.logger.info("Request to delete products in bulk")
+    check_content_type("application/json")
+    count = Product.delete_many(read_bulk_criteria(request.get_json()))
+    current_app.logger.info("Deleted %d products in bulk.", count)
+    return jsonify(deleted=count), status.HTTP_200_OK
 
 
 ######################################################################
@@ -151,110 +621,150 @@ def create_products():
 ######################################################################
 
 
-@app.route("/products/<int:product_id>", methods=["DELETE"])
+@api.route("/products/<int:product_id>", methods=["DELETE"])
 def delete_products(product_id):
     """Delete a Product"""
-    app.logger.info("Request to delete product with id: %s", product_id)
-    product = Product.find(product_id)
+    current_app.logger.info("Request to delete product with id: %s", product_id)
+    product = Product.find_for_update(product_id)
     if product:
         product.delete()
 
-    app.logger.info("Product with ID [%s] delete complete.", product_id)
+    current_app.logger.info("Product with ID [%s] delete complete.", product_id)
     return "", status.HTTP_204_NO_CONTENT
 
 
 ######################################################################
 # UPDATE AN EXISTING PRODUCT
 ######################################################################
-@app.route("/products/<int:product_id>", methods=["PUT"])
+@api.route("/products/<int:product_id>", methods=["PUT"])
 def update_products(product_id):
     """
     Update a Product
 
     This endpoint will update a Product based the body that is posted
     """
-    app.logger.info("Request to update product with id: %s", product_id)
+    current_app.logger.info("Request to update product with id: %s", product_id)
     check_content_type("application/json")
 
-    product = Product.find(product_id)
+    product = Product.find_for_update(product_id)
     if not product:
         abort(
             status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found."
         )
+    check_if_match(product)
 
     product.deserialize(request.get_json())
     product.id = product_id
     product.update()
 
-    app.logger.info("Product with ID [%s] updated.", product.id)
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    current_app.logger.info("Product with ID [%s] updated.", product.id)
+    return product_response(product)
 
 
 ######################################################################
 # UPDATE THE RATING OF A PRODUCT
 ######################################################################
-@app.route("/products/<int:product_id>/rating", methods=["PUT"])
+@api.route("/products/<int:product_id>/rating", methods=["PUT"])
 def update_rating_of_product(product_id):
     """
     Updates the rating of a product on the basis of feedback provided.
+
+    The new rating is added by one atomic UPDATE, so concurrent ratings
+    of the same product are never lost. With RATING_INGESTION=buffered the
+    rating of an existing product is queued and written in a batch, and
+    202_ACCEPTED is returned; a rating with If-Match is still written at
+    once, so its version is checked when the rating is applied.
     Args:
-        product_id (_type_): _description_
+        product_id (int): the id of the product being rated
     """
-    app.logger.info(
+    current_app.logger.info(
         "Request to update the rating of the product with id: %s", product_id
     )
     check_content_type("application/json")
-    product = Product.find(product_id)
+    new_rating = request.get_json()
+    if not isinstance(new_rating.get("rating"), int):
+        refuse_rating(product_id, "Rating should be of integer datatype")
+    if new_rating["rating"] <= 0 or new_rating["rating"] > 5:
+        refuse_rating(product_id, "The ratings can be from [1,5]")
+    version = rating_precondition(product_id)
+    if current_app.config["RATING_INGESTION"] == "buffered" and not request.if_match:
+        if not Product.find(product_id):
+            abort(
+                status.HTTP_404_NOT_FOUND,
+                description=f"Product with id '{product_id}' was not found.",
+            )
+        rating_buffer.add(product_id, new_rating["rating"])
+        current_app.logger.info("Rating of product with ID [%s] queued.", product_id)
+        return (
+            jsonify(id=product_id, rating=new_rating["rating"]),
+            status.HTTP_202_ACCEPTED,
+        )
+    product = Product.add_rating(product_id, new_rating["rating"], version)
+    if not product and version is not None:
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            description=f"Product with id '{product_id}' has changed.",
+        )
     if not product:
-        app.logger.info("Inside this condition")
+        current_app.logger.info("Product_id not found.")
         abort(
             status.HTTP_404_NOT_FOUND,
             description=f"Product with id '{product_id}' was not found.",
         )
-    new_rating = request.get_json()
-    if not isinstance(new_rating["rating"], int):
-        abort(
-            status.HTTP_406_NOT_ACCEPTABLE,
-            description="Rating should be of integer datatype",
-        )
-    if new_rating["rating"] <= 0 or new_rating["rating"] > 5:
+    current_app.logger.info("Product with ID [%s] updated.", product.id)
+    return product_response(product)
+
+
+def refuse_rating(product_id, description: str):
+    """
+    Refuses an invalid rating with 406_NOT_ACCEPTABLE
+
+    An unknown product is still answered with 404_NOT_FOUND first, whatever
+    the body; the product is only looked up once the rating is refused, so a
+    valid rating still costs a single UPDATE
+    """
+    if not Product.find(product_id):
+        current_app.logger.info("Product_id not found.")
         abort(
-            status.HTTP_406_NOT_ACCEPTABLE, description="The ratings can be from [1,5]"
+            status.HTTP_404_NOT_FOUND,
+            description=f"Product with id '{product_id}' was not found.",
         )
-    if new_rating["rating"] is not None:
-        product.id = product_id
-        myJson = product.serialize()
-        product.deserialize(myJson)
-        product.id = product_id
-        if product.rating is None or product.no_of_users_rated == 0:
-            product.no_of_users_rated = 1
-            product.rating = float(new_rating["rating"])
-        else:
-            product.rating = float(product.rating * product.no_of_users_rated + new_rating["rating"])\
-             / (product.no_of_users_rated+1)
-            product.no_of_users_rated = product.no_of_users_rated + 1
-        product.update()
-        app.logger.info("Product with ID [%s] updated.", product.id)
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    abort(status.HTTP_406_NOT_ACCEPTABLE, description=description)
+
+
+def rating_precondition(product_id) -> int:
+    """
+    Checks the If-Match header of a rating
+
+    Returns the version the rating is conditional on, or None when the
+    request has no If-Match header or the product does not exist
+    """
+    if not request.if_match:
+        return None
+    product = Product.find_for_update(product_id)
+    if not product:
+        return None
+    check_if_match(product)
+    return product.version
 
 
 ######################################################################
 # UPDATE THE PRICE OF A PRODUCT
 ######################################################################
-@app.route("/products/<int:product_id>/price", methods=["PUT"])
+@api.route("/products/<int:product_id>/price", methods=["PUT"])
 def update_price_of_product(product_id):
     """
     Updates the price of a product on the basis of feedback provided.
     Args:
         product_id (_type_): _description_
     """
-    app.logger.info(
+    current_app.logger.info(
         "Request to update the price of the product with id: %s", product_id
     )
     check_content_type("application/json")
-    product = Product.find(product_id)
+    product = Product.find_for_update(product_id)
     if not product:
-        app.logger.info("Product_id not found.")
+        current_app.logger.info("Product_id not found.")
         abort(
             status.HTTP_404_NOT_FOUND,
             description=f"Product with id '{product_id}' was not found.",
@@ -275,29 +785,30 @@ def update_price_of_product(product_id):
     new_price["price"] = float(new_price["price"])
     if new_price["price"] < MIN_PRICE or new_price["price"] > MAX_PRICE:
         abort(status.HTTP_406_NOT_ACCEPTABLE, description="New price out of range.")
+    check_if_match(product)
     product.price = new_price["price"]
     product.update()
-    app.logger.info("Price of product with ID [%s] updated.", product.id)
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    current_app.logger.info("Price of product with ID [%s] updated.", product.id)
+    return product_response(product)
 
 
 ######################################################################
 # UPDATE THE DESCRIPTION OF A PRODUCT
 ######################################################################
-@app.route("/products/<int:product_id>/description", methods=["PUT"])
+@api.route("/products/<int:product_id>/description", methods=["PUT"])
 def update_description_of_product(product_id):
     """
     Updates the description of a product on the basis of feedback provided.
     Args:
         product_id (_type_): _description_
     """
-    app.logger.info(
+    current_app.logger.info(
         "Request to update the description of the product with id: %s", product_id
     )
     check_content_type("application/json")
-    product = Product.find(product_id)
+    product = Product.find_for_update(product_id)
     if not product:
-        app.logger.info("Product_id not found.")
+        current_app.logger.info("Product_id not found.")
         abort(
             status.HTTP_404_NOT_FOUND,
             description=f"Product with id '{product_id}' was not found.",
@@ -317,10 +828,11 @@ def update_description_of_product(product_id):
         abort(
             status.HTTP_406_NOT_ACCEPTABLE, description="Description length over limit."
         )
+    check_if_match(product)
     product.description = new_description["description"]
     product.update()
-    app.logger.info("Description of product with ID [%s] updated.", product.id)
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    current_app.logger.info("Description of product with ID [%s] updated.", product.id)
+    return product_response(product)
 
 
 ######################################################################
@@ -328,20 +840,20 @@ def update_description_of_product(product_id):
 ######################################################################
 
 
-@app.route("/products/<int:product_id>/category", methods=["PUT"])
+@api.route("/products/<int:product_id>/category", methods=["PUT"])
 def update_category_of_product(product_id):
     """
     Updates the category of a product on the basis of feedback provided.
     Args:
         product_id (_type_): _category_
     """
-    app.logger.info(
+    current_app.logger.info(
         "Request to update the category of the product with id: %s", product_id
     )
     check_content_type("application/json")
-    product = Product.find(product_id)
+    product = Product.find_for_update(product_id)
     if not product:
-        app.logger.info("Product_id not found.")
+        current_app.logger.info("Product_id not found.")
         abort(
             status.HTTP_404_NOT_FOUND,
             description=f"Product with id '{product_id}' was not found.",
@@ -359,10 +871,36 @@ def update_category_of_product(product_id):
         )
     if len(new_category["category"]) > MAX_CATEGORY_LENGTH:
         abort(status.HTTP_406_NOT_ACCEPTABLE, description="Category length over limit.")
+    check_if_match(product)
     product.category = new_category["category"]
     product.update()
-    app.logger.info("Description of product with ID [%s] updated.", product.id)
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    current_app.logger.info("Description of product with ID [%s] updated.", product.id)
+    return product_response(product)
+
+
+######################################################################
+# METRICS
+######################################################################
+@api.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """
+    Returns the request, database, cache and pool metrics in the Prometheus
+    text format: count, latency and response size of the requests per route
+    and status, and the database time and queries of each request
+    """
+    body, content_type = metrics.render()
+    return current_app.response_class(body, status=status.HTTP_200_OK, content_type=content_type)
+
+
+@api.route("/metrics/pool", methods=["GET"])
+def pool_metrics():
+    """
+    Returns the connection pool state of the worker that answers
+
+    Connections checked out and in, overflow in use, and the number, total and
+    longest wait and timeouts of checkouts since the worker started
+    """
+    return jsonify(Product.pool_stats()), status.HTTP_200_OK
 
 
 ######################################################################
@@ -371,20 +909,67 @@ def update_category_of_product(product_id):
 
 
 def init_db():
-    """Initializes the SQLAlchemy app"""
-    global app
-    Product.init_db(app)
+    """Initializes the SQLAlchemy app of the current app"""
+    Product.init_db(current_app._get_current_object())  # pylint: disable=protected-access
+
+
+def prepare_db(app):
+    """Migrates the database of an app and loads its name completions, see Product.prepare_db"""
+    with app.app_context():
+        Product.prepare_db()
+
+
+@api.before_app_request
+def ensure_db():
+    """Prepares the database on the first request of a process nobody prepared it for"""
+    Product.ensure_db()
+
+
+def product_response(product, code=status.HTTP_200_OK):
+    """Returns a Product as JSON, tagged with the ETag of its version"""
+    response = jsonify(product.serialize())
+    response.status_code = code
+    response.set_etag(product.etag)
+    return response
+
+
+def listing_etag(counter: int, representation: str = "") -> str:
+    """
+    Returns the ETag of a listing: the table change counter, the query and
+    the representation, see listing_representation
+
+    The body must be read at the same counter, see Product.list_serialized
+    """
+    key = f"{counter}:{representation}:{request.full_path}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def not_modified(etag: str):
+    """Returns an empty 304_NOT_MODIFIED response for an unchanged resource"""
+    response = current_app.response_class(status=status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+
+def check_if_match(product):
+    """Aborts with 412_PRECONDITION_FAILED if If-Match names another version"""
+    if request.if_match and not request.if_match.contains(product.etag):
+        current_app.logger.info("Product with ID [%s] has changed.", product.id)
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            description=f"Product with id '{product.id}' has changed.",
+        )
 
 
-def check_content_type(media_type):
-    """Checks that the media type is correct"""
+def check_content_type(*media_types):
+    """Checks that the media type is one of the accepted ones"""
     content_type = request.headers.get("Content-Type")
-    if content_type and content_type == media_type:
+    if content_type and content_type in media_types:
         return
-    app.logger.error("Invalid Content-Type: %s", content_type)
+    current_app.logger.error("Invalid Content-Type: %s", content_type)
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-        "Content-Type must be {}".format(media_type),
+        "Content-Type must be {}".format(" or ".join(media_types)),
     )
 
 
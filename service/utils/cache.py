@@ -0,0 +1,312 @@
+"""
+Cache
+
+This module contains the cache used to serve hot products and listings
+without a database round trip.
+
+Values are stored under versioned keys: every key names the scopes it
+depends on (e.g. "products" and "product:42") and is looked up together
+with the current version of those scopes. A write only has to increment the
+version of the scopes it touched, and every cached value depending on them
+becomes unreachable. When the versions live in a shared backend such as
+Redis, a write in one worker invalidates the caches of all workers. With the
+per-process backend alone, a write only invalidates the worker that made it:
+the others may serve the old value until it expires, CACHE_TTL seconds at
+most.
+
+Versions are dropped like values, so one per product does not accumulate
+forever. A dropped scope never comes back at a version it had before, so the
+values cached under its old versions stay unreachable.
+"""
+import json
+import time
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+
+class CacheBackend(ABC):
+    """Interface of the stores that hold cached values and scope versions"""
+
+    name = "abstract"
+
+    @abstractmethod
+    def get(self, key: str):
+        """Returns the value cached under key, or None on a miss"""
+
+    @abstractmethod
+    def set(self, key: str, value):
+        """Caches value under key"""
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Drops the value cached under key, if any"""
+
+    @abstractmethod
+    def clear(self):
+        """Drops every cached value"""
+
+    @abstractmethod
+    def versions(self, scopes: list) -> list:
+        """Returns the current version of each scope"""
+
+    @abstractmethod
+    def incr(self, scope: str) -> int:
+        """Increments the version of a scope and returns it"""
+
+    def stats(self) -> dict:
+        """Returns counters describing the backend"""
+        return {"backend": self.name}
+
+
+class LRUCache(CacheBackend):
+    """A thread-safe least-recently-used cache whose entries expire
+
+    Entries are evicted when the cache holds more than `max_size` of them or
+    when they are older than `ttl` seconds. Scope versions are kept apart, the
+    `max_size` most recently used of them. A scope whose version was evicted
+    starts again from the highest version evicted so far, which is at least
+    its own last version. This is the per-process backend, and it stands in
+    for a shared backend when several caches are given the same instance.
+    """
+
+    name = "memory"
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._versions = OrderedDict()
+        self._version_floor = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def versions(self, scopes):
+        with self._lock:
+            versions = []
+            for scope in scopes:
+                version = self._versions.get(scope)
+                if version is None:
+                    version = self._version_floor
+                else:
+                    self._versions.move_to_end(scope)
+                versions.append(version)
+            return versions
+
+    def incr(self, scope):
+        with self._lock:
+            version = self._versions.pop(scope, self._version_floor) + 1
+            self._versions[scope] = version
+            while len(self._versions) > self.max_size:
+                _, evicted = self._versions.popitem(last=False)
+                self._version_floor = max(self._version_floor, evicted)
+            return version
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": self.name,
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class RedisCache(CacheBackend):
+    """A cache shared by every worker and replica, kept in Redis
+
+    Values are stored as JSON with a ttl, scope versions as Redis counters.
+    A version expires once it was neither read nor changed for `version_ttl`
+    seconds; by then every value cached under it has expired, so the scope
+    can start over from 0. Requires the optional `redis` package.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, ttl: float = 30.0, prefix: str = "products:", version_ttl: float = 3600.0):
+        import redis  # pylint: disable=import-outside-toplevel
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = max(1, int(ttl))
+        # leaves time for a slow load to store its value under the version it read
+        self.version_ttl = max(int(version_ttl), 10 * self.ttl)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        # the scope versions are kept, going back to older versions would
+        # make values cached under them reachable again
+        versions = (self.prefix + "v:").encode("utf-8")
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            if not key.startswith(versions):
+                self.client.delete(key)
+
+    def versions(self, scopes):
+        pipeline = self.client.pipeline(transaction=False)
+        for scope in scopes:
+            pipeline.getex(self.prefix + "v:" + scope, ex=self.version_ttl)
+        return [int(value or 0) for value in pipeline.execute()]
+
+    def incr(self, scope):
+        key = self.prefix + "v:" + scope
+        pipeline = self.client.pipeline()
+        pipeline.incr(key)
+        pipeline.expire(key, self.version_ttl)
+        return pipeline.execute()[0]
+
+
+class VersionedCache:
+    """Caches values under keys versioned by the scopes they depend on
+
+    Values are looked up in a per-process `local` backend first, then in the
+    `shared` backend, if any, which also holds the scope versions. Without a
+    shared backend the versions are kept in the local one, so invalidation is
+    limited to the current process.
+    """
+
+    def __init__(self, local: CacheBackend = None, shared: CacheBackend = None, enabled: bool = True):
+        self.configure(local or LRUCache(), shared, enabled)
+
+    def configure(self, local: CacheBackend, shared: CacheBackend = None, enabled: bool = True):
+        """Replaces the backends of the cache"""
+        self.local = local
+        self.shared = shared
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def _version_store(self) -> CacheBackend:
+        return self.shared if self.shared is not None else self.local
+
+    def _versioned_key(self, key: str, scopes: list) -> str:
+        versions = self._version_store.versions(scopes)
+        return key + "@" + ".".join(str(version) for version in versions)
+
+    def get_or_load(self, key: str, scopes: list, load):
+        """Returns the value cached under key, calling load() on a miss
+
+        The scope versions are read before load() runs, so a value loaded
+        while another worker writes is cached under the old versions and is
+        never served after that write.
+
+        :param key: the key of the value
+        :type key: str
+        :param scopes: the scopes the value depends on
+        :type scopes: list
+        :param load: returns the value from the database; None is not cached
+        :type load: callable
+
+        """
+        if not self.enabled:
+            return load()
+        try:
+            versioned_key = self._versioned_key(key, scopes)
+            value = self.local.get(versioned_key)
+            if value is None and self.shared is not None:
+                value = self.shared.get(versioned_key)
+                if value is not None:
+                    self.local.set(versioned_key, value)
+        except Exception as error:  # pylint: disable=broad-except
+            # the cache must never take the service down, fall back to the database
+            self.errors += 1
+            logger.warning("Cache lookup failed: %s", error)
+            return load()
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = load()
+        if value is not None:
+            self._store(versioned_key, value)
+        return value
+
+    def _store(self, versioned_key: str, value):
+        """Caches a loaded value in every backend"""
+        try:
+            self.local.set(versioned_key, value)
+            if self.shared is not None:
+                self.shared.set(versioned_key, value)
+        except Exception as error:  # pylint: disable=broad-except
+            self.errors += 1
+            logger.warning("Cache update failed: %s", error)
+
+    def invalidate(self, *scopes: str):
+        """Makes every value depending on one of the scopes unreachable"""
+        try:
+            for scope in scopes:
+                self._version_store.incr(scope)
+        except Exception as error:  # pylint: disable=broad-except
+            self.errors += 1
+            logger.error("Cache invalidation failed, clearing local cache: %s", error)
+            self.local.clear()
+
+    def clear(self):
+        """Drops every value cached by this process"""
+        self.local.clear()
+
+    def stats(self) -> dict:
+        """Returns the hit, miss and error counters and the backend counters"""
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "local": self.local.stats(),
+            "shared": self.shared.stats() if self.shared is not None else None,
+        }
+
+
+def create_cache_backend(config: dict, ttl: float):
+    """Returns the shared backend selected by CACHE_BACKEND, or None"""
+    if config.get("CACHE_BACKEND", "memory") != "redis":
+        return None
+    try:
+        return RedisCache(config["CACHE_URL"], ttl)
+    except ImportError:
+        logger.error("CACHE_BACKEND=redis needs the redis package, caching per process")
+        return None
@@ -1,20 +1,54 @@
 """
 Flask CLI Command Extensions
 """
-from service import app
+from flask import Blueprint, current_app
+from service import migrations
 from service.models import db
 
+# The flask commands of the service, registered by service.create_app()
+commands = Blueprint("commands", __name__, cli_group=None)
+
 
 ######################################################################
 # Command to force tables to be rebuilt
 # Usage: flask create-db
 ######################################################################
-@app.cli.command("create-db")
+@commands.cli.command("create-db")
 def create_db():
     """
-    Recreates a local database. You probably should not use this on
+    Recreates a local database, with the change counter and the category
+    summary kept by the migrations. You probably should not use this on
     production.
     """
     db.drop_all()
-    db.create_all()
+    migrations.drop_migration_tables(db.engine)
+    migrations.upgrade(db.engine, db.metadata)
     db.session.commit()
+
+
+######################################################################
+# Command to apply pending schema migrations
+# Usage: flask upgrade-db
+######################################################################
+@commands.cli.command("upgrade-db")
+def upgrade_db():
+    """
+    Applies any pending schema migrations. Safe to run against production.
+    """
+    applied = migrations.upgrade(db.engine, db.metadata)
+    current_app.logger.info("Applied migrations: %s", applied or "none")
+
+
+######################################################################
+# Command to recompute the category summary
+# Usage: flask rebuild-summary
+######################################################################
+@commands.cli.command("rebuild-summary")
+def rebuild_summary():
+    """
+    Recomputes the per category summary from the products. Writes to the
+    products wait until it is done.
+    """
+    with db.engine.begin() as connection:
+        migrations.rebuild_category_summary(connection)
+    current_app.logger.info("Category summary rebuilt")
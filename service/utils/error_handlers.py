@@ -17,26 +17,28 @@
 """
 Module: error_handlers
 """
-from flask import jsonify
-from service.models import DataValidationError
-from service import app
+from flask import Blueprint, current_app, jsonify
+from service.models import DataValidationError, DataConflictError
 from . import status
 
+# Handlers of every error of the app, registered by service.create_app()
+errors = Blueprint("errors", __name__)
+
 
 ######################################################################
 # Error Handlers
 ######################################################################
-@app.errorhandler(DataValidationError)
+@errors.app_errorhandler(DataValidationError)
 def request_validation_error(error):
     """Handles Value Errors from bad data"""
     return bad_request(error)
 
 
-@app.errorhandler(status.HTTP_400_BAD_REQUEST)
+@errors.app_errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """Handles bad requests with 400_BAD_REQUEST"""
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_400_BAD_REQUEST, error="Bad Request", message=message
@@ -45,22 +47,22 @@ def bad_request(error):
     )
 
 
-@app.errorhandler(status.HTTP_404_NOT_FOUND)
+@errors.app_errorhandler(status.HTTP_404_NOT_FOUND)
 def not_found(error):
     """Handles resources not found with 404_NOT_FOUND"""
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(status=status.HTTP_404_NOT_FOUND, error="Not Found", message=message),
         status.HTTP_404_NOT_FOUND,
     )
 
 
-@app.errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
+@errors.app_errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
 def method_not_supported(error):
     """Handles unsupported HTTP methods with 405_METHOD_NOT_SUPPORTED"""
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_405_METHOD_NOT_ALLOWED,
@@ -71,26 +73,47 @@ def method_not_supported(error):
     )
 
 
-# @app.errorhandler(status.HTTP_409_CONFLICT)
-# def resource_conflict(error):
-#     """Handles resource conflicts with HTTP_409_CONFLICT"""
-#     message = str(error)
-#     app.logger.warning(message)
-#     return (
-#         jsonify(
-#             status=status.HTTP_409_CONFLICT,
-#             error="Conflict",
-#             message=message,
-#         ),
-#         status.HTTP_409_CONFLICT,
-#     )
+@errors.app_errorhandler(DataConflictError)
+def request_conflict_error(error):
+    """Handles products changed by another request"""
+    return resource_conflict(error)
+
+
+@errors.app_errorhandler(status.HTTP_409_CONFLICT)
+def resource_conflict(error):
+    """Handles resource conflicts with HTTP_409_CONFLICT"""
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_409_CONFLICT,
+            error="Conflict",
+            message=message,
+        ),
+        status.HTTP_409_CONFLICT,
+    )
+
+
+@errors.app_errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+def precondition_failed(error):
+    """Handles failed If-Match preconditions with HTTP_412_PRECONDITION_FAILED"""
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED,
+            error="Precondition Failed",
+            message=message,
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
 
 
-@app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+@errors.app_errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """Handles unsupported media requests with 415_UNSUPPORTED_MEDIA_TYPE"""
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
@@ -101,11 +124,11 @@ def mediatype_not_supported(error):
     )
 
 
-@app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
+@errors.app_errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """Handles unexpected server error with 500_SERVER_ERROR"""
     message = str(error)
-    app.logger.error(message)
+    current_app.logger.error(message)
     return (
         jsonify(
             status=status.HTTP_500_INTERNAL_SERVER_ERROR,
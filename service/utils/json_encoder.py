@@ -0,0 +1,62 @@
+"""
+JSON Encoder
+
+This module contains the JSON encoder behind jsonify and the streamed
+listings, selected by the JSON_ENCODER setting.
+
+Flask 2.1 encodes through json.dumps(obj, cls=app.json_encoder), so a faster
+library is plugged in by overriding JSONEncoder.encode. FastJSONEncoder hands
+the common case (compact separators, no indentation) to orjson and produces
+the same documents as the stdlib encoder: the same key order, true/false,
+and floats that parse back to the same values. Objects only Flask knows how
+to encode (dates, decimals, dataclasses) still go through Flask's default(),
+and anything orjson refuses is encoded by the stdlib instead.
+
+The one difference is NaN and infinity: orjson encodes them as null, the
+stdlib as NaN and Infinity, which are not valid JSON. Spotting them would
+mean scanning every document before encoding it, and products never hold
+them (prices and ratings are range checked), so they are left to orjson.
+"""
+import logging
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+logger = logging.getLogger("flask.app")
+
+ORJSON_OPTIONS = (
+    orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+    if orjson
+    else 0
+)
+
+
+class FastJSONEncoder(JSONEncoder):
+    """A Flask JSONEncoder that encodes compact documents with orjson"""
+
+    def encode(self, o):
+        if self.indent is not None or (self.item_separator, self.key_separator) != (",", ":"):
+            return super().encode(o)
+        options = ORJSON_OPTIONS | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+        try:
+            text = orjson.dumps(o, default=self.default, option=options).decode("utf-8")
+        except orjson.JSONEncodeError:
+            return super().encode(o)
+        if self.ensure_ascii and not text.isascii():
+            # only the stdlib escapes non-ASCII characters
+            return super().encode(o)
+        return text
+
+
+def select_json_encoder(name: str = "auto") -> type:
+    """Returns the encoder class named by JSON_ENCODER: auto, orjson or stdlib"""
+    if name == "stdlib":
+        return JSONEncoder
+    if orjson is None:
+        if name == "orjson":
+            logger.error("JSON_ENCODER=orjson needs the orjson package, using the stdlib encoder")
+        return JSONEncoder
+    return FastJSONEncoder
@@ -0,0 +1,212 @@
+"""
+Request Metrics
+
+This module records the count, latency, response size and status of every
+request per route, with the time it spent in the database and its number of
+queries, and renders them for GET /metrics in the Prometheus text format.
+
+Recording a request costs four histogram updates and a counter increment; the
+database time is summed by two SQLAlchemy cursor events. A streamed response
+is recorded when it is closed, once its rows have been read and sent.
+
+Under gunicorn the workers write their metrics to files in
+PROMETHEUS_MULTIPROC_DIR (set up by gunicorn.conf.py), so whichever worker
+answers a scrape reports all of them. That includes the cache and connection
+pool gauges, which every worker refreshes at most once per
+GAUGE_REFRESH_INTERVAL as it answers requests. They are summed over the live
+workers, except the connections in use, which are reported per worker; the
+files of a worker are dropped when it exits.
+"""
+import os
+import time
+from functools import lru_cache
+
+from flask import Blueprint, has_request_context, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from service.models import Product, cache
+
+# The request hooks, registered on the app by service.create_app()
+metrics = Blueprint("metrics", __name__)
+
+LABELS = ("method", "route")
+ENVIRON_KEY = "products.metrics"
+
+# any other method is counted as "OTHER", clients must not create new series
+METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+
+REQUESTS = Counter(
+    "http_requests_total", "Requests answered, by route and status", LABELS + ("status",)
+)
+LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time from the start of a request to its response, by route",
+    LABELS,
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+RESPONSE_SIZE = Histogram(
+    "http_response_size_bytes",
+    "Size of the response bodies, by route (streams are not counted)",
+    LABELS,
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+)
+DB_TIME = Histogram(
+    "http_request_db_duration_seconds",
+    "Time a request spent executing database queries, by route",
+    LABELS,
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+DB_QUERIES = Histogram(
+    "http_request_db_queries",
+    "Database queries executed by a request, by route",
+    LABELS,
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+
+# seconds between two refreshes of the cache and pool gauges of a worker
+GAUGE_REFRESH_INTERVAL = 1.0
+
+CACHE_GAUGES = {
+    name: Gauge(f"products_cache_{name}", f"Cache {name} of the live workers", multiprocess_mode="livesum")
+    for name in ("hits", "misses", "errors")
+}
+# Product.pool_stats() key: gauge, labelled with the bind ("primary" or a replica)
+POOL_GAUGES = {
+    key: Gauge(f"products_db_pool_{name}", description, ["bind"], multiprocess_mode=mode)
+    for key, name, description, mode in (
+        ("size", "size", "Connections kept open by the live workers", "livesum"),
+        ("checked_in", "checked_in", "Idle connections of the live workers", "livesum"),
+        ("checked_out", "checked_out", "Connections in use, per worker", "liveall"),
+        ("overflow", "overflow", "Connections opened beyond the pool size, per worker", "liveall"),
+        ("checkouts", "checkouts", "Connections checked out by the live workers", "livesum"),
+        ("timeouts", "timeouts", "Checkouts of the live workers that timed out", "livesum"),
+        ("wait_seconds_total", "wait_seconds", "Time the live workers waited for a connection", "livesum"),
+    )
+}
+gauges_refreshed = {"at": 0.0}
+
+
+def route_label() -> str:
+    """Returns the name of the view that answered, without its blueprint"""
+    if request.endpoint is None:
+        return "unmatched"
+    return request.endpoint.rpartition(".")[2]
+
+
+class RequestUse:  # pylint: disable=too-few-public-methods
+    """The start and database use of a request, kept in its WSGI environ
+
+    Not in g: a streamed response runs its queries under a request context
+    pushed again by stream_with_context, which may come with another g.
+    """
+
+    __slots__ = ("start", "db_seconds", "db_queries")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_seconds = 0.0
+        self.db_queries = 0
+
+
+@metrics.before_app_request
+def start_request():
+    """Starts timing the request"""
+    request.environ[ENVIRON_KEY] = RequestUse()
+
+
+@lru_cache(maxsize=None)
+def route_metrics(method: str, route: str) -> tuple:
+    """Returns the latency, size, database time and query histograms of a route
+
+    The label lookups are done once per route rather than on every request.
+    """
+    return tuple(histogram.labels(method, route) for histogram in (LATENCY, RESPONSE_SIZE, DB_TIME, DB_QUERIES))
+
+
+@lru_cache(maxsize=None)
+def route_requests(method: str, route: str, code: int):
+    """Returns the request counter of a route and status"""
+    return REQUESTS.labels(method, route, str(code))
+
+
+@metrics.after_app_request
+def record_request(response):
+    """Records the latency, status, size and database use of the request
+
+    A streamed response has not run its queries yet: it is recorded when it
+    is closed, after the last row was sent.
+    """
+    use = request.environ.get(ENVIRON_KEY)
+    if use is None:
+        return response
+    method = request.method if request.method in METHODS else "OTHER"
+    route = route_label()
+    if response.is_streamed:
+        # the size of a stream is not known; referencing the response here would keep it alive
+        code = response.status_code
+        response.call_on_close(lambda: observe(method, route, code, None, use))
+    else:
+        observe(method, route, response.status_code, response.calculate_content_length(), use)
+    refresh_gauges()
+    return response
+
+
+def observe(method: str, route: str, code: int, size: int, use: RequestUse):
+    """Adds one request to the metrics of its route"""
+    latency_seconds, response_size, db_time, db_queries = route_metrics(method, route)
+    latency_seconds.observe(time.perf_counter() - use.start)
+    route_requests(method, route, code).inc()
+    if size is not None:
+        response_size.observe(size)
+    db_time.observe(use.db_seconds)
+    db_queries.observe(use.db_queries)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query(connection, cursor, statement, parameters, context, executemany):
+    """Starts timing a query"""
+    connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(connection, cursor, statement, parameters, context, executemany):
+    """Adds the time of a query to the request that made it, if any"""
+    starts = connection.info.get("query_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    use = request.environ.get(ENVIRON_KEY) if has_request_context() else None
+    if use is not None:
+        use.db_seconds += elapsed
+        use.db_queries += 1
+
+
+def refresh_gauges(force: bool = False):
+    """Copies the cache and pool statistics of this worker into its gauges"""
+    now = time.monotonic()
+    if not force and now - gauges_refreshed["at"] < GAUGE_REFRESH_INTERVAL:
+        return
+    gauges_refreshed["at"] = now
+    stats = cache.stats()
+    for name, gauge in CACHE_GAUGES.items():
+        gauge.set(stats[name])
+    pools = Product.pool_stats()
+    pools = dict(pools.pop("replicas", {}), primary=pools)
+    for bind, pool in pools.items():
+        for key, gauge in POOL_GAUGES.items():
+            if key in pool:
+                gauge.labels(bind).set(pool[key])
+
+
+def render() -> tuple:
+    """Returns the metrics in the Prometheus text format, and its content type"""
+    refresh_gauges(force=True)
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # merge the files written by every worker
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
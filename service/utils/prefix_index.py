@@ -0,0 +1,136 @@
+"""
+Prefix Index
+
+This module contains the in-process index behind name completions: every
+product name, case folded, in a sorted array searched with bisect, so the
+names starting with a prefix are one contiguous slice.
+
+Each worker keeps its own index. Writes made by the worker update it in
+place; writes made by other workers are picked up when the index is rebuilt
+from the database, at most `max_age` seconds after it was last loaded. One
+thread rebuilds it while the others keep answering from the old index.
+"""
+import time
+import heapq
+import threading
+from bisect import bisect_left, insort
+
+# sorts after any character a name can start a prefix with
+PREFIX_END = "\U0010ffff"
+
+# answers for prefixes this short match a large slice of the index, so they
+# are remembered until the next change
+MEMO_PREFIX_LENGTH = 2
+
+
+class PrefixIndex:
+    """A sorted array of product names answering top-k prefix queries"""
+
+    def __init__(self, max_age: float = 30.0):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._keys = []  # sorted (folded name, id)
+        self._entries = {}  # id -> (folded name, name, rating)
+        self._loaded_at = None
+        self._memo = {}
+
+    def configure(self, max_age: float):
+        """Changes how long the index is trusted before it is reloaded"""
+        self.max_age = max_age
+
+    def stale(self) -> bool:
+        """Returns True if the index must be (re)loaded from the database"""
+        loaded_at = self._loaded_at
+        return loaded_at is None or time.monotonic() - loaded_at > self.max_age
+
+    def expire(self):
+        """Forces a reload before the next query, e.g. after a bulk write"""
+        self._loaded_at = None
+
+    def clear(self):
+        """Empties the index and forces a reload"""
+        with self._lock:
+            self._keys = []
+            self._entries = {}
+            self._loaded_at = None
+            self._memo = {}
+
+    def refresh(self, fetch_rows) -> bool:
+        """Reloads the index from fetch_rows() if it is stale
+
+        Only one thread reloads at a time; the others return at once and keep
+        answering from the index as it is, so an expired index does not send
+        every concurrent query to the database.
+
+        :param fetch_rows: returns the (id, name, rating) rows of every product
+        :type fetch_rows: callable
+
+        :return: True if this call reloaded the index
+        :rtype: bool
+        """
+        if not self.stale() or not self._reload_lock.acquire(blocking=False):
+            return False
+        try:
+            # another thread may have reloaded it since stale() was checked
+            if not self.stale():
+                return False
+            self.load(fetch_rows())
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def load(self, rows):
+        """Replaces the whole index with (id, name, rating) rows"""
+        entries = {product_id: (name.casefold(), name, rating) for product_id, name, rating in rows}
+        keys = sorted((entry[0], product_id) for product_id, entry in entries.items())
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self._loaded_at = time.monotonic()
+            self._memo = {}
+
+    def add(self, product_id: int, name: str, rating: float = None):
+        """Adds a product, or replaces its name and rating"""
+        with self._lock:
+            self._remove(product_id)
+            key = name.casefold()
+            self._entries[product_id] = (key, name, rating)
+            insort(self._keys, (key, product_id))
+
+    def remove(self, product_id: int):
+        """Removes a product, if it is indexed"""
+        with self._lock:
+            self._remove(product_id)
+
+    def _remove(self, product_id: int):
+        self._memo = {}
+        entry = self._entries.pop(product_id, None)
+        if entry is None:
+            return
+        position = bisect_left(self._keys, (entry[0], product_id))
+        del self._keys[position]
+
+    def suggest(self, prefix: str, limit: int = 10) -> list:
+        """Returns the best rated products whose name starts with prefix
+
+        Products without a rating come last, ties are ordered by name.
+        """
+        prefix = prefix.casefold()
+        memo_key = (prefix, limit)
+        with self._lock:
+            memo = self._memo
+            if memo_key in memo:
+                return list(memo[memo_key])
+            start = bisect_left(self._keys, (prefix,))
+            end = bisect_left(self._keys, (prefix + PREFIX_END,), start)
+            matches = [(product_id, self._entries[product_id]) for _, product_id in self._keys[start:end]]
+        best = heapq.nsmallest(limit, matches, key=lambda match: (-(match[1][2] or 0), match[1][0], match[0]))
+        result = [{"id": product_id, "name": name, "rating": rating} for product_id, (_, name, rating) in best]
+        if len(prefix) <= MEMO_PREFIX_LENGTH:
+            # stored in the memo the matches were read with, a write since then replaced it
+            memo[memo_key] = result
+        return list(result)
+
+    def __len__(self):
+        return len(self._keys)
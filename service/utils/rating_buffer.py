@@ -0,0 +1,136 @@
+"""
+Rating Buffer
+
+This module coalesces ratings in memory so that bursts of ratings for the
+same products are written as one batched statement instead of one commit
+per rating
+"""
+import os
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger("flask.app")
+
+
+class RatingBuffer:
+    """Collects ratings per product and flushes them periodically
+
+    Ratings are kept as a (sum, count) delta per product. A background thread
+    flushes them at least every `max_staleness` seconds, or as soon as
+    `max_pending` ratings are waiting, and once more when the process exits.
+    Ratings that could not be written are queued again, up to `max_pending`
+    ratings in all; the rest are dropped and counted, see dropped().
+    """
+
+    def __init__(self, flush, max_staleness: float = 1.0, max_pending: int = 10000):
+        """
+        :param flush: called with {product id: (sum, count)} to write the deltas
+        :type flush: callable
+        :param max_staleness: the longest a rating may wait to be written, in seconds
+        :type max_staleness: float
+        :param max_pending: the number of waiting ratings that triggers a flush
+        :type max_pending: int
+        """
+        self.flush_function = flush
+        self.max_staleness = max_staleness
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_count = 0
+        self._dropped = 0
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._pid = None
+        atexit.register(self.stop)
+
+    def configure(self, max_staleness: float, max_pending: int):
+        """Changes how long and how many ratings may wait before a flush"""
+        self.max_staleness = max_staleness
+        self.max_pending = max_pending
+
+    def add(self, product_id: int, rating: int):
+        """Queues one rating of a product"""
+        with self._lock:
+            total, count = self._pending.get(product_id, (0, 0))
+            self._pending[product_id] = (total + rating, count + 1)
+            self._pending_count += 1
+            full = self._pending_count >= self.max_pending
+        self._start()
+        if full:
+            self._wakeup.set()
+
+    def pending(self) -> int:
+        """Returns the number of ratings waiting to be written"""
+        with self._lock:
+            return self._pending_count
+
+    def dropped(self) -> int:
+        """Returns the number of ratings dropped because they could not be written"""
+        with self._lock:
+            return self._dropped
+
+    def flush(self) -> int:
+        """Writes every waiting rating, returns the number of products written"""
+        with self._lock:
+            deltas = self._pending
+            self._pending = {}
+            self._pending_count = 0
+        if not deltas:
+            return 0
+        try:
+            self.flush_function(deltas)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Rating flush failed, keeping %d products queued: %s", len(deltas), error)
+            self._requeue(deltas)
+            return 0
+        return len(deltas)
+
+    def stop(self):
+        """Stops the flusher thread and writes what is still waiting"""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.max_staleness + 5)
+        self.flush()
+
+    def _requeue(self, deltas: dict):
+        """Puts deltas that could not be written back in the queue, while it has room
+
+        The queue is not allowed to grow past max_pending ratings while the
+        database is failing: the deltas that do not fit are dropped.
+        """
+        dropped = 0
+        with self._lock:
+            for product_id, (total, count) in deltas.items():
+                if self._pending_count + count > self.max_pending:
+                    dropped += count
+                    continue
+                pending_total, pending_count = self._pending.get(product_id, (0, 0))
+                self._pending[product_id] = (pending_total + total, pending_count + count)
+                self._pending_count += count
+            self._dropped += dropped
+        if dropped:
+            logger.error("Rating queue is full, dropped %d rating(s) that could not be written", dropped)
+
+    def _start(self):
+        """Starts the flusher thread in this process if it is not running"""
+        # threads do not survive a fork, so each worker starts its own
+        if self._pid == os.getpid() or self._stopped:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="rating-buffer", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        """Flushes the buffer until the buffer is stopped"""
+        while not self._stopped:
+            self._wakeup.wait(self.max_staleness)
+            self._wakeup.clear()
+            self.flush()
@@ -0,0 +1,77 @@
+"""
+Read Replicas
+
+This module contains the session that sends reads to read replicas.
+
+Replicas are the SQLALCHEMY_BINDS named "replica_<n>" (see DATABASE_READ_URI
+in service.config). A statement is read from a replica only when
+
+* the request was marked read-only (see READ_ONLY), or the statement itself
+  asks for it with the execution option replica=True, and
+* the session has not written anything yet: once it flushes or executes an
+  INSERT, UPDATE or DELETE every later statement of the request goes to the
+  primary, so a request always reads its own writes.
+
+Everything else, including all writes and the statements that ask for it
+with primary=True, goes to the primary. A session sticks
+to one replica so that all the reads of a request see the same snapshot.
+The flags are cleared when the next request starts, the session itself may
+outlive a request (see Product.reset_routing).
+"""
+import random
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+
+REPLICA_PREFIX = "replica_"
+
+# session.info keys
+READ_ONLY = "read_only"
+WROTE = "wrote"
+REPLICA = "replica"
+ROUTING_KEYS = (READ_ONLY, WROTE, REPLICA)
+
+
+def replica_binds(uris: list) -> dict:
+    """Returns the SQLALCHEMY_BINDS naming each read replica URI"""
+    return {f"{REPLICA_PREFIX}{number}": uri for number, uri in enumerate(uris)}
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from a read replica when it is safe to"""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._reads_from_replica(clause):
+            binds = self.app.config.get("SQLALCHEMY_BINDS") or {}
+            replicas = [key for key in binds if key.startswith(REPLICA_PREFIX)]
+            if replicas:
+                replica = self.info.setdefault(REPLICA, random.choice(replicas))
+                return self.db.get_engine(self.app, bind=replica)
+        return super().get_bind(mapper, clause)
+
+    def reset_routing(self):
+        """Forgets the routing of the last request, see Product.reset_routing"""
+        for key in ROUTING_KEYS:
+            self.info.pop(key, None)
+
+    def _reads_from_replica(self, clause) -> bool:
+        if clause is None or getattr(clause, "is_dml", False) or self._flushing:
+            # a write, or a connection that may be used for one
+            self.info[WROTE] = True
+            return False
+        if self.info.get(WROTE) or clause.get_execution_options().get("primary"):
+            return False
+        if not (self.info.get(READ_ONLY) or clause.get_execution_options().get("replica")):
+            return False
+        # changes not flushed yet are only visible on the primary
+        return not (self.new or self.dirty or self.deleted)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with sessions that route reads to read replicas"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,241 @@
+"""
+Test cases for the LRU Cache
+
+"""
+import time
+import unittest
+
+import fakeredis
+
+from service.utils.cache import CacheBackend, LRUCache, RedisCache, VersionedCache, create_cache_backend
+
+######################################################################
+#  L R U   C A C H E   T E S T   C A S E S
+######################################################################
+
+
+class TestLRUCache(unittest.TestCase):
+    """Test Cases for the LRU Cache"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.cache = LRUCache(max_size=3, ttl=60)
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+    def test_get_and_set(self):
+        """It should return cached values and count hits and misses"""
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", {"id": 1})
+        self.assertEqual(self.cache.get("a"), {"id": 1})
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_evict_least_recently_used(self):
+        """It should evict the least recently used value when full"""
+        for key in ["a", "b", "c"]:
+            self.cache.set(key, key)
+        self.cache.get("a")
+        self.cache.set("d", "d")
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), "a")
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_expire(self):
+        """It should not return values older than the ttl"""
+        self.cache.ttl = 0.01
+        self.cache.set("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_delete_and_clear(self):
+        """It should drop one value or all of them"""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.delete("a")
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("b"))
+
+    def test_versions(self):
+        """It should count scope versions apart from the cached values"""
+        self.assertEqual(self.cache.versions(["a", "b"]), [0, 0])
+        self.assertEqual(self.cache.incr("a"), 1)
+        self.cache.clear()
+        self.assertEqual(self.cache.versions(["a", "b"]), [1, 0])
+
+    def test_evict_versions(self):
+        """It should keep a bounded number of versions and never reuse an old one"""
+        for scope in ["a", "b", "c"]:
+            self.cache.incr(scope)
+        self.cache.incr("a")
+        self.cache.incr("d")
+        self.assertEqual(len(self.cache._versions), 3)  # pylint: disable=protected-access
+        # "b" was evicted at version 1: it starts over from there, not from 0
+        self.assertEqual(self.cache.versions(["b", "x"]), [1, 1])
+        self.cache.incr("c")
+        self.cache.incr("e")
+        self.cache.incr("f")
+        self.assertEqual(self.cache.versions(["a", "b"]), [2, 2])
+        self.assertEqual(self.cache.incr("a"), 3)
+
+
+######################################################################
+#  R E D I S   C A C H E   T E S T   C A S E S
+######################################################################
+
+
+class TestRedisCache(unittest.TestCase):
+    """Test Cases for the Redis Cache, over a fake Redis server"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.server = fakeredis.FakeServer()
+        self.cache = self.redis_cache()
+
+    def redis_cache(self) -> RedisCache:
+        """Returns a RedisCache connected to the fake server, as a worker would be"""
+        cache = RedisCache("redis://localhost:6379/0", ttl=60)
+        cache.client = fakeredis.FakeStrictRedis(server=self.server)
+        return cache
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+    def test_get_and_set(self):
+        """It should store values as JSON that expire after the ttl"""
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", [{"id": 1, "price": 12.5, "rating": None}])
+        self.assertEqual(self.cache.get("a"), [{"id": 1, "price": 12.5, "rating": None}])
+        self.assertTrue(0 < self.cache.client.ttl("products:a") <= 60)
+
+    def test_delete_and_clear(self):
+        """It should drop its own values and leave other keys alone"""
+        self.cache.client.set("other:a", "kept")
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.delete("a")
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.client.get("other:a"), b"kept")
+
+    def test_versions(self):
+        """It should bump scope versions that every worker sees"""
+        other_worker = self.redis_cache()
+        self.assertEqual(self.cache.versions(["a", "b"]), [0, 0])
+        self.assertEqual(self.cache.incr("a"), 1)
+        self.assertEqual(other_worker.incr("a"), 2)
+        self.cache.clear()
+        self.assertEqual(other_worker.versions(["a", "b"]), [2, 0])
+
+    def test_versions_expire(self):
+        """It should let versions nobody uses expire, long after their values"""
+        self.cache.incr("a")
+        self.cache.versions(["b"])
+        ttl = self.cache.client.ttl("products:v:a")
+        self.assertTrue(60 < ttl <= self.cache.version_ttl)
+        self.cache.client.expire("products:v:a", 5)
+        self.cache.versions(["a"])
+        self.assertGreater(self.cache.client.ttl("products:v:a"), 5)
+        self.assertFalse(self.cache.client.exists("products:v:b"))
+
+    def test_invalidate_across_workers(self):
+        """It should invalidate the values of every worker sharing Redis"""
+        worker1 = VersionedCache(LRUCache(), self.cache)
+        worker2 = VersionedCache(LRUCache(), self.redis_cache())
+        self.assertEqual(worker1.get_or_load("k", ["s"], lambda: 1), 1)
+        self.assertEqual(worker2.get_or_load("k", ["s"], lambda: 2), 1)
+        worker2.invalidate("s")
+        self.assertEqual(worker1.get_or_load("k", ["s"], lambda: 3), 3)
+
+    def test_create_cache_backend(self):
+        """It should only create a shared backend for CACHE_BACKEND=redis"""
+        self.assertIsNone(create_cache_backend({"CACHE_BACKEND": "memory"}, 30))
+        backend = create_cache_backend({"CACHE_BACKEND": "redis", "CACHE_URL": "redis://localhost:6379/0"}, 30)
+        self.assertIsInstance(backend, RedisCache)
+
+    def test_abstract_backend(self):
+        """It should not create a backend that leaves methods out"""
+        self.assertRaises(TypeError, CacheBackend)
+
+
+######################################################################
+#  V E R S I O N E D   C A C H E   T E S T   C A S E S
+######################################################################
+
+
+class TestVersionedCache(unittest.TestCase):
+    """Test Cases for the Versioned Cache"""
+
+    def setUp(self):
+        """This runs before each test"""
+        # two workers with their own local cache and a common shared backend
+        self.shared = LRUCache(max_size=100, ttl=60)
+        self.worker1 = VersionedCache(LRUCache(max_size=10, ttl=60), self.shared)
+        self.worker2 = VersionedCache(LRUCache(max_size=10, ttl=60), self.shared)
+        self.loads = 0
+
+    def load(self, value):
+        """Returns a loader counting how often the database is hit"""
+        def loader():
+            self.loads += 1
+            return value
+        return loader
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+    def test_read_through(self):
+        """It should load a value once and then serve it from the cache"""
+        self.assertEqual(self.worker1.get_or_load("k", ["s"], self.load(1)), 1)
+        self.assertEqual(self.worker1.get_or_load("k", ["s"], self.load(2)), 1)
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(self.worker1.stats()["hits"], 1)
+        self.assertEqual(self.worker1.stats()["misses"], 1)
+
+    def test_shared_between_workers(self):
+        """It should serve a value loaded by another worker"""
+        self.worker1.get_or_load("k", ["s"], self.load(1))
+        self.assertEqual(self.worker2.get_or_load("k", ["s"], self.load(2)), 1)
+        self.assertEqual(self.loads, 1)
+
+    def test_invalidate_across_workers(self):
+        """It should not serve a value from any worker after its scope changed"""
+        self.worker1.get_or_load("k", ["s", "t"], self.load(1))
+        self.worker2.get_or_load("k", ["s", "t"], self.load(1))
+        self.worker1.invalidate("t")
+        self.assertEqual(self.worker2.get_or_load("k", ["s", "t"], self.load(2)), 2)
+        self.assertEqual(self.worker1.get_or_load("k", ["s", "t"], self.load(3)), 2)
+        self.worker2.get_or_load("other", ["u"], self.load(4))
+        self.worker2.invalidate("t")
+        self.assertEqual(self.worker1.get_or_load("other", ["u"], self.load(5)), 4)
+
+    def test_write_during_load(self):
+        """It should not cache a value loaded while another worker wrote"""
+        def racing_loader():
+            self.worker2.invalidate("s")
+            return "old"
+
+        self.assertEqual(self.worker1.get_or_load("k", ["s"], racing_loader), "old")
+        self.assertEqual(self.worker1.get_or_load("k", ["s"], self.load("new")), "new")
+
+    def test_disabled(self):
+        """It should always load when disabled"""
+        cache = VersionedCache(enabled=False)
+        cache.get_or_load("k", ["s"], self.load(1))
+        cache.get_or_load("k", ["s"], self.load(1))
+        self.assertEqual(self.loads, 2)
+
+    def test_backend_failure(self):
+        """It should fall back to loading when the shared backend fails"""
+        def fail(*args):
+            raise ConnectionError("redis is down")
+
+        self.shared.versions = fail
+        self.assertEqual(self.worker1.get_or_load("k", ["s"], self.load(1)), 1)
+        self.assertEqual(self.worker1.stats()["errors"], 1)
@@ -0,0 +1,108 @@
+"""
+Test cases for the sizing of the gunicorn workers
+
+"""
+import os
+import tempfile
+import unittest
+import unittest.mock
+import importlib.util
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py")
+
+
+def load_config():
+    """Imports gunicorn.conf.py, which is not a module of a package"""
+    spec = importlib.util.spec_from_file_location("gunicorn_conf", CONFIG_PATH)
+    config = importlib.util.module_from_spec(spec)
+    with unittest.mock.patch.dict(os.environ):  # it sets PROMETHEUS_MULTIPROC_DIR
+        spec.loader.exec_module(config)
+    return config
+
+
+MIB = 1024 * 1024
+
+######################################################################
+#  G U N I C O R N   C O N F I G U R A T I O N   T E S T   C A S E S
+######################################################################
+
+
+class TestGunicornConfig(unittest.TestCase):
+    """Test Cases for the gunicorn configuration"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.config = load_config()
+        self.cgroup = tempfile.TemporaryDirectory()
+        self.root = self.cgroup.name
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.cgroup.cleanup()
+
+    def write(self, path: str, content: str):
+        """Writes a file of the fake cgroup"""
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="ascii") as cgroup_file:
+            cgroup_file.write(content + "\n")
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+    def test_cgroup_v2_limits(self):
+        """It should read the CPU and memory limits of cgroup v2"""
+        self.write("cpu.max", "20000 100000")
+        self.write("memory.max", str(64 * MIB))
+        self.assertAlmostEqual(self.config.cgroup_cpus(self.root), 0.2)
+        self.assertEqual(self.config.cgroup_memory(self.root), 64 * MIB)
+
+    def test_cgroup_v2_unlimited(self):
+        """It should report no limit when cgroup v2 has none"""
+        self.write("cpu.max", "max 100000")
+        self.write("memory.max", "max")
+        self.assertIsNone(self.config.cgroup_cpus(self.root))
+        self.assertIsNone(self.config.cgroup_memory(self.root))
+
+    def test_cgroup_v1_limits(self):
+        """It should read the CPU and memory limits of cgroup v1"""
+        self.write("cpu/cpu.cfs_quota_us", "150000")
+        self.write("cpu/cpu.cfs_period_us", "100000")
+        self.write("memory/memory.limit_in_bytes", str(512 * MIB))
+        self.assertAlmostEqual(self.config.cgroup_cpus(self.root), 1.5)
+        self.assertEqual(self.config.cgroup_memory(self.root), 512 * MIB)
+
+        self.write("cpu/cpu.cfs_quota_us", "-1")
+        self.write("memory/memory.limit_in_bytes", "9223372036854771712")
+        self.assertIsNone(self.config.cgroup_cpus(self.root))
+        self.assertIsNone(self.config.cgroup_memory(self.root))
+
+    def test_no_cgroup(self):
+        """It should report no limit outside a container"""
+        self.assertIsNone(self.config.cgroup_cpus(self.root))
+        self.assertIsNone(self.config.cgroup_memory(self.root))
+
+    def test_worker_count(self):
+        """It should run 2 x CPUs + 1 workers that fit in memory"""
+        self.assertEqual(self.config.worker_count(0.2, 64 * MIB), 1)
+        self.assertEqual(self.config.worker_count(2), 5)
+        self.assertEqual(self.config.worker_count(2, 128 * MIB, 48 * MIB), 2)
+        self.assertEqual(self.config.worker_count(4, 16 * MIB), 1)
+
+    def test_environment(self):
+        """It should take its settings from the environment"""
+        environment = {"GUNICORN_WORKER_CLASS": "sync", "GUNICORN_WORKERS": "3", "GUNICORN_PRELOAD": "false",
+                       "GUNICORN_MAX_REQUESTS": "0", "PORT": "9000"}
+        with unittest.mock.patch.dict(os.environ, environment):
+            config = load_config()
+        self.assertEqual(config.worker_class, "sync")
+        self.assertEqual(config.workers, 3)
+        self.assertEqual(config.threads, 1)
+        self.assertFalse(config.preload_app)
+        self.assertEqual(config.max_requests, 0)
+        self.assertEqual(config.bind, "0.0.0.0:9000")
+
+    def test_unknown_worker_class(self):
+        """It should refuse a worker class it was not sized for"""
+        with unittest.mock.patch.dict(os.environ, {"GUNICORN_WORKER_CLASS": "eventlet"}):
+            self.assertRaises(ValueError, load_config)
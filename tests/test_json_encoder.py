@@ -0,0 +1,79 @@
+"""
+Test cases for the JSON Encoder
+
+"""
+import json
+import unittest
+from datetime import date
+from decimal import Decimal
+
+from flask import Flask, jsonify
+from flask.json import JSONEncoder
+
+from service.utils.json_encoder import FastJSONEncoder, select_json_encoder
+
+PRODUCTS = [
+    {
+        "id": 1,
+        "name": "shoe",
+        "description": "unavailable",
+        "category": "shoes",
+        "price": 10.0,
+        "available": True,
+        "rating": None,
+        "no_of_users_rated": 0,
+    },
+    {"price": 99.99, "rating": 4.333333333333333, "available": False, "id": 2},
+]
+
+######################################################################
+#  J S O N   E N C O D E R   T E S T   C A S E S
+######################################################################
+
+
+class TestJSONEncoder(unittest.TestCase):
+    """Test Cases for the JSON Encoder"""
+
+    def assert_same_encoding(self, value, **kwargs):
+        """Asserts that both encoders produce the same document"""
+        expected = json.dumps(value, cls=JSONEncoder, **kwargs)
+        self.assertEqual(json.dumps(value, cls=FastJSONEncoder, **kwargs), expected)
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+    def test_same_as_stdlib(self):
+        """It should encode products exactly like the stdlib encoder"""
+        compact = {"separators": (",", ":")}
+        self.assert_same_encoding(PRODUCTS, sort_keys=True, **compact)
+        self.assert_same_encoding(PRODUCTS, sort_keys=False, **compact)
+        self.assert_same_encoding({"id": 1, "price": 12.5}, sort_keys=True)
+        self.assert_same_encoding(PRODUCTS, indent=2, **compact)
+        self.assert_same_encoding({1: "one", "name": "été"}, **compact)
+        self.assert_same_encoding({"name": "été"}, ensure_ascii=False, **compact)
+        self.assert_same_encoding([2 ** 70, Decimal("1.50"), date(2022, 5, 1)], **compact)
+
+    def test_non_finite_floats(self):
+        """It should encode NaN and infinity as null, unlike the stdlib encoder"""
+        values = [float("nan"), float("inf"), -float("inf")]
+        compact = {"separators": (",", ":")}
+        self.assertEqual(json.dumps(values, cls=FastJSONEncoder, **compact), "[null,null,null]")
+        self.assertEqual(json.dumps(values, cls=JSONEncoder, **compact), "[NaN,Infinity,-Infinity]")
+
+    def test_unserializable(self):
+        """It should still refuse values JSON cannot represent"""
+        self.assertRaises(TypeError, json.dumps, object(), cls=FastJSONEncoder, separators=(",", ":"))
+
+    def test_select_json_encoder(self):
+        """It should select the encoder named by JSON_ENCODER"""
+        self.assertIs(select_json_encoder("stdlib"), JSONEncoder)
+        self.assertIs(select_json_encoder("orjson"), FastJSONEncoder)
+        self.assertIs(select_json_encoder(), FastJSONEncoder)
+
+    def test_jsonify(self):
+        """It should be used by jsonify"""
+        app = Flask(__name__)
+        app.json_encoder = FastJSONEncoder
+        with app.app_context():
+            response = jsonify(PRODUCTS)
+        self.assertEqual(json.loads(response.data), PRODUCTS)
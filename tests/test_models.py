@@ -8,14 +8,16 @@ Test cases for Product Model
 import os
 import logging
 import unittest
+import threading
 
 from random import randint
 
 # from sqlalchemy import true
 # from sqlalchemy import null
 from werkzeug.exceptions import NotFound
-from service.models import Product, DataValidationError, db
+from service.models import Product, DataValidationError, DataConflictError, db, cache, suggestions
 from service import app
+from sqlalchemy import create_engine, select, text
 from tests.factories import ProductFactory
 
 DATABASE_URI = os.getenv(
@@ -37,6 +39,8 @@ class TestProduct(unittest.TestCase):
         app.config["DEBUG"] = False
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
+        cls.context = app.app_context()
+        cls.context.push()
         Product.init_db(app)
         # pass
 
@@ -44,11 +48,14 @@ class TestProduct(unittest.TestCase):
     def tearDownClass(cls):
         """This runs once after the entire test suite"""
         db.session.close()
+        cls.context.pop()
 
     def setUp(self):
         """This runs before each test"""
         db.session.query(Product).delete()  # clean up the last tests
         db.session.commit()
+        cache.clear()
+        suggestions.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -420,3 +427,339 @@ class TestProduct(unittest.TestCase):
         self.assertEqual(found.count(), count)
         for product in found:
             self.assertTrue(product.available)
+
+    def test_find_by_criteria(self):
+        """It should Find Products matching several criteria at once"""
+        products = ProductFactory.create_batch(10)
+        for product in products:
+            product.create()
+        category = products[0].category
+        price = products[0].price
+        count = len(
+            [
+                product
+                for product in products
+                if product.category == category
+                and product.price <= price
+                and product.available is True
+            ]
+        )
+        found = Product.find_by_criteria(
+            {"category": category, "price": price, "available": True, "rating": None}
+        )
+        self.assertEqual(found.count(), count)
+        for product in found:
+            self.assertEqual(product.category, category)
+            self.assertGreaterEqual(price, product.price)
+            self.assertTrue(product.available)
+
+    def test_find_by_criteria_bad_filter(self):
+        """It should not Find Products with an unknown criterion"""
+        self.assertRaises(
+            DataValidationError, Product.find_by_criteria, {"colour": "red"}
+        )
+
+    def test_find_by_criteria_paginated(self):
+        """It should return Products one keyset page at a time"""
+        products = ProductFactory.create_batch(7)
+        for product in products:
+            product.create()
+        ids = sorted(product.id for product in products)
+        page = Product.find_by_criteria({}, limit=3).all()
+        self.assertEqual([product.id for product in page], ids[:3])
+        page = Product.find_by_criteria({}, after=page[-1].id, limit=3).all()
+        self.assertEqual([product.id for product in page], ids[3:6])
+        page = Product.find_by_availability(after=ids[5], limit=3).all()
+        for product in page:
+            self.assertGreater(product.id, ids[5])
+            self.assertTrue(product.available)
+
+    def test_create_many_products(self):
+        """It should Create many Products in batches and skip existing names"""
+        existing = ProductFactory()
+        existing.create()
+        products = ProductFactory.create_batch(5)
+        duplicate = ProductFactory(name=existing.name)
+        created = Product.create_many(products + [duplicate], batch_size=2)
+        self.assertEqual(len(created), 5)
+        self.assertNotIn(existing.name, created)
+        self.assertEqual(len(Product.all()), 6)
+        for product in products:
+            found = Product.find(created[product.name])
+            self.assertEqual(found.name, product.name)
+            self.assertEqual(found.category, product.category)
+            self.assertAlmostEqual(found.price, product.price)
+
+    def test_check_required(self):
+        """It should not accept a Product without its required fields"""
+        product = Product().deserialize({"name": "shirt", "category": "men's clothing"})
+        self.assertRaises(DataValidationError, product.check_required)
+
+    def test_update_many_products(self):
+        """It should Update every matching Product in one statement"""
+        products = ProductFactory.create_batch(6)
+        for product in products:
+            product.create()
+        category = products[0].category
+        count = len([product for product in products if product.category == category])
+        updated = Product.update_many({"category": category}, {"price": 42.0, "available": False})
+        self.assertEqual(updated, count)
+        db.session.expire_all()
+        for product in Product.find_by_category(category):
+            self.assertEqual(product.price, 42.0)
+            self.assertFalse(product.available)
+
+    def test_update_many_bad_changes(self):
+        """It should not Update Products in bulk with bad changes or no criteria"""
+        self.assertRaises(DataValidationError, Product.update_many, {}, {"price": 42.0})
+        self.assertRaises(DataValidationError, Product.update_many, {"ids": [1]}, {"name": "x"})
+        self.assertRaises(DataValidationError, Product.update_many, {"ids": [1]}, {"price": 1000.0})
+        self.assertRaises(DataValidationError, Product.update_many, {"ids": [1]}, {"category": "c" * 64})
+        self.assertRaises(DataValidationError, Product.update_many, {"ids": [1]}, {"description": "d" * 64})
+
+    def test_delete_many_products(self):
+        """It should Delete every matching Product in one statement"""
+        products = ProductFactory.create_batch(5)
+        for product in products:
+            product.create()
+        deleted = Product.delete_many({"ids": [products[0].id, products[1].id]})
+        self.assertEqual(deleted, 2)
+        self.assertEqual(len(Product.all()), 3)
+        self.assertRaises(DataValidationError, Product.delete_many, {})
+
+    def test_add_rating(self):
+        """It should add ratings to the running average atomically"""
+        product = ProductFactory(rating=None, no_of_users_rated=0)
+        product.create()
+        product = Product.add_rating(product.id, 2)
+        self.assertEqual(product.rating, 2.0)
+        self.assertEqual(product.no_of_users_rated, 1)
+        product = Product.add_rating(product.id, 5)
+        self.assertAlmostEqual(product.rating, 3.5)
+        self.assertEqual(product.no_of_users_rated, 2)
+        self.assertAlmostEqual(product.rating_sum, 7.0)
+        self.assertIsNone(Product.add_rating(0, 3))
+
+    def test_add_rating_concurrently(self):
+        """It should not lose ratings sent concurrently"""
+        product = Product().deserialize(
+            {"name": "shirt", "category": "men's clothing", "price": 20.0,
+             "rating": 4.0, "no_of_users_rated": 2}
+        )
+        product.create()
+        product_id = product.id
+
+        def rate():
+            with app.app_context():
+                for _ in range(10):
+                    Product.add_rating(product_id, 1)
+                db.session.remove()
+
+        threads = [threading.Thread(target=rate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db.session.expire_all()
+        product = Product.find(product_id)
+        self.assertEqual(product.no_of_users_rated, 42)
+        self.assertAlmostEqual(product.rating, (4.0 * 2 + 40) / 42)
+
+    def test_add_coalesced_ratings(self):
+        """It should add coalesced ratings to many Products in one statement"""
+        products = ProductFactory.create_batch(3)
+        for product in products:
+            product.rating = None
+            product.no_of_users_rated = 0
+            product.create()
+        products[1].deserialize({"rating": 2.0, "no_of_users_rated": 2})
+        products[1].update()
+        updated = Product.add_ratings({products[0].id: (9, 2), products[1].id: (8, 2), 0: (5, 1)})
+        self.assertEqual(updated, 2)
+        db.session.expire_all()
+        product = Product.find(products[0].id)
+        self.assertEqual(product.no_of_users_rated, 2)
+        self.assertAlmostEqual(product.rating, 4.5)
+        product = Product.find(products[1].id)
+        self.assertEqual(product.no_of_users_rated, 4)
+        self.assertAlmostEqual(product.rating, 3.0)
+        self.assertIsNone(Product.find(products[2].id).rating)
+        ratings = {match["id"]: match["rating"] for match in Product.suggest("")}
+        self.assertAlmostEqual(ratings[products[0].id], 4.5)
+        self.assertAlmostEqual(ratings[products[1].id], 3.0)
+
+    def test_find_from_cache(self):
+        """It should Find a Product from the cache and still update it"""
+        product = ProductFactory()
+        product.create()
+        product_id = product.id
+        db.session.remove()
+        Product.find(product_id)
+        db.session.remove()
+        hits = cache.stats()["hits"]
+        found = Product.find(product_id)
+        self.assertEqual(cache.stats()["hits"], hits + 1)
+        self.assertEqual(found.name, product.name)
+        found.category = "k9"
+        found.update()
+        db.session.remove()
+        found = Product.find(product_id)
+        self.assertEqual(found.category, "k9")
+
+    def test_cached_listing_invalidated(self):
+        """It should not serve a cached listing after a write"""
+        products = ProductFactory.create_batch(3)
+        for product in products:
+            product.create()
+        self.assertEqual(len(Product.list_serialized({})), 3)
+        hits = cache.stats()["hits"]
+        self.assertEqual(len(Product.list_serialized({})), 3)
+        self.assertEqual(cache.stats()["hits"], hits + 1)
+        products[0].delete()
+        self.assertEqual(len(Product.list_serialized({})), 2)
+
+    def test_update_stale_product(self):
+        """It should raise a DataConflictError for a Product changed elsewhere"""
+        product = ProductFactory()
+        product.create()
+        self.assertEqual(product.etag, f"{product.id}-1")
+        with db.engine.begin() as connection:
+            connection.execute(
+                text("UPDATE product SET version = version + 1 WHERE id = :id"),
+                {"id": product.id},
+            )
+        product.price = 1.0
+        self.assertRaises(DataConflictError, product.update)
+        found = Product.find(product.id)
+        self.assertEqual(found.version, 2)
+
+    def test_iter_serialized(self):
+        """It should yield every matching Product a batch at a time"""
+        products = ProductFactory.create_batch(5)
+        for product in products:
+            product.available = True
+            product.create()
+        rows = list(Product.iter_serialized({"available": True}, batch_size=2))
+        self.assertEqual([row["id"] for row in rows], sorted(p.id for p in products))
+        rows = list(Product.iter_serialized({}, after=rows[0]["id"], limit=3, batch_size=2))
+        self.assertEqual(len(rows), 3)
+
+    def test_select_rows(self):
+        """It should select only the requested fields as plain rows"""
+        product = ProductFactory()
+        product.create()
+        fields, statement = Product.select_rows({"name": product.name}, ("price", "name", "price"))
+        self.assertEqual(fields, ("id", "price", "name"))
+        rows = db.session.execute(statement).all()
+        self.assertEqual(rows, [(product.id, product.price, product.name)])
+        self.assertEqual(
+            Product.list_serialized({}, fields=("name",)),
+            [{"id": product.id, "name": product.name}],
+        )
+        self.assertEqual(Product.list_serialized({}), [product.serialize()])
+        self.assertRaises(DataValidationError, Product.select_rows, {}, ("rating_sum",))
+
+    def test_find_by_criteria_sorted(self):
+        """It should page through Products in sort order with missing ratings last"""
+        ratings = [4.0, None, 2.0, 4.0, None, 5.0]
+        products = ProductFactory.create_batch(len(ratings))
+        for product, rating in zip(products, ratings):
+            product.rating = rating
+            product.create()
+        rated = sorted((p.rating, p.id) for p in products if p.rating is not None)
+        unrated = sorted(p.id for p in products if p.rating is None)
+        orders = {
+            "rating": [id for _, id in rated] + unrated,
+            "-rating": [id for _, id in reversed(rated)] + unrated[::-1],
+        }
+        for sort, expected in orders.items():
+            seen = []
+            after = None
+            while True:
+                page = Product.list_serialized({}, after, 2, ("rating",), sort)
+                if not page:
+                    break
+                seen.extend(row["id"] for row in page)
+                after = (page[-1]["rating"], page[-1]["id"])
+            self.assertEqual(seen, expected)
+        prices = [p.price for p in Product.find_by_criteria({}, sort="-price", limit=3)]
+        self.assertEqual(prices, sorted((p.price for p in products), reverse=True)[:3])
+        self.assertRaises(DataValidationError, Product.find_by_criteria, {}, sort="description")
+
+    def test_search_fallback(self):
+        """It should search with LIKE on databases without full-text search"""
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(
+                Product.__table__.insert(),
+                [
+                    {"name": "Red running shoe", "description": "light", "category": "c", "price": 20.0},
+                    {"name": "Blue jacket", "description": "runs small", "category": "c", "price": 30.0},
+                    {"name": "Green hat", "description": "red_ish", "category": "c", "price": 40.0},
+                ],
+            )
+            criteria = {"q_prefix": "run"}
+            statement = (
+                select(Product.name)
+                .where(Product.search_clause("run", prefix=True, dialect="sqlite"))
+                .order_by(Product.search_rank(criteria, dialect="sqlite").desc())
+            )
+            self.assertEqual(connection.execute(statement).scalars().all(), ["Red running shoe", "Blue jacket"])
+            statement = select(Product.name).where(Product.search_clause("red shoe", dialect="sqlite"))
+            self.assertEqual(connection.execute(statement).scalars().all(), ["Red running shoe"])
+            statement = select(Product.name).where(Product.search_clause("ish", prefix=True, dialect="sqlite"))
+            self.assertEqual(connection.execute(statement).scalars().all(), [])
+            statement = select(Product.name).where(Product.search_clause("--", dialect="sqlite"))
+            self.assertEqual(connection.execute(statement).scalars().all(), [])
+
+    def test_suggest(self):
+        """It should keep name suggestions up to date with every write"""
+        product = ProductFactory(name="Running shoe", rating=4.0)
+        product.create()
+        other = ProductFactory(name="Running jacket", rating=4.5)
+        other.create()
+        self.assertEqual([match["id"] for match in Product.suggest("run")], [other.id, product.id])
+        product.name = "Trail shoe"
+        product.update()
+        self.assertEqual([match["id"] for match in Product.suggest("run")], [other.id])
+        self.assertEqual(Product.suggest("trail")[0]["name"], "Trail shoe")
+        other.delete()
+        self.assertEqual(Product.suggest("run"), [])
+        db.session.execute(text("INSERT INTO product (name, category, price, available, no_of_users_rated) "
+                                "VALUES ('Rugby ball', 'c', 20, true, 0)"))
+        db.session.commit()
+        self.assertEqual(Product.suggest("rug"), [])
+        suggestions.expire()
+        self.assertEqual(Product.suggest("rug")[0]["name"], "Rugby ball")
+
+    def test_category_summary(self):
+        """It should keep the category summary in step with every kind of write"""
+        products = ProductFactory.create_batch(6)
+        for product in products[:4]:
+            product.create()
+        Product.create_many(products[4:])
+        products[0].price = 99.0
+        products[0].category = "hats"
+        products[0].update()
+        products[1].delete()
+        Product.add_rating(products[2].id, 5)
+        Product.add_ratings({products[3].id: (9, 2)})
+        Product.update_many({"ids": [products[4].id]}, {"category": "hats", "available": True})
+        Product.delete_many({"ids": [products[5].id]})
+
+        expected = {
+            category: {key: facet[key] for key in ("count", "available", "avg_price", "avg_rating")}
+            for category, facet in Product.stats()["categories"].items()
+        }
+        summary = Product.category_summary()
+        self.assertEqual(set(summary), set(expected))
+        for category, facet in expected.items():
+            for key, value in facet.items():
+                if value is None:
+                    self.assertIsNone(summary[category][key])
+                else:
+                    self.assertAlmostEqual(summary[category][key], value)
+        Product.query.delete()
+        db.session.commit()
+        self.assertEqual(Product.category_summary(), {})
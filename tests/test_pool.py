@@ -0,0 +1,59 @@
+"""
+Test cases for the instrumented connection pool
+
+"""
+import sqlite3
+import unittest
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from service.utils.pool import InstrumentedQueuePool
+
+######################################################################
+#  C O N N E C T I O N   P O O L   T E S T   C A S E S
+######################################################################
+
+
+class TestInstrumentedQueuePool(unittest.TestCase):
+    """Test Cases for the instrumented connection pool"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.pool = InstrumentedQueuePool(
+            lambda: sqlite3.connect(":memory:", check_same_thread=False),
+            pool_size=1,
+            max_overflow=1,
+            timeout=0.05,
+        )
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.pool.dispose()
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+    def test_checkouts(self):
+        """It should count checkouts and the connections in use"""
+        first = self.pool.connect()
+        second = self.pool.connect()
+        stats = self.pool.stats()
+        self.assertEqual(stats["checkouts"], 2)
+        self.assertEqual(stats["checked_out"], 2)
+        self.assertEqual(stats["overflow"], 1)
+        self.assertEqual(stats["timeouts"], 0)
+        first.close()
+        second.close()
+        stats = self.pool.stats()
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertGreaterEqual(stats["wait_seconds_total"], stats["wait_seconds_max"])
+
+    def test_checkout_timeout(self):
+        """It should count checkouts that time out waiting for a connection"""
+        connections = [self.pool.connect(), self.pool.connect()]
+        self.assertRaises(PoolTimeoutError, self.pool.connect)
+        stats = self.pool.stats()
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertGreaterEqual(stats["wait_seconds_max"], 0.05)
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,87 @@
+"""
+Test cases for the Prefix Index
+
+"""
+import threading
+import unittest
+
+from service.utils.prefix_index import PrefixIndex
+
+######################################################################
+#  P R E F I X   I N D E X   T E S T   C A S E S
+######################################################################
+
+
+class TestPrefixIndex(unittest.TestCase):
+    """Test Cases for the Prefix Index"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.index = PrefixIndex(max_age=60)
+        self.index.load(
+            [
+                (1, "Running shoe", 4.0),
+                (2, "Running jacket", 4.5),
+                (3, "Rugby ball", None),
+                (4, "running socks", 3.0),
+                (5, "Hat", 5.0),
+            ]
+        )
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+    def test_suggest(self):
+        """It should return the best rated names starting with a prefix"""
+        names = [match["name"] for match in self.index.suggest("RUN")]
+        self.assertEqual(names, ["Running jacket", "Running shoe", "running socks"])
+        self.assertEqual([match["id"] for match in self.index.suggest("ru", 2)], [2, 1])
+        self.assertEqual(self.index.suggest("rug"), [{"id": 3, "name": "Rugby ball", "rating": None}])
+        self.assertEqual(self.index.suggest("x"), [])
+        self.assertEqual(len(self.index.suggest("")), 5)
+
+    def test_add_and_remove(self):
+        """It should update the index in place"""
+        self.index.add(6, "Rubber boots", 2.0)
+        self.index.add(1, "Trail shoe", 4.0)
+        self.index.remove(2)
+        self.index.remove(42)
+        names = [match["name"] for match in self.index.suggest("ru")]
+        self.assertEqual(names, ["running socks", "Rubber boots", "Rugby ball"])
+        self.assertEqual(self.index.suggest("trail")[0]["id"], 1)
+        self.assertEqual(len(self.index), 5)
+
+    def test_stale(self):
+        """It should need a reload once expired or too old"""
+        self.assertFalse(self.index.stale())
+        self.index.expire()
+        self.assertTrue(self.index.stale())
+        self.index.load([])
+        self.index.configure(-1)
+        self.assertTrue(self.index.stale())
+        self.index.clear()
+        self.assertEqual(len(self.index), 0)
+
+    def test_refresh(self):
+        """It should reload a stale index in one thread while the others keep the old one"""
+        self.assertFalse(self.index.refresh(lambda: self.fail("reloaded a fresh index")))
+        self.index.expire()
+        loading, release = threading.Event(), threading.Event()
+        loads = []
+
+        def fetch_rows():
+            loads.append(1)
+            loading.set()
+            release.wait(5)
+            return [(7, "Rucksack", 4.8)]
+
+        reloader = threading.Thread(target=self.index.refresh, args=(fetch_rows,))
+        reloader.start()
+        self.assertTrue(loading.wait(5))
+        self.assertFalse(self.index.refresh(fetch_rows))
+        self.assertEqual(len(self.index.suggest("ru")), 4)
+        release.set()
+        reloader.join(5)
+        self.assertEqual(loads, [1])
+        self.assertEqual(self.index.suggest("ru"), [{"id": 7, "name": "Rucksack", "rating": 4.8}])
+        self.assertFalse(self.index.stale())
@@ -0,0 +1,94 @@
+"""
+Test cases for the Rating Buffer
+
+"""
+import time
+import unittest
+
+from service.utils.rating_buffer import RatingBuffer
+
+######################################################################
+#  R A T I N G   B U F F E R   T E S T   C A S E S
+######################################################################
+
+
+class TestRatingBuffer(unittest.TestCase):
+    """Test Cases for the Rating Buffer"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.flushed = []
+        self.buffer = RatingBuffer(self.flushed.append, max_staleness=60, max_pending=100)
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.buffer.stop()
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+    def test_coalesce_ratings(self):
+        """It should coalesce ratings into one delta per product"""
+        for rating in [1, 2, 3]:
+            self.buffer.add(1, rating)
+        self.buffer.add(2, 5)
+        self.assertEqual(self.buffer.pending(), 4)
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.flushed, [{1: (6, 3), 2: (5, 1)}])
+        self.assertEqual(self.buffer.pending(), 0)
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(len(self.flushed), 1)
+
+    def test_flush_when_stale(self):
+        """It should flush on its own after max_staleness seconds"""
+        self.buffer.max_staleness = 0.05
+        self.buffer.add(1, 4)
+        deadline = time.time() + 5
+        while not self.flushed and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.flushed, [{1: (4, 1)}])
+
+    def test_flush_when_full(self):
+        """It should flush as soon as max_pending ratings are waiting"""
+        self.buffer.max_pending = 3
+        for _ in range(3):
+            self.buffer.add(7, 5)
+        deadline = time.time() + 5
+        while not self.flushed and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.flushed, [{7: (15, 3)}])
+
+    def test_requeue_on_failure(self):
+        """It should keep the ratings queued when a flush fails"""
+        def fail(deltas):
+            raise RuntimeError("database is down")
+
+        self.buffer.flush_function = fail
+        self.buffer.add(1, 2)
+        self.assertEqual(self.buffer.flush(), 0)
+        self.buffer.add(1, 4)
+        self.buffer.flush_function = self.flushed.append
+        self.buffer.flush()
+        self.assertEqual(self.flushed, [{1: (6, 2)}])
+
+    def test_requeue_is_capped(self):
+        """It should drop and count the ratings that do not fit back in the queue"""
+        def fail(deltas):
+            raise RuntimeError("database is down")
+
+        self.buffer.flush_function = fail
+        self.buffer.max_pending = 5
+        for product_id in range(4):
+            self.buffer.add(product_id, 3)
+        self.buffer.add(0, 2)
+        self.buffer.add(9, 1)
+        self.buffer.flush()
+        self.assertEqual(self.buffer.pending(), 5)
+        self.assertEqual(self.buffer.dropped(), 1)
+        self.buffer.flush_function = self.flushed.append
+
+    def test_flush_on_stop(self):
+        """It should write the waiting ratings when stopped"""
+        self.buffer.add(3, 1)
+        self.buffer.stop()
+        self.assertEqual(self.flushed, [{3: (1, 1)}])
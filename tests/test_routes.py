@@ -6,17 +6,19 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import json
 import logging
 from unittest import TestCase
 
 # from unittest.mock import MagicMock, patch
 from service import app
-from service.models import Product
+from service.models import Product, cache, suggestions
 from service.models import db, MIN_PRICE, MAX_PRICE, MAX_DESCRIPTION_LENGTH
-from service.routes import init_db
+from service.routes import encode_cursor, init_db, rating_buffer
 from service.utils import status
 from tests.factories import ProductFactory  # HTTP Status Codes
 from urllib.parse import quote_plus
+from sqlalchemy import text
 
 
 # DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
@@ -44,18 +46,23 @@ class TestYourResourceServer(TestCase):
         # Set up the test database
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
+        cls.context = app.app_context()
+        cls.context.push()
         init_db()
 
     @classmethod
     def tearDownClass(cls):
         """This runs once after the entire test suite"""
         db.session.close()
+        cls.context.pop()
 
     def setUp(self):
         """This runs before each test"""
         self.client = app.test_client()
         db.session.query(Product).delete()  # clean up the last tests
         db.session.commit()
+        cache.clear()
+        suggestions.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -137,6 +144,125 @@ class TestYourResourceServer(TestCase):
         self.assertEqual(new_product["available"], test_product.available)
         self.assertEqual(new_product["rating"], test_product.rating)
 
+    def test_create_products_in_bulk(self):
+        """It should Create many Products from a JSON array"""
+        test_products = [product.serialize() for product in ProductFactory.create_batch(5)]
+        response = self.client.post(f"{BASE_URL}/bulk", json=test_products)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        results = response.get_json()
+        self.assertEqual(len(results), 5)
+        for index, result in enumerate(results):
+            self.assertEqual(result["index"], index)
+            self.assertEqual(result["status"], status.HTTP_201_CREATED)
+            response = self.client.get(result["location"])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()["name"], test_products[index]["name"])
+
+    def test_create_products_in_bulk_too_long(self):
+        """It should reject only the bulk items with a field longer than its column"""
+        test_products = [product.serialize() for product in ProductFactory.create_batch(4)]
+        test_products[0]["name"] = "n" * 64
+        test_products[1]["description"] = "d" * (MAX_DESCRIPTION_LENGTH + 1)
+        test_products[2]["category"] = "c" * (MAX_CATEGORY_LENGTH + 1)
+        response = self.client.post(f"{BASE_URL}/bulk", json=test_products)
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.get_json()
+        self.assertEqual(
+            [result["status"] for result in results],
+            [status.HTTP_400_BAD_REQUEST] * 3 + [status.HTTP_201_CREATED],
+        )
+        self.assertIn("[category]", results[2]["error"])
+
+    def test_create_products_in_bulk_ndjson(self):
+        """It should Create many Products from NDJSON and report every bad item"""
+        existing = self._create_products(1)[0]
+        good = ProductFactory().serialize()
+        bad_price = ProductFactory().serialize()
+        bad_price["price"] = "string"
+        duplicate = ProductFactory(name=existing.name).serialize()
+        lines = [json.dumps(good), "{not json", json.dumps(bad_price), json.dumps(duplicate)]
+        response = self.client.post(
+            f"{BASE_URL}/bulk", data="\n".join(lines), content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.get_json()
+        self.assertEqual(
+            [result["status"] for result in results],
+            [
+                status.HTTP_201_CREATED,
+                status.HTTP_400_BAD_REQUEST,
+                status.HTTP_400_BAD_REQUEST,
+                status.HTTP_409_CONFLICT,
+            ],
+        )
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 2)
+
+    def test_create_products_in_bulk_bad_body(self):
+        """It should not Create Products in bulk from a body that is not a list"""
+        response = self.client.post(f"{BASE_URL}/bulk", json={"name": "shirt"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/bulk", data="[]", content_type="text/plain")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_update_products_in_bulk(self):
+        """It should Update the price of a whole category at once"""
+        products = self._create_products(6)
+        test_category = products[0].category
+        count = len([product for product in products if product.category == test_category])
+        response = self.client.patch(
+            f"{BASE_URL}/bulk",
+            json={"filter": {"category": test_category}, "set": {"price": int(MIN_PRICE)}},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["updated"], count)
+        response = self.client.get(BASE_URL, query_string={"category": test_category})
+        for product in response.get_json():
+            self.assertEqual(product["price"], float(MIN_PRICE))
+
+        response = self.client.patch(
+            f"{BASE_URL}/bulk", json={"ids": [products[0].id], "set": {"available": "no"}}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.patch(f"{BASE_URL}/bulk", json={"set": {"available": False}})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_products_in_bulk_bad_filter(self):
+        """It should not Update Products in bulk with a malformed filter"""
+        self._create_products(2)
+        for criteria in (
+            {"price": "abc"},
+            {"price": -1},
+            {"rating": 6},
+            {"q": 5},
+            {"category": ["a"]},
+            {"available": "yes"},
+            {"ids": "all"},
+        ):
+            response = self.client.patch(
+                f"{BASE_URL}/bulk", json={"filter": criteria, "set": {"available": False}}
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, criteria)
+            response = self.client.delete(f"{BASE_URL}/bulk", json={"filter": criteria})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, criteria)
+        response = self.client.patch(
+            f"{BASE_URL}/bulk",
+            json={"filter": {"price": 1000}, "set": {"description": "d" * (MAX_DESCRIPTION_LENGTH + 1)}},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_delete_products_in_bulk(self):
+        """It should Delete a list of Products at once"""
+        products = self._create_products(4)
+        response = self.client.delete(
+            f"{BASE_URL}/bulk", json={"ids": [products[0].id, products[1].id]}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["deleted"], 2)
+        response = self.client.get(BASE_URL)
+        self.assertEqual(len(response.get_json()), 2)
+        response = self.client.delete(f"{BASE_URL}/bulk", json={"ids": "all"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_delete_product(self):
         """It should Delete a Product"""
         test_product = self._create_products(1)[0]
@@ -243,6 +369,45 @@ class TestYourResourceServer(TestCase):
         data = response.get_json()
         self.assertEqual(len(data), len(target_products))
 
+    def test_query_category_price_available(self):
+        """It should Query Products by Category, Price and Availability together"""
+        products = self._create_products(10)
+        test_category = products[0].category
+        test_price = products[0].price
+        target_products = [
+            product for product in products
+            if product.category == test_category
+            and product.price <= test_price
+            and product.available is True
+        ]
+        response = self.client.get(
+            BASE_URL,
+            query_string={"category": test_category, "price": test_price, "available": "True"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(
+            sorted(product["id"] for product in data),
+            sorted(product.id for product in target_products),
+        )
+
+    def test_get_product_list_paginated(self):
+        """It should Get a list of Products one page at a time"""
+        products = self._create_products(7)
+        response = self.client.get(BASE_URL, query_string="limit=3")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        seen = [product["id"] for product in response.get_json()]
+        self.assertEqual(len(seen), 3)
+        while "Link" in response.headers:
+            self.assertIn('rel="next"', response.headers["Link"])
+            cursor = response.headers["X-Next-Cursor"]
+            response = self.client.get(
+                BASE_URL, query_string={"limit": 3, "after": cursor}
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(product["id"] for product in response.get_json())
+        self.assertEqual(seen, sorted(product.id for product in products))
+
     def test_query_list_by_availability(self):
         """It should Query Products by Availability"""
         products = self._create_products(10)
@@ -299,6 +464,48 @@ class TestYourResourceServer(TestCase):
         updated_product = response.get_json()
         self.assertAlmostEqual(updated_product["rating"], 3)
 
+    def test_buffered_rating(self):
+        """It should queue ratings and write them together in buffered mode"""
+        test_product = self._create_products(1)[0]
+        self.client.put(
+            f"{BASE_URL}/{test_product.id}", json={"rating": None, "no_of_users_rated": 0}
+        )
+        app.config["RATING_INGESTION"] = "buffered"
+        try:
+            for rating in [2, 3, 4]:
+                response = self.client.put(
+                    f"{BASE_URL}/{test_product.id}/rating", json={"rating": rating}
+                )
+                self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        finally:
+            app.config["RATING_INGESTION"] = "direct"
+        rating_buffer.flush()
+        db.session.expire_all()
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        product = response.get_json()
+        self.assertEqual(product["no_of_users_rated"], 3)
+        self.assertAlmostEqual(product["rating"], 3.0)
+
+    def test_buffered_rating_checks(self):
+        """It should refuse unknown products and apply If-Match at once in buffered mode"""
+        test_product = self._create_products(1)[0]
+        etag = self.client.get(f"{BASE_URL}/{test_product.id}").headers["ETag"]
+        app.config["RATING_INGESTION"] = "buffered"
+        try:
+            response = self.client.put(f"{BASE_URL}/0/rating", json={"rating": 3})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.put(
+                f"{BASE_URL}/{test_product.id}/rating", json={"rating": 3}, headers={"If-Match": etag}
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.put(
+                f"{BASE_URL}/{test_product.id}/rating", json={"rating": 3}, headers={"If-Match": etag}
+            )
+            self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        finally:
+            app.config["RATING_INGESTION"] = "direct"
+        self.assertEqual(rating_buffer.pending(), 0)
+
     def test_update_price(self):
         """It should update the price of a product"""
         # create a product to update
@@ -522,6 +729,12 @@ class TestYourResourceServer(TestCase):
         response = self.client.put(f"{BASE_URL}/{wrong_id}/rating", json=myJson)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_user_sends_bad_rating_of_invalid_product_id(self):
+        """It should answer 404_NOT_FOUND for an unknown product before checking the rating"""
+        for rating in ["FalseRating", -1, None]:
+            response = self.client.put(f"{BASE_URL}/0/rating", json={"rating": rating})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_user_sends_incorrect_availability_param(self):
         """The user sends an incorrect availability Parameter"""
         response = self.client.get(BASE_URL, query_string="available=IncorrectString")
@@ -634,3 +847,351 @@ class TestYourResourceServer(TestCase):
         new_product["category"] = "a"*(MAX_CATEGORY_LENGTH+1)
         response = self.client.put(f"{BASE_URL}/{id}/category", json=new_product)
         self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    def test_query_product_list_bad_page(self):
+        """It should return a 406_NOT_ACCEPTABLE error for a bad limit or cursor"""
+        response = self.client.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        response = self.client.get(BASE_URL, query_string="limit=many")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        response = self.client.get(BASE_URL, query_string="after=not-a-cursor")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        for sort, value in (("price", "abc"), ("price", [1]), ("rating", True), ("name", 5), ("price", None)):
+            cursor = encode_cursor({"id": 1, "value": value, "sort": sort})
+            response = self.client.get(BASE_URL, query_string={"sort": sort, "after": cursor})
+            self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE, (sort, value))
+        cursor = encode_cursor({"id": 1, "value": None, "sort": "rating"})
+        response = self.client.get(BASE_URL, query_string={"sort": "rating", "after": cursor})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_get_product_not_modified(self):
+        """It should return 304_NOT_MODIFIED for an unchanged Product"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response.headers["ETag"]
+        response = self.client.get(
+            f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.data, b"")
+
+        response = self.client.put(
+            f"{BASE_URL}/{test_product.id}/price", json={"price": 12.5}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        response = self.client.get(
+            f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_products_not_modified(self):
+        """It should return 304_NOT_MODIFIED for an unchanged listing"""
+        self._create_products(3)
+        response = self.client.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response.headers["ETag"]
+        response = self.client.get(
+            BASE_URL, query_string="limit=2", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(
+            BASE_URL, query_string="limit=3", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self._create_products(1)
+        response = self.client.get(
+            BASE_URL, query_string="limit=2", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_list_products_changed_by_another_process(self):
+        """It should not serve a cached listing under the ETag of a newer change"""
+        test_product = self._create_products(1)[0]
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 1)  # cached here
+        self.client.get(f"{BASE_URL}/stats")
+        # another worker changes the product, this cache is not told
+        db.session.execute(
+            text("UPDATE product SET price = 42.5 WHERE id = :id"), {"id": test_product.id}
+        )
+        db.session.commit()
+        response = self.client.get(BASE_URL)
+        self.assertEqual(response.get_json()[0]["price"], 42.5)
+        response = self.client.get(BASE_URL, headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        stats = self.client.get(f"{BASE_URL}/stats").get_json()
+        self.assertEqual(stats["categories"][test_product.category]["max_price"], 42.5)
+
+    def test_update_product_if_match(self):
+        """It should only update a Product whose ETag matches If-Match"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        etag = response.headers["ETag"]
+        response = self.client.put(
+            f"{BASE_URL}/{test_product.id}/description",
+            json={"description": "first"},
+            headers={"If-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.put(
+            f"{BASE_URL}/{test_product.id}/description",
+            json={"description": "second"},
+            headers={"If-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.put(
+            f"{BASE_URL}/{test_product.id}/rating",
+            json={"rating": 4},
+            headers={"If-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.get_json()["description"], "first")
+
+    def test_update_product_changed_by_another_process(self):
+        """It should check writes against the database, not a cached Product"""
+        test_product = self._create_products(1)[0]
+        self.client.get(f"{BASE_URL}/{test_product.id}")  # cached here
+        # another worker changes the product, this cache is not told
+        db.session.execute(
+            text("UPDATE product SET price = 40, version = version + 1 WHERE id = :id"),
+            {"id": test_product.id},
+        )
+        version = db.session.execute(
+            text("SELECT version FROM product WHERE id = :id"), {"id": test_product.id}
+        ).scalar()
+        db.session.commit()
+        db.session.expunge_all()
+        etag = f'"{test_product.id}-{version}"'
+        response = self.client.put(
+            f"{BASE_URL}/{test_product.id}/rating",
+            json={"rating": 4},
+            headers={"If-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        data["price"] = 50.0
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["price"], 50.0)
+
+    def test_stream_products_ndjson(self):
+        """It should stream every matching Product as NDJSON"""
+        app.config["DEFAULT_PAGE_SIZE"] = 2
+        try:
+            self._create_products(5)
+            response = self.client.get(
+                BASE_URL, headers={"Accept": "application/x-ndjson"}
+            )
+        finally:
+            app.config["DEFAULT_PAGE_SIZE"] = 100
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertIn("ETag", response.headers)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 5)
+        ids = [json.loads(line)["id"] for line in lines]
+        self.assertEqual(ids, sorted(ids))
+
+    def test_listing_representations(self):
+        """It should tag a page, a JSON stream and an NDJSON stream differently"""
+        self._create_products(2)
+        page = self.client.get(BASE_URL)
+        ndjson = {"Accept": "application/x-ndjson"}
+        etags = set()
+        for query_string, headers in (("", {}), ("", ndjson), ("stream=1", {}), ("stream=1", ndjson)):
+            response = self.client.get(BASE_URL, query_string=query_string, headers=headers)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIn("Accept", response.vary)
+            etags.add(response.headers["ETag"])
+            response.close()
+        self.assertEqual(len(etags), 4)
+        response = self.client.get(BASE_URL, headers=dict(ndjson, **{"If-None-Match": page.headers["ETag"]}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        response.close()
+        response = self.client.get(BASE_URL, headers={"If-None-Match": page.headers["ETag"]})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertIn("Accept", response.vary)
+
+    def test_stream_products_json(self):
+        """It should stream a listing as the same JSON array as a page"""
+        self._create_products(4)
+        page = self.client.get(BASE_URL, query_string="available=True")
+        response = self.client.get(BASE_URL, query_string="available=True&stream=1")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(response.data, page.data)
+        response = self.client.get(BASE_URL, query_string="stream=1&limit=2")
+        self.assertEqual(len(response.get_json()), 2)
+        response = self.client.get(BASE_URL, query_string="stream=1&limit=0")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    def test_query_product_list_fields(self):
+        """It should return only the requested fields of each Product"""
+        self._create_products(3)
+        response = self.client.get(BASE_URL, query_string="fields=name,price")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), 3)
+        for product in data:
+            self.assertEqual(set(product), {"id", "name", "price"})
+        response = self.client.get(
+            BASE_URL,
+            query_string="fields=category&limit=2",
+            headers={"Accept": "application/x-ndjson"},
+        )
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(set(json.loads(lines[0])), {"id", "category"})
+        self.assertEqual(len(lines), 2)
+        response = self.client.get(BASE_URL, query_string="fields=name,secret")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    def test_query_product_list_sorted(self):
+        """It should sort a listing in the database and page through it"""
+        products = self._create_products(7)
+        response = self.client.get(BASE_URL, query_string="sort=price&order=desc&limit=3")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        seen = [product["price"] for product in response.get_json()]
+        while "Link" in response.headers:
+            cursor = response.headers["X-Next-Cursor"]
+            response = self.client.get(
+                BASE_URL,
+                query_string={"sort": "price", "order": "desc", "limit": 3, "after": cursor},
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(product["price"] for product in response.get_json())
+        self.assertEqual(seen, sorted((product.price for product in products), reverse=True))
+
+        response = self.client.get(
+            BASE_URL, query_string={"sort": "name", "limit": 3, "after": cursor}
+        )
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        response = self.client.get(BASE_URL, query_string="sort=description")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        response = self.client.get(BASE_URL, query_string="sort=price&order=up")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    def test_search_products(self):
+        """It should search names and descriptions, most relevant first"""
+        catalog = [
+            ("Red running shoe", "light trainers"),
+            ("Blue running jacket", "waterproof"),
+            ("Shoe polish", "keeps red leather shiny"),
+        ]
+        for name, description in catalog:
+            product = ProductFactory(name=name, description=description)
+            response = self.client.post(BASE_URL, json=product.serialize())
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.get(BASE_URL, query_string="q=running")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        names = {product["name"] for product in response.get_json()}
+        self.assertEqual(names, {"Red running shoe", "Blue running jacket"})
+
+        response = self.client.get(BASE_URL, query_string="q=red&limit=1")
+        data = response.get_json()
+        self.assertEqual(data[0]["name"], "Red running shoe")
+        self.assertIn("rank", data[0])
+        response = self.client.get(
+            BASE_URL,
+            query_string={"q": "red", "limit": 1, "after": response.headers["X-Next-Cursor"]},
+        )
+        self.assertEqual([product["name"] for product in response.get_json()], ["Shoe polish"])
+        self.assertNotIn("Link", response.headers)
+
+        response = self.client.get(BASE_URL, query_string="q=sho&prefix=true&sort=name")
+        names = [product["name"] for product in response.get_json()]
+        self.assertEqual(names, ["Red running shoe", "Shoe polish"])
+        response = self.client.get(BASE_URL, query_string="q=sho")
+        self.assertEqual(response.get_json(), [])
+        response = self.client.get(BASE_URL, query_string="sort=rank")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    def test_suggest_products(self):
+        """It should complete product names, best rated first"""
+        for name, rating in (("Running shoe", 4.0), ("Running jacket", 4.5), ("Hat", 5.0)):
+            product = ProductFactory(name=name, rating=rating)
+            response = self.client.post(BASE_URL, json=product.serialize())
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get(f"{BASE_URL}/suggest", query_string="q=run")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([match["name"] for match in response.get_json()], ["Running jacket", "Running shoe"])
+        response = self.client.get(f"{BASE_URL}/suggest", query_string="q=RUN&limit=1")
+        self.assertEqual(len(response.get_json()), 1)
+        response = self.client.get(f"{BASE_URL}/suggest", query_string="q=")
+        self.assertEqual(response.get_json(), [])
+        response = self.client.get(f"{BASE_URL}/suggest", query_string="q=run&limit=1000")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        response = self.client.get(f"{BASE_URL}/suggest", query_string="q=run&limit=x")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    def test_product_stats(self):
+        """It should count Products per facet with a single GROUP BY"""
+        catalog = [
+            ("hats", 12.0, True, 4.0),
+            ("hats", 18.0, False, None),
+            ("shoes", 25.0, True, 3.0),
+            ("shoes", 45.0, True, 5.0),
+        ]
+        for category, price, available, rating in catalog:
+            product = ProductFactory(category=category, price=price, available=available, rating=rating)
+            response = self.client.post(BASE_URL, json=product.serialize())
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.get(f"{BASE_URL}/stats")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["total"], 4)
+        self.assertEqual(data["available"], {"true": 3, "false": 1})
+        self.assertEqual(
+            data["categories"]["hats"],
+            {"count": 2, "available": 1, "min_price": 12.0, "max_price": 18.0, "avg_price": 15.0, "avg_rating": 4.0},
+        )
+        self.assertEqual(data["categories"]["shoes"]["avg_rating"], 4.0)
+        self.assertEqual(
+            data["price_buckets"],
+            [
+                {"min": 10.0, "max": 20.0, "count": 2},
+                {"min": 20.0, "max": 30.0, "count": 1},
+                {"min": 40.0, "max": 50.0, "count": 1},
+            ],
+        )
+        etag = response.headers["ETag"]
+        response = self.client.get(f"{BASE_URL}/stats", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get(f"{BASE_URL}/stats", query_string="category=shoes")
+        self.assertEqual(list(response.get_json()["categories"]), ["shoes"])
+        self.client.delete(f"{BASE_URL}/bulk", json={"filter": {"category": "hats"}})
+        response = self.client.get(f"{BASE_URL}/stats")
+        self.assertEqual(response.get_json()["total"], 2)
+        response = self.client.get(f"{BASE_URL}/stats", query_string="price=-1")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    def test_category_summary(self):
+        """It should summarize every category"""
+        products = self._create_products(5)
+        response = self.client.get(f"{BASE_URL}/categories")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(sum(facet["count"] for facet in data.values()), 5)
+        self.assertEqual(
+            sum(facet["available"] for facet in data.values()),
+            len([product for product in products if product.available]),
+        )
+
+    def test_pool_metrics(self):
+        """It should report the connection pool of the worker"""
+        self.client.get(BASE_URL)
+        response = self.client.get("/metrics/pool")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["pid"], os.getpid())
+        self.assertGreater(data["checkouts"], 0)
+        for key in ("size", "checked_out", "overflow", "timeouts", "wait_seconds_total"):
+            self.assertIn(key, data)